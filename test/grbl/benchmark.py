@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+GRBL communication and motion benchmarks
+Runs against the firmware emulator by default so it can be used in CI
+Use --port to benchmark real hardware instead
+
+Ex:
+./test/grbl/benchmark.py
+./test/grbl/benchmark.py --microscope lip-m2 --status-hz 50 --json out.json
+"""
+
+from uscope.motion.grbl import GRBL, GrblHal
+from uscope.motion.grbl_emulator import GrblEmulator
+from uscope.planner.scan_order import MotionModel
+from uscope.util import add_bool_arg
+import json
+import time
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize(dts):
+    return {
+        "n": len(dts),
+        "mean_ms": 1000.0 * sum(dts) / len(dts),
+        "p95_ms": 1000.0 * percentile(dts, 0.95),
+        "max_ms": 1000.0 * max(dts),
+    }
+
+
+def grid_positions(origin, cols, rows, step):
+    """
+    Serpentine tile visit like the XY planner
+    """
+    ret = []
+    for row in range(rows):
+        cols_iter = range(cols) if row % 2 == 0 else reversed(range(cols))
+        for col in cols_iter:
+            ret.append({
+                "x": origin["x"] + col * step,
+                "y": origin["y"] + row * step,
+            })
+    return ret
+
+
+def bench_status(grbl, n):
+    dts = []
+    for _i in range(n):
+        tstart = time.time()
+        grbl.qstatus()
+        dts.append(time.time() - tstart)
+    return summarize(dts)
+
+
+def bench_moves(move_absolute, positions, model, start):
+    """
+    Blocking move per position as a scan does
+    Compare against the time the motion itself should take
+    """
+    dts = []
+    tstart = time.time()
+    for pos in positions:
+        t = time.time()
+        move_absolute(pos)
+        dts.append(time.time() - t)
+    total = time.time() - tstart
+    ideal = model.path_time(positions, start=start)
+    ret = summarize(dts)
+    ret.update({
+        "total_s":
+        total,
+        "ideal_s":
+        ideal,
+        "overhead_ms_per_move":
+        1000.0 * (total - ideal) / len(positions),
+    })
+    return ret
+
+
+def bench_stream(grbl, positions, f, model, start):
+    tstart = time.time()
+    for pos in positions:
+        grbl.stream_move_absolute(pos, f=f)
+    tqueued = time.time() - tstart
+    grbl.wait_idle()
+    total = time.time() - tstart
+    ideal = model.path_time(positions, start=start)
+    return {
+        "n": len(positions),
+        "queue_s": tqueued,
+        "total_s": total,
+        "ideal_s": ideal,
+        "overhead_ms_per_move": 1000.0 * (total - ideal) / len(positions),
+    }
+
+
+def bench_jog(grbl, n, rate, period):
+    """
+    Keyboard style jogging: short relative jogs then a cancel
+    """
+    dts = []
+    for i in range(n):
+        tstart = time.time()
+        grbl.jog_rel({"x": 0.1 if i % 2 == 0 else -0.1}, rate)
+        dts.append(time.time() - tstart)
+        time.sleep(period)
+    tstart = time.time()
+    grbl.jog_cancel()
+    ret = summarize(dts)
+    ret["cancel_ms"] = 1000.0 * (time.time() - tstart)
+    return ret
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="GRBL benchmarks")
+    add_bool_arg(parser, "--verbose", default=False, help="Verbose output")
+    parser.add_argument("--port",
+                        help="Benchmark this controller instead of emulating")
+    parser.add_argument(
+        "--microscope",
+        help="Run moves through GrblHal configured for this microscope")
+    parser.add_argument("--status-hz",
+                        type=float,
+                        default=0.0,
+                        help="Status reader thread rate. 0: on demand")
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0.002,
+                        help="Emulator response latency in seconds")
+    parser.add_argument("--corrupt-rate", type=float, default=0.0)
+    parser.add_argument("--status-n", type=int, default=100)
+    parser.add_argument("--grid",
+                        type=int,
+                        default=5,
+                        help="Move benchmark is grid x grid tiles")
+    parser.add_argument("--step",
+                        type=float,
+                        default=0.5,
+                        help="Tile step in mm")
+    parser.add_argument("--f", type=int, default=1000, help="mm/min")
+    parser.add_argument("--json", help="Also write results here")
+    args = parser.parse_args()
+
+    emu = None
+    port = args.port
+    if port is None:
+        emu = GrblEmulator(latency=args.latency,
+                           corrupt_rate=args.corrupt_rate,
+                           seed=0)
+        port = emu.start()
+
+    results = {}
+    try:
+        if args.microscope:
+            # Full config stack needs gstreamer etc
+            from uscope.motion.plugins import configure_motion_hal
+            from uscope.microscope import get_virtual_microscope, get_mconfig
+
+            microscope = get_virtual_microscope(mconfig=get_mconfig(
+                name=args.microscope))
+            hal = GrblHal(port=port,
+                          microscope=microscope,
+                          verbose=args.verbose)
+            if args.status_hz:
+                hal.grbl.start_status_reader(args.status_hz)
+            microscope.set_motion(hal)
+            microscope.set_motion_ts(hal)
+            configure_motion_hal(microscope)
+            grbl = hal.grbl
+            move_absolute = hal.move_absolute
+            start = hal.pos()
+            model = MotionModel.from_motion(hal, microscope=microscope)
+        else:
+            grbl = GRBL(port=port,
+                        status_hz=args.status_hz,
+                        verbose=args.verbose)
+            move_absolute = lambda pos: grbl.move_absolute(pos, f=args.f)
+            start = grbl.mpos()
+            model = MotionModel(grbl.axes_max_rate(),
+                                grbl.axes_max_acceleration())
+            # Feed limited below machine max
+            model.velocities = dict([(axis, min(v, args.f / 60.0))
+                                     for axis, v in model.velocities.items()])
+
+        positions = grid_positions(start, args.grid, args.grid, args.step)
+        results["status"] = bench_status(grbl, args.status_n)
+        results["moves"] = bench_moves(move_absolute, positions, model, start)
+        move_absolute(start)
+        if not args.microscope:
+            results["stream"] = bench_stream(grbl, positions, args.f, model,
+                                             start)
+            move_absolute(start)
+        results["jog"] = bench_jog(grbl, 20, rate=600, period=0.05)
+        if emu:
+            results["emulator"] = {
+                "lines": emu.lines_rx,
+                "status_reports": emu.status_reports,
+                "rx_buffer_max": emu.rx_buffer_max,
+                "rx_overflows": emu.rx_overflows,
+            }
+    finally:
+        if emu:
+            emu.stop()
+
+    for name, result in results.items():
+        print(name)
+        for k, v in result.items():
+            if type(v) is float:
+                print("  %-22s %0.3f" % (k, v))
+            else:
+                print("  %-22s %s" % (k, v))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
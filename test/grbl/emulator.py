@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Serve an emulated GRBL controller on a pseudo-terminal
+Point tools at it with GRBL_PORT:
+    ./test/grbl/emulator.py --link /tmp/grbl
+    GRBL_PORT=/tmp/grbl ./test/grbl/status.py
+"""
+
+from uscope.motion.grbl_emulator import GrblEmulator
+from uscope.util import add_bool_arg
+import os
+import time
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="GRBL firmware emulator")
+    add_bool_arg(parser, "--verbose", default=False, help="Verbose output")
+    add_bool_arg(parser,
+                 "--homed",
+                 default=True,
+                 help="Start idle instead of requiring $H")
+    parser.add_argument("--link", help="Symlink this path to the pty")
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0.002,
+                        help="Response latency in seconds")
+    parser.add_argument("--noise-rate",
+                        type=float,
+                        default=0.0,
+                        help="Probability of a junk line per response")
+    parser.add_argument("--corrupt-rate",
+                        type=float,
+                        default=0.0,
+                        help="Probability of a corrupted status report")
+    parser.add_argument("--homing-time", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    emu = GrblEmulator(homed=args.homed,
+                       homing_time=args.homing_time,
+                       latency=args.latency,
+                       noise_rate=args.noise_rate,
+                       corrupt_rate=args.corrupt_rate,
+                       seed=args.seed,
+                       verbose=args.verbose)
+    port = emu.start()
+    if args.link:
+        if os.path.islink(args.link):
+            os.unlink(args.link)
+        os.symlink(port, args.link)
+        port = args.link
+    print("GRBL emulator on %s" % (port, ))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emu.stop()
+        if args.link:
+            os.unlink(args.link)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,8 +9,10 @@ Running the full suite:
 
 import unittest
 import os
+import json
 import json5
-from uscope.motion.hal import MockHal
+from uscope.motion.hal import MockHal, MotionStop
+from uscope.motion.thread import MotionThreadBase
 from uscope.imager.imager import MockImager
 from uscope.imager import gst
 from uscope.imager.util import have_touptek_camera, have_v4l2_camera
@@ -18,11 +20,32 @@ import uscope.planner
 from uscope.config import get_usj
 from uscope.util import printj
 from uscope.planner import microscope_to_planner
+from uscope.planner.planner_util import get_planner
+from uscope.planner.focus_map import FocusMap, load_focus_map
+from uscope.microscope import get_virtual_microscope
+from uscope.kinematics import Kinematics, SettleStats
 import shutil
+import threading
 import time
+import types
 import glob
-from uscope.motion.grbl import GRBL, GrblHal
+import cv2
+import numpy as np
+from PIL import Image, TiffImagePlugin
+from uscope.motion.grbl import GRBL, GrblHal, GrblError, GRBL_RX_BUFFER_SIZE
+from uscope.motion.grbl import write_wcs_vals
+from uscope.motion.grbl_emulator import Block, GrblEmulator
 from uscope.imager.touptek import toupcamsrc_info
+from uscope import scan_util
+from uscope.planner.scan_order import MotionModel, pattern_order, optimize_order, excluded_tiles
+from uscope.imagep.pipeline import CSImageProcessor, get_open_set
+from uscope.spool import SpoolWriter, spool_fn, spool_to_dir
+from uscope.imagep.cache import ResultCache
+from uscope.imagep.util import EtherealImageR, EtherealImageW, im_to_shm, im_from_shm
+from uscope.imagep.plugins import FocusStackFuser, StackNativePlugin
+from uscope.imagep.plugins import ExposureFuser, HDRMertensPlugin
+from uscope.imagep.plugins import FlatFieldEngine
+from uscope.imagep.tiled import DeepZoomWriter, PyramidTiffWriter, downsample2
 
 TT_WH = (5440, 3648)
 TT_WH = (4928, 4928)
@@ -231,6 +254,327 @@ class PlannerTestCase(TestCommon):
         microscope_to_planner(usj, objectivei=0, contour=contour)
 
 
+class MockPlannerTestCommon(TestCommon):
+    """
+    Run the real planner pipeline on a mock microscope
+    """
+    def get_planner(self, pconfig):
+        log = lambda *args, **kwargs: None
+        microscope = get_virtual_microscope(mconfig={"name": "mock"})
+        motion = MockHal(log=log, microscope=microscope)
+        motion.configure({})
+        imager = MockImager(width=150, height=50)
+        microscope.set_motion(motion)
+        microscope.set_motion_ts(motion)
+        microscope.set_imager(imager)
+        microscope.set_imager_ts(imager)
+        kinematics = Kinematics(microscope=microscope, log=log)
+        kinematics.configure(tsettle_motion=0.0, tsettle_hdr=0.0)
+        microscope.set_kinematics(kinematics)
+        microscope.set_kinematics_ts(kinematics)
+        return get_planner(microscope=microscope,
+                           pconfig=pconfig,
+                           out_dir=self.planner_dir,
+                           dry=False,
+                           log=log)
+
+    def xy3p_config(self):
+        """
+        3 images wide
+        4 images tall
+        """
+        return {
+            "imager": {
+                "x_view": 1.0,
+            },
+            "motion": {},
+            "kinematics": {
+                "tsettle_motion": 0.0,
+                "tsettle_hdr": 0.0,
+            },
+            "objective": {
+                "name": "mock",
+                "x_view": 1.0,
+                "na": 0.1,
+                "magnification": 5,
+            },
+            "points-xy3p": {
+                "corners": {
+                    "ll": {
+                        "x": 0.0,
+                        "y": 0.0,
+                        "z": 0.0
+                    },
+                    "ul": {
+                        "x": 0.0,
+                        "y": 1.0,
+                        "z": 0.0
+                    },
+                    "lr": {
+                        "x": 2.0,
+                        "y": 0.0,
+                        "z": 0.0
+                    },
+                },
+            },
+        }
+
+
+class PointGenerator3PTestCase(MockPlannerTestCommon):
+    def test_refocus(self):
+        """
+        Corners are autofocused while the planner is being set up
+        """
+        pconfig = self.xy3p_config()
+        pconfig["points-xy3p"]["refocus"] = True
+        planner = self.get_planner(pconfig)
+        xy3p = planner.pipeline["points-xy3p"]
+        assert xy3p.af is not None
+        assert xy3p.af.moves > 0
+        assert xy3p.corners["lr"]["x"] == 2.0
+        assert xy3p.corners["ul"]["y"] == 1.0
+        planner.run()
+        assert len(glob.glob(self.planner_dir + "/c*_r*.jpg")) == 12
+
+
+class ScanOrderTestCase(MockPlannerTestCommon):
+    def grid(self, cols, rows, excluded=()):
+        return [(col, row) for row in range(rows) for col in range(cols)
+                if (col, row) not in excluded]
+
+    def test_pattern_order(self):
+        tiles = self.grid(3, 2)
+        assert pattern_order(tiles) == [(0, 0), (1, 0), (2, 0), (2, 1), (1, 1),
+                                        (0, 1)]
+        assert pattern_order(tiles, serpentine=False) == tiles
+        assert pattern_order(tiles, reverse=True) == [(2, 0), (1, 0), (0, 0),
+                                                      (0, 1), (1, 1), (2, 1)]
+        assert pattern_order(tiles, major="y") == [(0, 0), (0, 1), (1, 1),
+                                                   (1, 0), (2, 0), (2, 1)]
+        # A fully excluded line doesn't flip the direction of the rest
+        tiles = self.grid(2, 3, excluded=((0, 1), (1, 1)))
+        assert pattern_order(tiles) == [(0, 0), (1, 0), (0, 2), (1, 2)]
+
+    def test_optimize_order(self):
+        calc_pos = lambda col, row: {"x": col * 1.0, "y": row * 0.2}
+        model = MotionModel({"x": 600.0, "y": 600.0}, {"x": 50.0, "y": 50.0})
+        origin = calc_pos(0, 0)
+        tiles = self.grid(5, 8, excluded=((4, 0), (4, 1), (3, 0)))
+        order, name, seconds = optimize_order(tiles,
+                                              calc_pos,
+                                              model,
+                                              start=origin,
+                                              end=origin)
+        assert sorted(order) == sorted(tiles)
+        assert name
+        for major in ("x", "y"):
+            pattern = pattern_order(tiles, major=major)
+            assert seconds <= model.path_time(
+                [calc_pos(*tile) for tile in pattern],
+                start=origin,
+                end=origin) + 1e-9
+        # Tall narrow tiles: columns are the cheaper lines
+        assert name.startswith("y-major") or name == "nearest"
+
+    def test_excluded_scan(self):
+        """
+        Excluded tiles aren't reported as missing by post processing
+        """
+        pconfig = self.xy3p_config()
+        pconfig["exclude"] = [{"c0": 1, "c1": 1, "r0": 1, "r1": 2}]
+        assert excluded_tiles(pconfig["exclude"], 3, 4) == [(1, 1), (1, 2)]
+        planner = self.get_planner(pconfig)
+        assert planner.pipeline["points-xy3p"].images_expected() == 10
+        planner.run()
+
+        excluded = scan_util.scan_excluded_tiles(self.planner_dir)
+        assert excluded == set([(1, 1), (1, 2)])
+        iindex = scan_util.index_scan_images(self.planner_dir)
+        assert len(iindex["images"]) == 10
+        assert get_open_set(iindex) == excluded
+        assert get_open_set(iindex, excluded) == set()
+        csip = CSImageProcessor(nthreads=1, log=lambda s: None)
+        csip.start()
+        csip.ready.wait(1.0)
+        try:
+            assert not csip.inspect_final_dir(iindex)
+            assert csip.inspect_final_dir(iindex, excluded)
+        finally:
+            csip.shutdown()
+
+
+class SettleImager:
+    """
+    Live frames that shift each frame until moving frames have passed
+    Each frame advances clock by 10 ms
+    """
+    def __init__(self, moving, clock):
+        noise = np.random.RandomState(0).randint(0, 256, size=(120, 256))
+        self.base = cv2.GaussianBlur(noise.astype(np.uint8), (0, 0), 2)
+        self.moving = moving
+        self.clock = clock
+        self.n = 0
+
+    def get(self):
+        frame = np.roll(self.base, 3 * min(self.n, self.moving), axis=1)
+        self.n += 1
+        self.clock[0] += 0.01
+        return types.SimpleNamespace(to_np=lambda: frame)
+
+
+class KinematicsSettleTestCase(TestCommon):
+    def setUp(self):
+        super().setUp()
+        self.microscope = get_virtual_microscope(mconfig={"name": "mock"})
+        self.kinematics = Kinematics(microscope=self.microscope,
+                                     log=lambda *args, **kwargs: None)
+        self.kinematics.configure(tsettle_motion=0.5,
+                                  tsettle_hdr=0.2,
+                                  tsettle_autofocus=0.1,
+                                  settle_mode="adaptive")
+        # Simulated seconds since the move
+        self.clock = [0.0]
+        self.sleeps = []
+
+        def sleep(t):
+            self.sleeps.append(t)
+            self.clock[0] += t
+
+        self.kinematics.sleep = sleep
+
+    def imager(self, moving):
+        imager = SettleImager(moving, self.clock)
+        self.microscope.set_imager_ts(imager)
+        return imager
+
+    def wait_settle(self, tsettle=0.5, stats=None):
+        return self.kinematics.wait_settle(tsettle,
+                                           lambda: self.clock[0],
+                                           stats=stats)
+
+    def test_still_frames(self):
+        imager = self.imager(moving=5)
+        # 5 moving pairs then settle_still_frames (2) still ones
+        t = self.wait_settle()
+        assert imager.n == 8, imager.n
+        assert abs(t - 0.08) < 1e-6, t
+        self.clock[0] = 0.0
+        self.kinematics.settle_still_frames = 3
+        imager = self.imager(moving=5)
+        self.wait_settle()
+        assert imager.n == 9, imager.n
+
+    def test_timeout(self):
+        stats = SettleStats()
+        self.imager(moving=1000)
+        # Never still: falls back to waiting the full fixed delay
+        assert self.wait_settle(tsettle=0.1, stats=stats) is None
+        assert self.clock[0] >= 0.1
+        assert stats.timeouts == 1
+        assert len(stats.times) == 0
+
+    def test_exposure(self):
+        frame = SettleImager(0, [0.0]).base.astype(np.float32)
+        brighter = frame * 1.1
+        assert self.kinematics.frames_settled(frame, brighter)
+        assert not self.kinematics.frames_settled(
+            frame, brighter, exposure=True)
+        assert self.kinematics.frames_settled(frame,
+                                              frame * 1.01,
+                                              exposure=True)
+
+    def test_min_wait(self):
+        stats = SettleStats()
+        for t in (0.2, 0.3, 0.4):
+            stats.add(t)
+        # Not enough samples to trust yet
+        assert stats.min_wait() == 0.0
+        stats.add(0.5)
+        assert abs(stats.min_wait() - 0.15) < 1e-6
+        imager = self.imager(moving=0)
+        t = self.wait_settle(stats=stats)
+        # Skips frames that would have been in motion
+        assert len(self.sleeps) == 1 and abs(self.sleeps[0] - 0.15) < 1e-6
+        assert imager.n == 3
+        assert abs(t - 0.18) < 1e-6, t
+        assert len(stats.times) == 5
+        # Capped by tsettle
+        self.sleeps = []
+        self.clock[0] = 0.0
+        self.wait_settle(tsettle=0.1, stats=stats)
+        assert abs(self.sleeps[0] - 0.1) < 1e-6, self.sleeps
+
+
+class FocusMapTestCase(TestCommon):
+    def surface(self, x, y):
+        return 1.0 + 0.01 * x - 0.02 * y + 0.003 * x * y
+
+    def add_grid(self, focus_map, f):
+        for x in (0.0, 5.0, 10.0):
+            for y in (0.0, 4.0, 8.0):
+                focus_map.add(x, y, f(x, y), refit=False)
+        focus_map.fit()
+
+    def test_plane(self):
+        plane = lambda x, y: 1.0 + 0.01 * x - 0.02 * y
+        # All methods reproduce a plane
+        for method in ("plane", "bilinear", "tps"):
+            focus_map = FocusMap(method)
+            self.add_grid(focus_map, plane)
+            assert focus_map.fit_method == method
+            for x, y in ((2.5, 1.0), (7.0, 6.5), (12.0, -1.0)):
+                self.assertAlmostEqual(focus_map.predict(x, y), plane(x, y))
+
+    def test_bilinear(self):
+        focus_map = FocusMap("bilinear")
+        self.add_grid(focus_map, self.surface)
+        self.assertAlmostEqual(focus_map.predict(3.0, 7.0),
+                               self.surface(3.0, 7.0))
+        # Twist isn't a plane
+        focus_map = FocusMap("plane")
+        self.add_grid(focus_map, self.surface)
+        assert abs(focus_map.predict(10.0, 8.0) -
+                   self.surface(10.0, 8.0)) > 0.01
+
+    def test_tps(self):
+        bump = lambda x, y: self.surface(x, y) + 0.05 * np.sin(x) * np.cos(y)
+        focus_map = FocusMap("tps")
+        self.add_grid(focus_map, bump)
+        # Exact through the points
+        for x, y, z, _source in focus_map.points:
+            self.assertAlmostEqual(focus_map.predict(x, y), z)
+        # Smoothing trades that for a softer surface
+        smooth = FocusMap("tps", smoothing=10.0)
+        self.add_grid(smooth, bump)
+        assert abs(smooth.predict(5.0, 4.0) - bump(5.0, 4.0)) > 1e-4
+
+    def test_fallback(self):
+        focus_map = FocusMap("tps")
+        focus_map.add(0.0, 0.0, 1.0)
+        focus_map.add(1.0, 0.0, 2.0)
+        assert focus_map.fit_method == "constant"
+        self.assertAlmostEqual(focus_map.predict(5.0, 5.0), 1.5)
+        focus_map = FocusMap("bilinear")
+        for x, y in ((0.0, 0.0), (1.0, 0.0), (0.0, 1.0)):
+            focus_map.add(x, y, x + y)
+        assert focus_map.fit_method == "plane"
+        with self.assertRaises(ValueError):
+            FocusMap("spline")
+
+    def test_residuals_json(self):
+        focus_map = FocusMap("bilinear")
+        self.add_grid(focus_map, self.surface)
+        focus_map.add(2.0, 2.0, self.surface(2.0, 2.0) + 0.1)
+        self.assertAlmostEqual(focus_map.residual_rms(), 0.1)
+        with open("/tmp/pyuscope/uscan.json", "w") as f:
+            json.dump({"points-xy3p": {"focus-map": focus_map.to_j()}}, f)
+        loaded = load_focus_map("/tmp/pyuscope")
+        assert len(loaded) == len(focus_map)
+        assert loaded.residuals == focus_map.residuals
+        self.assertAlmostEqual(loaded.predict(3.0, 3.0),
+                               focus_map.predict(3.0, 3.0))
+
+
 class GstTestCase(TestCommon):
     def test_mock(self):
         usj = get_usj(name="mock")
@@ -469,5 +813,687 @@ class GrblHalTestCase(TestCommon):
             self.gh.move_relative(pos={axis: -self.delta})
 
 
+class MockGrblStreamTestCase(TestCommon):
+    """
+    Character counting flow control against the mock's emulated RX buffer
+    """
+    def setUp(self):
+        super().setUp()
+        self.grbl = GRBL(port="mock")
+        self.gs = self.grbl.gs
+
+    def tearDown(self):
+        self.grbl.close()
+        super().tearDown()
+
+    def test_stream_flow_control(self):
+        seqs = []
+        for i in range(100):
+            seqs.append(
+                self.grbl.stream_move_absolute(
+                    {
+                        "x": i * 0.01,
+                        "z": (i % 5) * 0.002
+                    }, f=1000))
+        # Never overran the controller
+        assert self.gs.rx_buffer_max <= GRBL_RX_BUFFER_SIZE
+        # But kept it busy
+        assert self.gs.stream_pending
+        assert self.gs.stream_acked(seqs[0])
+        self.grbl.wait_idle()
+        assert self.gs.stream_acked(seqs[-1])
+        assert not self.gs.stream_pending
+        mpos = self.grbl.mpos()
+        assert abs(mpos["x"] - 0.99) < 0.0001
+        assert abs(mpos["z"] - 0.008) < 0.0001
+
+    def test_stream_error(self):
+        self.gs.stream("$J=G17 X1")
+        with self.assertRaises(GrblError):
+            self.grbl.wait_idle()
+        # Error is reported once
+        self.grbl.wait_idle()
+
+    def test_stream_stop(self):
+        for i in range(20):
+            self.grbl.stream_move_absolute({"x": 1.0 + i}, f=1000)
+        self.grbl.stop()
+        assert not self.gs.stream_pending
+
+
+class MockGrblReaderTestCase(TestCommon):
+    """
+    Status reader thread against the mock
+    """
+    def setUp(self):
+        super().setUp()
+        self.grbl = GRBL(port="mock", status_hz=50)
+        self.gs = self.grbl.gs
+
+    def tearDown(self):
+        self.grbl.close()
+        super().tearDown()
+
+    def test_reader_status(self):
+        statuses = []
+        self.gs.reader.register_status_cb(statuses.append)
+        status = self.gs.reader.wait_status(timeout=1.0)
+        assert status.idle()
+        assert set(status.mpos.keys()) == set("xyz")
+        time.sleep(0.2)
+        # Polled without anyone asking
+        assert len(statuses) >= 3
+
+    def test_reader_stream(self):
+        for i in range(50):
+            self.grbl.stream_move_absolute({"x": i * 0.1}, f=1000)
+        self.grbl.wait_idle()
+        assert not self.gs.stream_pending
+        assert abs(self.grbl.pos_cache["x"] - 4.9) < 0.0001
+        assert abs(self.grbl.mpos()["x"] - 4.9) < 0.0001
+
+
+class GrblEmulatorTestCase(TestCommon):
+    """
+    Real serial stack against the pty firmware emulator
+    """
+    def setUp(self):
+        super().setUp()
+        self.emu = GrblEmulator(seed=0)
+        self.grbl = GRBL(port=self.emu.start())
+
+    def tearDown(self):
+        self.grbl.close()
+        self.emu.stop()
+        super().tearDown()
+
+    def test_emulator_move(self):
+        assert self.grbl.qstatus()["status"] == "Idle"
+        start = self.emu.current_position()
+        tstart = time.time()
+        self.grbl.move_absolute({"x": -2.0, "y": -1.0}, f=1000)
+        dt = time.time() - tstart
+        assert self.emu.moves == 1
+        block = Block(start, self.emu.current_position(), 1000,
+                      self.emu.max_rates(), self.emu.accelerations())
+        # Limited by acceleration: 2.24 mm at 33.5 mm/sec^2 along the move
+        # => never reaches 1000 mm/min
+        assert block.t_cruise == 0.0
+        assert abs(block.duration - 0.516) < 0.001, block.duration
+        # Only acked once the modelled motion is done
+        assert dt >= block.duration, dt
+        mpos = self.grbl.mpos()
+        assert abs(mpos["x"] + 2.0) < 0.0001
+        assert abs(mpos["y"] + 1.0) < 0.0001
+
+    def test_emulator_wcs(self):
+        write_wcs_vals(self.grbl.gs, 3, (1.0, -2.0, 3.5))
+        assert "G56:1.000,-2.000,3.500" in self.grbl.gs.hash()
+
+    def test_emulator_jog_cancel(self):
+        self.grbl.jog_rel({"x": -20.0}, 600)
+        time.sleep(0.2)
+        self.grbl.jog_cancel()
+        x = self.grbl.mpos()["x"]
+        assert -20.0 < x < 0.0, x
+        with self.assertRaises(GrblError):
+            self.grbl.gs.j("G91 X1.0")
+
+    def test_emulator_path_markers(self):
+        """
+        G4 P0 is only acked once motion stops (as move_path() relies on)
+        """
+        seqs = []
+        for x in (-0.5, -1.0, -1.5):
+            self.grbl.stream_move_absolute({"x": x}, f=1000, jog=False)
+            seqs.append(self.grbl.gs.stream("G4 P0"))
+        for x, seq in zip((-0.5, -1.0, -1.5), seqs):
+            self.grbl.gs.stream_wait(seq)
+            assert abs(self.grbl.mpos()["x"] - x) < 0.0001
+        self.grbl.wait_idle()
+
+    def test_emulator_stop_queued(self):
+        """
+        stop() flushes queued G1 moves without losing position
+        """
+        self.grbl.gs.txrx0("G10 L2 P1 X-1 Y0 Z0")
+        self.grbl.gs.txrx0("G55 T1")
+        self.grbl.reset_modal = self.grbl.modal_state()
+        assert self.grbl.reset_modal == ["G55", "T1"], self.grbl.reset_modal
+        for x in (-2.0, -4.0, -6.0, -8.0):
+            self.grbl.stream_move_absolute({"x": x}, f=1000, jog=False)
+        time.sleep(0.3)
+        self.grbl.stop()
+        status = self.grbl.qstatus()
+        assert status["status"] == "Idle", status
+        assert -4.0 < status["MPos"]["x"] < 0.0, status
+        assert not self.grbl.gs.stream_pending
+        # WCS and tool (homed flag) survive the soft reset
+        assert self.grbl.selected_tool() == 1
+        assert "G55" in self.grbl.gs.g()
+        # Still usable: no alarm to clear
+        self.grbl.move_absolute({"x": -1.0}, f=1000)
+        assert abs(self.grbl.mpos()["x"] + 1.0) < 0.0001
+
+    def test_emulator_move_path_modal(self):
+        """
+        Path G1 moves don't leave G1 modal for later moves
+        """
+        microscope = get_virtual_microscope(mconfig={"name": "mock"})
+        hal = GrblHal(grbl=self.grbl,
+                      microscope=microscope,
+                      log=lambda *args, **kwargs: None)
+        try:
+            hal.configure({})
+            assert self.grbl.motion_mode() == "G0"
+            path = [{"x": -1.0}, {"x": -2.0}]
+            got = [i for i, _pos in hal.move_path_iter(path, dwells=0.01)]
+            assert got == [0, 1], got
+            assert abs(hal.pos()["x"] + 2.0) < 0.0001
+            assert self.grbl.motion_mode() == "G0"
+            # Also when the caller stops early
+            it = hal.move_path_iter(path)
+            next(it)
+            it.close()
+            assert self.grbl.motion_mode() == "G0"
+        finally:
+            # Don't stop() from __del__ after the emulator is gone
+            hal.grbl = None
+
+
+class MockMotionThread(MotionThreadBase):
+    def __init__(self, microscope):
+        # Normally the GUI application context
+        self.ac = types.SimpleNamespace(microscope=microscope)
+        self.mock_motion = MockHal(log=lambda *args, **kwargs: None,
+                                   microscope=microscope)
+        self.mock_motion.configure({})
+        super().__init__(microscope=microscope)
+
+    def init_motion(self):
+        self.motion = self.mock_motion
+
+
+class MotionThreadTestCase(TestCommon):
+    def setUp(self):
+        super().setUp()
+        microscope = get_virtual_microscope(mconfig={"name": "mock"})
+        self.mt = MockMotionThread(microscope)
+        self.thread = threading.Thread(target=self.mt.run, daemon=True)
+        self.thread.start()
+        self.motion = self.mt.get_planner_motion()
+
+    def tearDown(self):
+        self.mt.shutdown()
+        self.thread.join(3.0)
+        super().tearDown()
+
+    def test_move_path(self):
+        path = [{"x": 1.0}, {"x": 2.0}, {"x": 3.0}]
+        got = [i for i, _pos in self.motion.move_path_iter(path)]
+        assert got == [0, 1, 2], got
+        assert self.motion.pos()["x"] == 3.0
+
+    def test_move_path_stop(self):
+        """
+        A stopped path raises instead of looking finished
+        """
+        it = self.motion.move_path_iter([{"x": 1.0}, {"x": 2.0}, {"x": 3.0}])
+        assert next(it)[0] == 0
+        self.mt.stop()
+        while self.mt._stop:
+            time.sleep(0.01)
+        with self.assertRaises(MotionStop):
+            next(it)
+        # Next path isn't affected
+        got = [i for i, _pos in self.motion.move_path_iter([{"x": 0.0}])]
+        assert got == [0], got
+
+
+class ScanUtilTestCase(TestCommon):
+    def setUp(self):
+        super().setUp()
+        self.scan_dir = "/tmp/pyuscope/scan"
+        os.mkdir(self.scan_dir)
+        for col in range(3):
+            for row in range(2):
+                self.touch("c%03u_r%03u_h%02u.jpg" % (col, row, row))
+        self.touch("uscan.json")
+
+    def touch(self, basename):
+        open(os.path.join(self.scan_dir, basename), "w").close()
+
+    def backdate(self):
+        """
+        Make the directory mtime old enough to be trusted
+        """
+        t = time.time() - 10 * scan_util.IINDEX_MTIME_SLACK
+        os.utime(self.scan_dir, (t, t))
+
+    def test_parse_fn(self):
+        v = scan_util.iindex_parse_fn("c001_r002_z03_h04_is05.tif")
+        assert v["col"] == 1 and v["col_str"] == "c001"
+        assert v["row"] == 2 and v["stack"] == 3 and v["hdr"] == 4
+        assert v["stabilization"] == 5 and v["extension"] == ".tif"
+        assert scan_util.iindex_parse_fn("image.jpg")["singleton"]
+        with self.assertRaises(AssertionError):
+            scan_util.iindex_parse_fn("c001_x002.jpg")
+
+    def test_index_cache(self):
+        iindex = scan_util.index_scan_images(self.scan_dir)
+        assert len(iindex["images"]) == 6
+        assert iindex["cols"] == 3 and iindex["rows"] == 2
+        assert iindex["hdrs"] == 2
+        assert os.path.exists(
+            os.path.join(self.scan_dir, scan_util.IINDEX_CACHE_FN))
+        assert not scan_util.is_tif_scan(self.scan_dir)
+
+        # New outputs are picked up
+        self.touch("c003_r000_h00.tif")
+        iindex = scan_util.index_scan_images(self.scan_dir)
+        assert iindex["cols"] == 4
+        assert scan_util.is_tif_scan(self.scan_dir)
+
+        # Unchanged directory reuses the cache, even from another process
+        self.backdate()
+        scan_util.index_scan_images(self.scan_dir)
+        scan_util._iindex_cache.clear()
+        iindex = scan_util.index_scan_images(self.scan_dir)
+        assert len(iindex["images"]) == 7
+        # Callers can modify their copy
+        iindex["images"]["c000_r000_h00.jpg"]["col"] = 10
+        iindex = scan_util.index_scan_images(self.scan_dir)
+        assert iindex["images"]["c000_r000_h00.jpg"]["col"] == 0
+
+        os.remove(os.path.join(self.scan_dir, "c003_r000_h00.tif"))
+        iindex = scan_util.index_scan_images(self.scan_dir)
+        assert iindex["cols"] == 3 and len(iindex["images"]) == 6
+
+    def test_index_cache_unwritable(self):
+        # Can't be written, even as root
+        os.mkdir(os.path.join(self.scan_dir, scan_util.IINDEX_CACHE_FN))
+        iindex = scan_util.index_scan_images(self.scan_dir)
+        assert len(iindex["images"]) == 6
+        self.touch("c003_r000_h00.jpg")
+        iindex = scan_util.index_scan_images(self.scan_dir)
+        assert iindex["cols"] == 4 and len(iindex["images"]) == 7
+
+
+class SpoolTestCase(TestCommon):
+    def test_exif(self):
+        """
+        Capture EXIF (ex: exposure for HDR) must survive the spool
+        """
+        exif = Image.Exif()
+        exif.get_ifd(0x8769)[33434] = TiffImagePlugin.IFDRational(1, 100)
+        fn = spool_fn("/tmp/pyuscope")
+        spool = SpoolWriter(fn, capacity=2, shape=(16, 16, 3))
+        array = np.full((16, 16, 3), 128, dtype=np.uint8)
+        spool.append({
+            "col": 0,
+            "row": 0
+        },
+                     "c000_r000",
+                     array,
+                     exif=exif.tobytes())
+        spool.append({"col": 1, "row": 0}, "c001_r000", array)
+        spool.close()
+
+        spool_to_dir(fn, "/tmp/pyuscope/out")
+        im = Image.open("/tmp/pyuscope/out/c000_r000.jpg")
+        assert im.getexif().get_ifd(0x8769)[33434] == 0.01
+        im = Image.open("/tmp/pyuscope/out/c001_r000.jpg")
+        assert 33434 not in im.getexif().get_ifd(0x8769)
+
+        image = EtherealImageR(spool=(fn, "c000_r000"))
+        assert image.to_im().info["exif"] == exif.tobytes()
+        im = Image.open(image.get_filename())
+        assert im.getexif().get_ifd(0x8769)[33434] == 0.01
+
+
+class ResultCacheTestCase(TestCommon):
+    class Plugin:
+        version = 1
+
+    def setUp(self):
+        super().setUp()
+        self.cache = ResultCache("/tmp/pyuscope/cache", 1000)
+        self.fn_in = "/tmp/pyuscope/in.jpg"
+        self.fn_out = "/tmp/pyuscope/out.jpg"
+        with open(self.fn_in, "wb") as f:
+            f.write(b"in")
+
+    def key(self, options={}, deps={}, data_in=None):
+        if data_in is None:
+            data_in = {"image": EtherealImageR(fn=self.fn_in)}
+        return self.cache.task_key(
+            self.Plugin,
+            "test",
+            data_in=data_in,
+            data_out={"image": EtherealImageW(want_fn=self.fn_out)},
+            options=options,
+            deps=deps)
+
+    def test_key(self):
+        key = self.key()
+        assert key.endswith(".jpg")
+        assert key == self.key()
+        assert key != self.key(options={"x": 1})
+        assert key != self.key(deps={"config": {"x": 1}})
+        self.Plugin.version = 2
+        try:
+            assert key != self.key()
+        finally:
+            self.Plugin.version = 1
+        time.sleep(0.01)
+        with open(self.fn_in, "wb") as f:
+            f.write(b"in2")
+        assert key != self.key()
+        # In memory images aren't cached
+        assert self.key(data_in={"image": EtherealImageR(im=object())}) is None
+        assert self.cache.stats()["uncacheable"] == 1
+
+    def test_fetch_store(self):
+        key = self.key()
+        assert not self.cache.fetch(key, self.fn_out)
+        with open(self.fn_out, "wb") as f:
+            f.write(b"out")
+        self.cache.store(key, self.fn_out)
+        os.unlink(self.fn_out)
+        assert self.cache.fetch(key, self.fn_out)
+        with open(self.fn_out, "rb") as f:
+            assert f.read() == b"out"
+        stats = self.cache.stats()
+        assert stats["hits"] == 1 and stats["misses"] == 1
+        # Picked up by a new instance
+        assert ResultCache("/tmp/pyuscope/cache", 1000).fetch(key, self.fn_out)
+
+    def test_lazy_load(self):
+        with open(self.fn_out, "wb") as f:
+            f.write(b"out")
+        key = self.key()
+        self.cache.store(key, self.fn_out)
+        cache = ResultCache("/tmp/pyuscope/cache", 1000)
+        # Directory isn't scanned until the cache is used
+        assert not cache.loaded and not cache.entries
+        assert cache.stats()["entries"] == 1
+        assert cache.loaded
+        cache = ResultCache("/tmp/pyuscope/cache", 1000)
+        cache.store(key, self.fn_out)
+        assert cache.stats()["bytes"] == 3
+
+    def test_evict(self):
+        keys = []
+        for i in range(4):
+            with open(self.fn_out, "wb") as f:
+                f.write(b"x" * 300)
+            keys.append(self.key(options={"i": i}))
+            self.cache.store(keys[-1], self.fn_out)
+            if i == 2:
+                # Most recently used survives
+                assert self.cache.fetch(keys[0], self.fn_out)
+        assert self.cache.stats()["bytes"] <= 1000
+        assert self.cache.fetch(keys[0], self.fn_out)
+        assert not self.cache.fetch(keys[1], self.fn_out)
+        assert self.cache.fetch(keys[3], self.fn_out)
+        assert self.cache.stats()["evictions"] == 1
+
+
+class FlatFieldTestCase(TestCommon):
+    def setUp(self):
+        super().setUp()
+        rs = np.random.RandomState(0)
+        # No dead (0) pixels: the float path divides by the calibration
+        self.ff_np = rs.randint(40, 256, size=(48, 64, 3), dtype=np.uint8)
+        self.ff_fn = "/tmp/pyuscope/ff.png"
+        Image.fromarray(self.ff_np).save(self.ff_fn)
+        self.im_np = rs.randint(0, 256, size=(48, 64, 3), dtype=np.uint8)
+
+    def correct_float(self, engine, im_np):
+        """
+        Original per band float path
+        """
+        ret = np.empty_like(im_np)
+        for bandi in range(3):
+            scalar = engine.ff_maxs[bandi] / self.ff_np[:, :, bandi]
+            band = np.round(np.multiply(im_np[:, :, bandi], scalar))
+            ret[:, :, bandi] = np.minimum(band, 255).astype(np.uint8)
+        return ret
+
+    def test_lut_matches_float(self):
+        engine = FlatFieldEngine(self.ff_fn)
+        expect = self.correct_float(engine, self.im_np)
+        assert (engine.correct(self.im_np) == expect).all()
+        # In place
+        im_np = self.im_np.copy()
+        engine.correct(im_np, out=im_np)
+        assert (im_np == expect).all()
+        im = engine.correct_im(Image.fromarray(self.im_np))
+        assert (np.asarray(im) == expect).all()
+
+    def test_size_mismatch(self):
+        engine = FlatFieldEngine(self.ff_fn)
+        with self.assertRaises(ValueError):
+            engine.correct(self.im_np[0:32])
+
+
+class SharedMemoryImageTestCase(TestCommon):
+    """
+    In memory images passed to the process backend
+    """
+    def round_trip(self, im):
+        shm, desc = im_to_shm(im)
+        try:
+            ret = im_from_shm(desc)
+        finally:
+            shm.close()
+            shm.unlink()
+        assert ret.mode == im.mode and ret.size == im.size
+        assert ret.tobytes() == im.tobytes()
+        return ret
+
+    def test_modes(self):
+        rs = np.random.RandomState(0)
+        # Odd width: mode "1" rows are padded to a byte
+        bits = rs.randint(0, 2, size=(7, 13)).astype(bool)
+        ret = self.round_trip(Image.fromarray(bits))
+        assert (np.asarray(ret) == bits).all()
+        gray = rs.randint(0, 256, size=(7, 13), dtype=np.uint8)
+        assert (np.asarray(self.round_trip(
+            Image.fromarray(gray))) == gray).all()
+        rgb = rs.randint(0, 256, size=(7, 13, 3), dtype=np.uint8)
+        assert (np.asarray(self.round_trip(Image.fromarray(rgb))) == rgb).all()
+        i16 = rs.randint(0, 65536, size=(7, 13)).astype("<u2")
+        im = Image.frombytes("I;16", (13, 7), i16.tobytes())
+        assert (np.asarray(self.round_trip(im)) == i16).all()
+
+    def test_unlink(self):
+        shm, desc = im_to_shm(Image.new("L", (4, 4), 7))
+        shm.close()
+        im = im_from_shm(desc, unlink=True)
+        assert im.getpixel((3, 3)) == 7
+        with self.assertRaises(FileNotFoundError):
+            im_from_shm(desc)
+
+
+class ImageFusionTestCase(TestCommon):
+    def setUp(self):
+        super().setUp()
+        self.texture = np.random.RandomState(0).randint(0,
+                                                        256,
+                                                        size=(96, 128, 3),
+                                                        dtype=np.uint8)
+
+    def focus_stack(self):
+        """
+        Each image is in focus on a different horizontal band
+        """
+        blurred = cv2.GaussianBlur(self.texture, (0, 0), 3)
+        ret = []
+        for bandi in range(3):
+            im = blurred.copy()
+            im[bandi * 32:(bandi + 1) * 32] = self.texture[bandi *
+                                                           32:(bandi + 1) * 32]
+            ret.append(im)
+        return ret
+
+    def assert_picks_sharp(self, fused):
+        blurred = cv2.GaussianBlur(self.texture, (0, 0), 3)
+        for bandi in range(3):
+            # Stay clear of the focus transitions
+            rows = slice(bandi * 32 + 6, (bandi + 1) * 32 - 6)
+
+            def error(im):
+                return np.abs(im[rows].astype(float) -
+                              self.texture[rows]).mean()
+
+            assert error(fused) < 0.25 * error(blurred), (bandi, error(fused),
+                                                          error(blurred))
+
+    def test_focus_stack_fuser(self):
+        fuser = FocusStackFuser()
+        for im in self.focus_stack():
+            fuser.add(im)
+        fused = fuser.result()
+        assert fused.shape == self.texture.shape and fused.dtype == np.uint8
+        self.assert_picks_sharp(fused)
+
+    def test_stack_native(self):
+        images = []
+        for imi, im in enumerate(self.focus_stack()):
+            fn = "/tmp/pyuscope/stack_%u.png" % imi
+            Image.fromarray(im).save(fn)
+            images.append(EtherealImageR(fn=fn))
+        fn_out = "/tmp/pyuscope/stack_out.png"
+        microscope = get_virtual_microscope(mconfig={"name": "mock"})
+        plugin = StackNativePlugin(log=lambda *args, **kwargs: None,
+                                   microscope=microscope)
+        plugin.run({"images": images},
+                   {"image": EtherealImageW(want_fn=fn_out)})
+        self.assert_picks_sharp(np.array(Image.open(fn_out)))
+
+    def bracket(self):
+        """
+        Left half dark, right half bright scene at 3 exposures
+        """
+        scene = np.zeros((96, 128, 3), dtype=np.float32)
+        scene[:, :64] = 20
+        scene[:, 64:] = 200
+        scene *= 0.75 + 0.5 * self.texture / 255
+        return [
+            np.clip(scene * gain, 0, 255).astype(np.uint8)
+            for gain in (0.5, 1.0, 4.0)
+        ]
+
+    def assert_fused_bracket(self, fused, bracket):
+        under, _normal, over = bracket
+        assert fused.shape == under.shape and fused.dtype == np.uint8
+        # Bright side: takes detail from the short exposure, not the clipped one
+        assert (over[:, 64:] == 255).mean() > 0.9
+        assert fused[:, 72:].std() > 5 * over[:, 72:].std()
+        assert fused[:, 72:].max() < 255
+        # Dark side: brighter than the short exposure
+        assert fused[:, :56].mean() > 2 * under[:, :56].mean()
+
+    def test_exposure_fuser(self):
+        fuser = ExposureFuser()
+        bracket = self.bracket()
+        self.assert_fused_bracket(fuser.fuse(bracket), bracket)
+        # Same exposure in: same image out
+        same = fuser.fuse([self.texture] * 3)
+        assert np.abs(same.astype(int) - self.texture).max() <= 1
+        with self.assertRaises(ValueError):
+            fuser.fuse([self.texture, self.texture[0:64]])
+
+    def test_hdr_mertens(self):
+        bracket = self.bracket()
+        images = []
+        for imi, im in enumerate(bracket):
+            fn = "/tmp/pyuscope/hdr_%u.png" % imi
+            Image.fromarray(im).save(fn)
+            images.append(EtherealImageR(fn=fn))
+        fn_out = "/tmp/pyuscope/hdr_out.png"
+        microscope = get_virtual_microscope(mconfig={"name": "mock"})
+        plugin = HDRMertensPlugin(log=lambda *args, **kwargs: None,
+                                  microscope=microscope)
+        plugin.run({"images": images},
+                   {"image": EtherealImageW(want_fn=fn_out)})
+        self.assert_fused_bracket(np.array(Image.open(fn_out)), bracket)
+
+
+class TiledTestCase(TestCommon):
+    def setUp(self):
+        super().setUp()
+        self.im = np.random.RandomState(0).randint(0,
+                                                   256,
+                                                   size=(300, 600, 3),
+                                                   dtype=np.uint8)
+
+    def write_rows(self, writer):
+        # Odd sized bands to exercise the row carry between levels
+        for y in range(0, 300, 37):
+            writer.write_rows(self.im[y:y + 37])
+
+    def test_deepzoom(self):
+        fn = "/tmp/pyuscope/deepzoom.dzi"
+        writer = DeepZoomWriter(fn,
+                                600,
+                                300,
+                                tile=254,
+                                overlap=1,
+                                format="png")
+        self.write_rows(writer)
+        writer.close()
+        assert 'Width="600" Height="300"' in open(fn).read()
+        tiles_dir = "/tmp/pyuscope/deepzoom_files"
+        # 600 => 1 halves 10 times
+        assert writer.max_level == 10
+        assert sorted(int(d) for d in os.listdir(tiles_dir)) == list(range(11))
+
+        def tile(level, col, row):
+            return np.array(
+                Image.open(
+                    os.path.join(tiles_dir, str(level),
+                                 "%u_%u.png" % (col, row))))
+
+        full = os.listdir(os.path.join(tiles_dir, "10"))
+        assert len(full) == 3 * 2, full
+        # Overlap on inner edges only
+        assert tile(10, 0, 0).shape == (255, 255, 3)
+        assert tile(10, 1, 0).shape == (255, 256, 3)
+        assert tile(10, 2, 1).shape == (47, 93, 3)
+        assert (tile(10, 1, 1) == self.im[253:300, 253:509]).all()
+        half = downsample2(self.im)
+        assert (tile(9, 0, 0) == half[:, 0:255]).all()
+        # 150 x 75 fits in one tile
+        assert (tile(8, 0, 0) == downsample2(half)).all()
+        assert tile(0, 0, 0).shape == (1, 1, 3)
+
+    def test_pyramid_tiff(self):
+        fn = "/tmp/pyuscope/pyramid.tif"
+        writer = PyramidTiffWriter(fn,
+                                   600,
+                                   300,
+                                   tile=128,
+                                   compression="deflate")
+        self.write_rows(writer)
+        writer.close()
+        with open(fn, "rb") as f:
+            # BigTIFF
+            assert f.read(4) == b"II+\0"
+        im = Image.open(fn)
+        levels = []
+        for i in range(im.n_frames):
+            im.seek(i)
+            levels.append(np.array(im.convert("RGB")))
+        # Halved until it fits in a tile
+        assert [level.shape[:2] for level in levels] == [(300, 600),
+                                                         (150, 300), (75, 150),
+                                                         (38, 75)]
+        assert (levels[0] == self.im).all()
+        assert (levels[1] == downsample2(self.im)).all()
+        assert (levels[2] == downsample2(downsample2(self.im))).all()
+
+
 if __name__ == "__main__":
     unittest.main()
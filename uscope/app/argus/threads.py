@@ -230,11 +230,12 @@ class QPlannerThread(PlannerThreadBase, ArgusThread):
     plannerDone = pyqtSignal(dict)
     log_msg = pyqtSignal(str)
 
-    def __init__(self, planner_args, progress_cb, parent=None):
+    def __init__(self, planner_args, progress_cb, csip=None, parent=None):
         ArgusThread.__init__(self, parent)
         PlannerThreadBase.__init__(self,
                                    planner_args=planner_args,
-                                   progress_cb=progress_cb)
+                                   progress_cb=progress_cb,
+                                   csip=csip)
 
     def log(self, msg=""):
         self.log_msg.emit(msg)
@@ -249,6 +250,7 @@ class QPlannerThread(PlannerThreadBase, ArgusThread):
 
             self.planner = get_planner(log=self.log, **self.planner_args)
             self.planner.register_progress_callback(self.progress_cb)
+            self.stream_start()
             self.log('Running planner')
             b = Benchmark()
             self.log()
@@ -270,6 +272,8 @@ class QPlannerThread(PlannerThreadBase, ArgusThread):
             ret["exception"] = e
             #raise
         finally:
+            # Post scan processing expects streamed images to be done
+            self.stream_finish()
             self.plannerDone.emit(ret)
 
 
@@ -267,6 +267,29 @@ class USCImager:
         """
         return self.j.get("save_quality", 95)
 
+    def save_threads(self):
+        """
+        Planner image encode + save threads
+        0: save on the planner thread before moving on (default)
+        N: save in the background while the stage moves to the next position
+        """
+        return int(self.j.get("save_threads", 0))
+
+    def save_queue_depth(self):
+        """
+        Max images waiting on save_threads before the planner blocks
+        Bounds memory use if saving can't keep up
+        """
+        return int(self.j.get("save_queue_depth", 4))
+
+    def save_spool(self):
+        """
+        Append raw frames to a single memory mapped spool file (frames.spool)
+        instead of encoding one file per image
+        Image processing reads the spool and writes the classic image files
+        """
+        return bool(self.j.get("save_spool", False))
+
     def ff_cal_fn(self):
         return os.path.join(self.microscope.usc.get_microscope_data_dir(),
                             "imager_calibration_ff.tif")
@@ -593,6 +616,19 @@ class USCMotion:
             assert 0 < ret <= 1.0
         return ret
 
+    def grbl_status_hz(self):
+        """
+        GRBL status report polling rate from a dedicated reader thread
+        Ex: 20 to 50
+        0 => query status on demand
+        None => default (GRBL_STATUS_HZ or 0)
+        """
+        ret = self.j.get("grbl_status_hz", None)
+        if ret is not None:
+            ret = float(ret)
+            assert ret >= 0
+        return ret
+
 
 class USCPlanner:
     def __init__(self, j={}, microscope=None):
@@ -677,6 +713,47 @@ class USCKinematics:
         # Recommended for real imagers
         return bool(self.j.get("frame_sync", True))
 
+    def settle_mode(self):
+        """
+        fixed: always wait the full tsettle_* time
+        adaptive: compare live frames and stop once they are still
+            tsettle_* becomes the upper bound
+        """
+        ret = self.j.get("settle_mode", "fixed")
+        if ret not in ("fixed", "adaptive"):
+            raise ValueError("Bad settle_mode %s" % (ret, ))
+        return ret
+
+    def settle_width(self):
+        """
+        Live frames are downscaled to this width before comparing
+        """
+        return int(self.j.get("settle_width", 256))
+
+    def settle_shift_pix(self):
+        """
+        Adaptive settle: frames are still once they move less than this
+        In settle_width scaled pixels
+        """
+        return float(self.j.get("settle_shift_pix", 0.25))
+
+    def settle_still_frames(self):
+        """
+        Adaptive settle: consecutive still frame pairs required
+        More than one guards against vibration aliasing with the frame rate
+        """
+        ret = int(self.j.get("settle_still_frames", 2))
+        if ret < 1:
+            raise ValueError("settle_still_frames must be >= 1")
+        return ret
+
+    def settle_exposure_tolerance(self):
+        """
+        Adaptive HDR settle: exposure is stable once mean brightness
+        changes less than this fraction between frames
+        """
+        return float(self.j.get("settle_exposure_tolerance", 0.02))
+
 
 class USCOptics:
     def __init__(self, j=None, microscope=None):
@@ -719,6 +796,52 @@ class USCOptics:
         return self.j.get("optics", None)
 
 
+class USCAutofocus:
+    def __init__(self, j={}, microscope=None):
+        """
+        j: usj["autofocus"]
+        """
+        self.j = j
+        self.microscope = microscope
+
+    def scoring_threads(self):
+        """
+        Worker threads scoring frames while the stage moves to the next position
+        """
+        return int(self.j.get("scoring_threads", 2))
+
+    def downsample(self):
+        """
+        Score on a center ROI shrunk by this factor
+        1 => full resolution
+        """
+        ret = int(self.j.get("downsample", 2))
+        if ret < 1:
+            raise ValueError("Invalid autofocus downsample: %s" % (ret, ))
+        return ret
+
+    def metric(self):
+        """
+        Default focus metric, see uscope.imager.autofocus.FOCUS_METRICS
+        Objectives can override with "autofocus_metric"
+        """
+        return self.j.get("metric", "laplacian")
+
+    def search(self):
+        """
+        Default autofocus search, see uscope.imager.autofocus.AUTOFOCUS_SEARCHES
+        Objectives can override with "autofocus_search"
+        """
+        return self.j.get("search", "sweep")
+
+    def early_stop(self):
+        """
+        Stop a sweep once the score has clearly passed its peak
+        Off by default: can settle on a secondary peak (ex: multi-layer die)
+        """
+        return bool(self.j.get("early_stop", False))
+
+
 class USCImageProcessingPipeline:
     def __init__(self, j={}, microscope=None):
         self.j = j
@@ -737,10 +860,71 @@ class USCImageProcessingPipeline:
         """
         return self.j.get("snapshot_correction", [])
 
+    def backend(self):
+        """
+        How CSImageProcessor runs plugins
+        thread: worker threads in this process
+        process: worker processes, images passed through shared memory
+            Avoids GIL contention in NumPy heavy plugins
+        """
+        ret = self.j.get("backend", "thread")
+        if ret not in ("thread", "process"):
+            raise ValueError("Invalid ipp backend: %s" % (ret, ))
+        return ret
+
+    def stream(self):
+        """
+        Process HDR / stack / FF buckets while the planner is still scanning
+        instead of waiting for the scan to complete
+        """
+        return bool(self.j.get("stream", False))
+
+    def hdr_plugin(self):
+        """
+        Which plugin to HDR merge with
+        hdr-luminance: luminance-hdr-cli (external tool)
+        hdr-enfuse: enfuse (external tool)
+        hdr-mertens: in process OpenCV, also works on in memory snapshots
+        """
+        return self.j.get("hdr_plugin", "hdr-luminance")
+
+    def stack_plugin(self):
+        """
+        Which plugin to focus stack with
+        stack-enfuse: enfuse + align_image_stack (external tools)
+        stack-native: in process OpenCV
+        """
+        return self.j.get("stack_plugin", "stack-enfuse")
+
     # plugin specific options
     def get_plugin(self, name):
         return self.j.get("plugins", {}).get(name, {})
 
+    def result_cache(self):
+        """
+        Reuse plugin results when the input images, options, plugin config
+        and plugin version are unchanged
+        Lazy processing still skips outputs that already exist
+        Ex: a non-lazy re-run after changing a late stage only
+        recomputes that stage
+        """
+        return bool(self.j.get("result_cache", False))
+
+    def result_cache_dir(self):
+        ret = self.j.get("result_cache_dir")
+        if ret is None:
+            ret = os.path.join(get_bc().get_data_dir(), "ipp_cache")
+        return ret
+
+    def result_cache_max_bytes(self):
+        """
+        Least recently used results are evicted beyond this
+        """
+        ret = float(self.j.get("result_cache_max_gb", 20.0))
+        if ret <= 0:
+            raise ValueError("result_cache_max_gb must be positive")
+        return int(ret * 1e9)
+
 
 class ObjectiveDB:
     def __init__(self, fn=None, strict=None):
@@ -855,6 +1039,8 @@ class USC:
                                 microscope=self.microscope)
         self.ipp = USCImageProcessingPipeline(self.usj.get("ipp", {}),
                                               microscope=self.microscope)
+        self.autofocus = USCAutofocus(self.usj.get("autofocus", {}),
+                                      microscope=self.microscope)
         self.apps = {}
 
     def get_usj(self, config_dir=None):
@@ -1083,6 +1269,15 @@ class PCImager:
     def save_quality(self, *args, **kwargs):
         return USCImager.save_quality(self, *args, **kwargs)
 
+    def save_threads(self, *args, **kwargs):
+        return USCImager.save_threads(self, *args, **kwargs)
+
+    def save_queue_depth(self, *args, **kwargs):
+        return USCImager.save_queue_depth(self, *args, **kwargs)
+
+    def save_spool(self, *args, **kwargs):
+        return USCImager.save_spool(self, *args, **kwargs)
+
 
 class PCMotion:
     def __init__(self, j=None):
@@ -1117,6 +1312,53 @@ class PCKinematics:
         return self.j.get("tsettle_hdr", 0.0)
 
 
+class PCFocusMap:
+    """
+    pconfig["points-xy3p"]["focus-map"]
+    """
+    def __init__(self, j=None):
+        self.j = j
+
+    def method(self):
+        """
+        Surface fit: plane, bilinear, tps (thin plate spline)
+        """
+        return self.j.get("method", "tps")
+
+    def smoothing(self):
+        """
+        tps only: 0 => pass exactly through points
+        Increase if autofocus results are noisy
+        """
+        return float(self.j.get("smoothing", 0.0))
+
+    def spacing(self):
+        """
+        Autofocus every N tiles in each direction (plus the last row / column)
+        """
+        ret = int(self.j.get("spacing", 4))
+        if ret < 1:
+            raise ValueError("focus map spacing must be >= 1")
+        return ret
+
+    def mode(self):
+        """
+        prescan: autofocus all sample tiles before imaging (best predictions)
+        inline: autofocus sample tiles as the scan reaches them, refitting as it goes
+        none: only use corners / loaded points
+        """
+        ret = self.j.get("mode", "prescan")
+        if ret not in ("prescan", "inline", "none"):
+            raise ValueError("Invalid focus map mode: %s" % (ret, ))
+        return ret
+
+    def load(self):
+        """
+        Seed from a previous scan: uscan.json or scan directory
+        """
+        return self.j.get("load")
+
+
 """
 Planner configuration
 """
@@ -1133,6 +1375,21 @@ class PC:
     def exclude(self):
         return self.j.get('exclude', [])
 
+    def objective(self):
+        """
+        Objective config the scan was planned for, if known
+        """
+        return self.j.get("objective")
+
+    def focus_map(self):
+        """
+        Return PCFocusMap if XY3P focus mapping is enabled, otherwise None
+        """
+        j = self.j.get("points-xy3p", {}).get("focus-map")
+        if j is None:
+            return None
+        return PCFocusMap(j)
+
     def end_at(self):
         return self.j.get("end_at", "start")
 
@@ -1175,6 +1432,10 @@ class PC:
         return ret
 
     def xy_pattern(self):
+        """
+        Tile order, see XYPattern
+        ex: "x-:x+" (default), "y-:y+", "auto" (least estimated travel time)
+        """
         return self.j.get("xy-pattern", None)
 
     def xy_serpentine(self):
@@ -1,6 +1,7 @@
 import os
 import threading
 import traceback
+import numpy as np
 from uscope.imager.image_sequence import CapturedImage
 
 import gi
@@ -57,7 +58,8 @@ class CbSink(GstBase.BaseSink):
         assert result
 
         try:
-            # type: bytes
+            # type: bytes or memoryview depending on PyGObject version
+            # Only valid until unmap
             if self.cb:
                 self.cb(mapinfo.data)
         finally:
@@ -116,7 +118,7 @@ class CaptureSink(CbSink):
         del self.images_actual[image_id]
         #self.verbose and print("bytes", len(buf), 'w', width, 'h', height)
         return CapturedImage(
-            image=self.ac.vidpip.imager_aplugin.gst_decode_image(image_dict),
+            array=self.ac.vidpip.imager_aplugin.gst_decode_array(image_dict),
             meta=image_dict["meta"],
             microscope=self.ac.microscope)
 
@@ -151,8 +153,13 @@ class CaptureSink(CbSink):
                     assert 0, "FIXME"
                 """
 
+                # Copy exactly once out of the mapped buffer
+                # Frames outlive the sink (planner, processing queues)
+                # so there is no safe point to recycle them into a pool
+                array = np.empty(len(buffer), dtype=np.uint8)
+                array[:] = np.frombuffer(buffer, dtype=np.uint8)
                 self.images_actual[self.next_image_id] = {
-                    "bytes": bytearray(buffer),
+                    "array": array,
                     "width": self.width,
                     "height": self.height,
                     "meta": self.meta
@@ -465,6 +465,7 @@ class CompositeImageGrabber:
                 "cloud_stitch": False,
                 "write_html_viewer": False,
                 "write_quick_pano": False,
+                "write_deepzoom": False,
                 "write_snapshot_grid": False,
                 "keep_intermediates": False,
                 "snapshot": True,
@@ -1530,7 +1530,10 @@ class ImagingTaskWidget(AWidget):
             }
 
             self.ac.planner_thread = QPlannerThread(
-                planner_args, progress_cb=emitCncProgress, parent=self)
+                planner_args,
+                progress_cb=emitCncProgress,
+                csip=self.ac.image_processing_thread.ip,
+                parent=self)
             self.ac.planner_thread.log_msg.connect(self.ac.log)
             self.ac.planner_thread.plannerDone.connect(self.plannerDone)
             self.setControlsEnabled(False)
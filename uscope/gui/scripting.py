@@ -300,14 +300,18 @@ class ArgusScriptingPlugin(QThread):
         """
         return self._ac.microscope.image_save_extension()
 
-    def autofocus(self, block=True):
+    def autofocus(self, block=True, search=None):
         """
         Autofocus at the current location
         Suggest to call is_idle() if you aren't sure a previous operation is done
+        search: "sweep", "coarse-fine", "golden", or "parabolic"
+            None => microscope / objective default
         """
         self.check_running()
         self._ac.image_processing_thread.auto_focus(
-            objective_config=self._ac.objective_config(), block=block)
+            objective_config=self._ac.objective_config(),
+            search=search,
+            block=block)
 
     def message_box_yes_cancel(self, title, message):
         # quick hack: run as subprocess?
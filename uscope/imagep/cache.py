@@ -0,0 +1,256 @@
+"""
+Content addressed cache of image processing plugin results
+
+A plugin call is keyed on the contents of its input files, the plugin name
+and version, its configuration, the options it was called with and
+any other files it depends on (ex: flat field calibration)
+Re-running a pipeline after changing one stage then only recomputes that
+stage and whatever is downstream of it
+
+Entries are plain files named by key
+Least recently used entries are evicted to stay within a disk budget
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+DIGEST_CHUNK = 1 << 20
+
+# key: realpath, value: ((size, mtime_ns), digest)
+_file_digests = {}
+_file_digests_lock = threading.Lock()
+
+
+def file_digest(fn):
+    """
+    sha256 of the file contents
+    Remembered until the file size or mtime changes so each file is
+    normally only read once (ex: as one stage's output, then the next
+    stage's input)
+    """
+    fn = os.path.realpath(fn)
+    st = os.stat(fn)
+    key = (st.st_size, st.st_mtime_ns)
+    with _file_digests_lock:
+        cached = _file_digests.get(fn)
+        if cached and cached[0] == key:
+            return cached[1]
+    h = hashlib.sha256()
+    with open(fn, "rb") as f:
+        while True:
+            chunk = f.read(DIGEST_CHUNK)
+            if not chunk:
+                break
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _file_digests_lock:
+        _file_digests[fn] = (key, digest)
+    return digest
+
+
+class ResultCache:
+    """
+    Thread safe: yes
+    Several processes can share a directory, but each only accounts for
+    the entries it has seen when enforcing max_bytes
+    The directory is only scanned on first use so constructing one is cheap
+    """
+    def __init__(self, directory, max_bytes, log=None):
+        if not log:
+
+            def log(s):
+                print(s)
+
+        self.log = log
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # entry name => size, least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+        self.stores = 0
+        self.evictions = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def load(self):
+        """
+        Pick up entries from earlier runs, oldest use first
+        Lock held
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+        found = []
+        for root, _dirs, files in os.walk(self.directory):
+            for name in files:
+                # Partial copy from an aborted run
+                if ".tmp" in name:
+                    continue
+                st = os.stat(os.path.join(root, name))
+                found.append((st.st_mtime_ns, name, st.st_size))
+        for _mtime, name, size in sorted(found):
+            self.entries[name] = size
+            self.bytes += size
+        self.evict()
+
+    def entry_fn(self, name):
+        return os.path.join(self.directory, name[0:2], name)
+
+    def task_key(self, plugin_ctor, task_name, data_in, data_out, options,
+                 deps):
+        """
+        Return the entry name for a plugin call or None if it can't be cached
+        Only file in, file out calls are cached
+        deps: plugin_ctor.cache_deps() result
+        """
+        try:
+            ret = self._task_key(plugin_ctor, task_name, data_in, data_out,
+                                 options, deps)
+        except OSError:
+            # ex: missing input. Let the plugin report it
+            ret = None
+        if ret is None:
+            with self.lock:
+                self.uncacheable += 1
+        return ret
+
+    def _task_key(self, plugin_ctor, task_name, data_in, data_out, options,
+                  deps):
+        image_out = data_out.get("image")
+        if image_out is None or image_out.want_im or not image_out.want_fn:
+            return None
+        j = {
+            "plugin": task_name,
+            "version": plugin_ctor.version,
+            "options": options,
+            "deps": dict(deps),
+            "inputs": {},
+        }
+        j["deps"]["files"] = [file_digest(fn) for fn in deps.get("files", [])]
+        for k, v in data_in.items():
+            if k == "image":
+                v = [v]
+            elif k != "images":
+                j["inputs"][k] = v
+                continue
+            digests = []
+            for image_in in v:
+                # In memory / spooled images aren't content addressed yet
+                if image_in.im is not None or image_in.spool or not image_in.fn:
+                    return None
+                digests.append(file_digest(image_in.fn))
+            j["inputs"][k] = digests
+        try:
+            s = json.dumps(j, sort_keys=True)
+        except TypeError:
+            # Live objects in options etc
+            return None
+        # Output format follows the extension
+        extension = os.path.splitext(image_out.want_fn)[1]
+        return hashlib.sha256(s.encode("utf-8")).hexdigest() + extension
+
+    def fetch(self, name, fn_out):
+        """
+        Write cached entry name to fn_out
+        Return True on hit
+        """
+        with self.lock:
+            self.load()
+            size = self.entries.get(name)
+            if size is None:
+                self.misses += 1
+                return False
+            self.entries.move_to_end(name)
+        entry_fn = self.entry_fn(name)
+        try:
+            # Already in place (ex: lazy re-run) => leave it alone
+            if not (os.path.exists(fn_out) and os.path.getsize(fn_out) == size
+                    and file_digest(fn_out) == file_digest(entry_fn)):
+                # Copy, not link: plugins overwrite outputs in place
+                tmp_fn = fn_out + ".tmp%u" % threading.get_ident()
+                shutil.copyfile(entry_fn, tmp_fn)
+                os.replace(tmp_fn, fn_out)
+            # Persist LRU order across runs
+            os.utime(entry_fn)
+        except OSError as e:
+            self.log(f"WARNING: result cache: failed to fetch {name}: {e}")
+            with self.lock:
+                self.remove(name)
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def store(self, name, fn_out):
+        """
+        Add a freshly generated fn_out as entry name
+        """
+        try:
+            size = os.path.getsize(fn_out)
+            if size > self.max_bytes:
+                return
+            entry_fn = self.entry_fn(name)
+            os.makedirs(os.path.dirname(entry_fn), exist_ok=True)
+            tmp_fn = entry_fn + ".tmp%u" % threading.get_ident()
+            shutil.copyfile(fn_out, tmp_fn)
+            os.replace(tmp_fn, entry_fn)
+        except OSError as e:
+            self.log(f"WARNING: result cache: failed to store {name}: {e}")
+            return
+        with self.lock:
+            self.load()
+            self.remove(name)
+            self.entries[name] = size
+            self.bytes += size
+            self.stores += 1
+            self.evict()
+
+    def remove(self, name):
+        # Lock held
+        size = self.entries.pop(name, None)
+        if size is not None:
+            self.bytes -= size
+
+    def evict(self):
+        # Lock held
+        while self.bytes > self.max_bytes and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+            try:
+                os.unlink(self.entry_fn(name))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            self.load()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "uncacheable": self.uncacheable,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def stats_str(self):
+        stats = self.stats()
+        return "%u hits, %u misses (%0.1f%% hit rate), %u uncacheable, %u evictions, %0.1f / %0.1f GB" % (
+            stats["hits"], stats["misses"], 100.0 * stats["hit_rate"],
+            stats["uncacheable"], stats["evictions"], stats["bytes"] / 1e9,
+            stats["max_bytes"] / 1e9)
@@ -14,9 +14,10 @@ They generally take one or more images in and produce a single image out
 """
 
 from uscope.scan_util import index_scan_images
-from uscope.imagep.util import EtherealImageR, EtherealImageW
-from uscope.imagep.streams import DirCSIP, SnapshotCSIP
+from uscope.imagep.util import EtherealImageR, EtherealImageW, im_to_shm, im_from_shm
+from uscope.imagep.streams import DirCSIP, SnapshotCSIP, StreamCSIP
 from uscope.imagep.plugins import get_plugins, get_plugin_ctors
+from uscope.imagep.cache import ResultCache
 from uscope import config
 from uscope.microscope import get_virtual_microscope, get_mconfig
 from uscope.threads import ShutdownPhase
@@ -34,14 +35,18 @@ import tempfile
 import json
 
 
-def get_open_set(working_iindex):
+def get_open_set(working_iindex, excluded=()):
+    """
+    Return set of (col, row) tiles missing from the grid
+    excluded: tiles that were never meant to be imaged (see scan_excluded_tiles())
+    """
     open_set = set()
     for col in range(working_iindex["cols"]):
         for row in range(working_iindex["rows"]):
             open_set.add((col, row))
     for filev in working_iindex["images"].values():
         open_set.remove((filev["col"], filev["row"]))
-    return open_set
+    return open_set - set(excluded)
 
 
 def already_uploaded(directory):
@@ -108,15 +113,12 @@ class CSImageProcessorThread(threading.Thread):
                     ip_params.callback(*out)
                 self.simple_idle.set()
 
-            plugin = self.plugins.get(ip_params.task_name)
-            if plugin is None:
+            if not self.has_plugin(ip_params.task_name):
                 self.log(f"Invalid plugin {ip_params.task_name}")
                 finish_command("error", "invalid command")
                 continue
             try:
-                ret = plugin.run(data_in=ip_params.data_in,
-                                 data_out=ip_params.data_out,
-                                 options=ip_params.options)
+                ret = self.run_plugin_cached(ip_params)
                 # self.log("Command done")
                 finish_command("ok", ret)
             except Exception as e:
@@ -125,6 +127,200 @@ class CSImageProcessorThread(threading.Thread):
                 self.log(traceback.format_exc())
                 finish_command("exception", e)
                 continue
+        self.cleanup()
+
+    def has_plugin(self, task_name):
+        return task_name in self.plugins
+
+    def run_plugin_cached(self, ip_params):
+        """
+        Restore the output from the result cache if possible
+        Otherwise run the plugin and add its output to the cache
+        """
+        cache = self.csip.result_cache
+        if not cache:
+            return self.run_plugin(ip_params)
+        plugin_ctor = get_plugin_ctors()[ip_params.task_name]
+        name = cache.task_key(plugin_ctor,
+                              ip_params.task_name,
+                              data_in=ip_params.data_in,
+                              data_out=ip_params.data_out,
+                              options=ip_params.options,
+                              deps=plugin_ctor.cache_deps(
+                                  config.get_usc(), ip_params.task_name))
+        if name is None:
+            return self.run_plugin(ip_params)
+        fn_out = ip_params.data_out["image"].get_filename()
+        if cache.fetch(name, fn_out):
+            return None
+        ret = self.run_plugin(ip_params)
+        cache.store(name, fn_out)
+        return ret
+
+    def run_plugin(self, ip_params):
+        plugin = self.plugins[ip_params.task_name]
+        return plugin.run(data_in=ip_params.data_in,
+                          data_out=ip_params.data_out,
+                          options=ip_params.options)
+
+    def cleanup(self):
+        pass
+
+
+"""
+Process backend
+A thread per worker process to keep the queue / callback / TaskBarrier handling here
+while the plugin itself runs in a child process with its own GIL
+In memory images are passed through shared memory instead of being pickled
+"""
+
+# Options that reference live objects (microscope, etc) and can't cross processes
+PROCESS_OPTIONS_SKIP = ("captured_image", )
+
+
+def encode_image_r(image_r, shms):
+    # Spooled frames are reopened (memory mapped) by the worker, not copied
+    ret = {
+        "fn": image_r.fn,
+        "meta": image_r.meta,
+        "shm": None,
+        "spool": image_r.spool
+    }
+    if image_r.im is not None:
+        shm, desc = im_to_shm(image_r.im)
+        shms.append(shm)
+        ret["shm"] = desc
+    return ret
+
+
+def decode_image_r(j):
+    im = None
+    if j["shm"]:
+        im = im_from_shm(j["shm"])
+    return EtherealImageR(im=im, fn=j["fn"], meta=j["meta"], spool=j["spool"])
+
+
+def encode_data_in(data_in, shms):
+    ret = {}
+    for k, v in data_in.items():
+        if k == "image":
+            ret[k] = encode_image_r(v, shms)
+        elif k == "images":
+            ret[k] = [encode_image_r(image_r, shms) for image_r in v]
+        else:
+            ret[k] = v
+    return ret
+
+
+def decode_data_in(j):
+    ret = {}
+    for k, v in j.items():
+        if k == "image":
+            ret[k] = decode_image_r(v)
+        elif k == "images":
+            ret[k] = [decode_image_r(image_r) for image_r in v]
+        else:
+            ret[k] = v
+    return ret
+
+
+def csip_process_main(conn, mconfig):
+    """
+    Worker process entry point
+    Plugins are created once and live as long as the process
+    """
+    microscope = get_virtual_microscope(mconfig=mconfig)
+    plugins = get_plugins(log=print, microscope=microscope)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        task_name, data_in_j, data_out_j, options = msg
+        im_out = None
+        try:
+            data_in = decode_data_in(data_in_j)
+            image_w = EtherealImageW(want_fn=data_out_j["want_fn"],
+                                     meta=data_out_j["meta"])
+            image_w.want_im = data_out_j["want_im"]
+            ret = plugins[task_name].run(data_in=data_in,
+                                         data_out={"image": image_w},
+                                         options=options)
+            if image_w.im is not None:
+                shm, im_out = im_to_shm(image_w.im)
+                # Parent unlinks after copying out
+                shm.close()
+            conn.send(("ok", ret, im_out))
+        except Exception as e:
+            traceback.print_exc()
+            # Exceptions may not pickle
+            conn.send(("exception", repr(e), None))
+    conn.close()
+
+
+class CSImageProcessorProcessThread(CSImageProcessorThread):
+    def __init__(self, csip, name):
+        threading.Thread.__init__(self)
+        self.csip = csip
+        self.log = self.csip.log
+        self.name = name
+        self.running = threading.Event()
+        self.simple_idle = threading.Event()
+        self.simple_idle.set()
+        self.queue_in = queue.Queue()
+
+        microscope = self.csip.microscope
+        mconfig = {}
+        if microscope is not None:
+            mconfig = get_mconfig(name=microscope.name,
+                                  serial=microscope.serial())
+        # spawn: parent has threads (and possibly GStreamer) that don't fork well
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=csip_process_main,
+                                   args=(child_conn, mconfig),
+                                   name=f"csip-{name}",
+                                   daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.running.set()
+
+    def has_plugin(self, task_name):
+        return task_name in get_plugin_ctors()
+
+    def run_plugin(self, ip_params):
+        data_out = ip_params.data_out["image"]
+        options = dict([(k, v) for k, v in ip_params.options.items()
+                        if k not in PROCESS_OPTIONS_SKIP])
+        shms = []
+        try:
+            data_in_j = encode_data_in(ip_params.data_in, shms)
+            data_out_j = {
+                "want_fn": data_out.want_fn,
+                "want_im": data_out.want_im,
+                "meta": data_out.meta,
+            }
+            self.conn.send(
+                (ip_params.task_name, data_in_j, data_out_j, options))
+            result, info, im_out = self.conn.recv()
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+        if im_out:
+            data_out.im = im_from_shm(im_out, unlink=True)
+        if result != "ok":
+            raise Exception(f"Worker process failed: {info}")
+        return info
+
+    def cleanup(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=3.0)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
 
 
 """
@@ -175,7 +371,7 @@ Probably would need to make this a thread to handle that
 
 
 class CSImageProcessor(threading.Thread):
-    def __init__(self, nthreads=None, log=None, microscope=None):
+    def __init__(self, nthreads=None, log=None, microscope=None, backend=None):
         super().__init__()
         self.microscope = microscope
         if log is None:
@@ -194,11 +390,31 @@ class CSImageProcessor(threading.Thread):
         self.temp_dir_object = tempfile.TemporaryDirectory()
         self.temp_dir = self.temp_dir_object.name
 
+        self.result_cache = None
+        if self.microscope is not None and self.microscope.usc.ipp.result_cache(
+        ):
+            ipp = self.microscope.usc.ipp
+            self.result_cache = ResultCache(ipp.result_cache_dir(),
+                                            ipp.result_cache_max_bytes(),
+                                            log=self.log)
+
+        if backend is None:
+            backend = "thread"
+            if self.microscope is not None:
+                backend = self.microscope.usc.ipp.backend()
+        self.backend = backend
+        if backend == "thread":
+            worker_cls = CSImageProcessorThread
+        elif backend == "process":
+            worker_cls = CSImageProcessorProcessThread
+        else:
+            raise ValueError(f"Invalid backend {backend}")
+
         if not nthreads:
             nthreads = multiprocessing.cpu_count()
         for i in range(nthreads):
             name = f"w{i}"
-            self.workers[name] = CSImageProcessorThread(self, name)
+            self.workers[name] = worker_cls(self, name)
         self.running.set()
 
     def __del__(self):
@@ -273,6 +489,7 @@ class CSImageProcessor(threading.Thread):
                                callback=callback,
                                tb=tb)
         self.queue_task(ip_params=ip_params, block=block)
+        return data_out
 
     def queue_1_to_1_plugin(self,
                             plugin,
@@ -309,10 +526,12 @@ class CSImageProcessor(threading.Thread):
         return data_out
 
     def queue_hdr(self, **kwargs):
-        self.queue_n_to_1_plugin(task_name="hdr-luminance", **kwargs)
+        return self.queue_n_to_1_plugin(
+            task_name=config.get_usc().ipp.hdr_plugin(), **kwargs)
 
     def queue_stack(self, **kwargs):
-        self.queue_n_to_1_plugin(task_name="stack-enfuse", **kwargs)
+        return self.queue_n_to_1_plugin(
+            task_name=config.get_usc().ipp.stack_plugin(), **kwargs)
 
     def queue_stabilization(self, **kwargs):
         self.queue_n_to_1_plugin(task_name="stabilization", **kwargs)
@@ -323,7 +542,7 @@ class CSImageProcessor(threading.Thread):
     def queue_correct_sharp1(self, **kwargs):
         return self.queue_1_to_1_plugin(plugin="correct-sharp1", **kwargs)
 
-    def fix_dir(self, this_iindex, dir_out):
+    def fix_dir(self, this_iindex, dir_out, excluded=()):
         """
         Make a best estimate by filling in images from directory above
         For now assumes dir above is focus stack and the output dir is the final upload dir
@@ -333,7 +552,7 @@ class CSImageProcessor(threading.Thread):
         if not os.path.exists(dir_out):
             os.mkdir(dir_out)
 
-        open_set = get_open_set(this_iindex)
+        open_set = get_open_set(this_iindex, excluded)
         stack_iindex = index_scan_images(os.path.dirname(this_iindex["dir"]))
         assert stack_iindex["stacks"], "fixme assumes dir above is stack"
         stacks = stack_iindex["stacks"]
@@ -375,22 +594,29 @@ class CSImageProcessor(threading.Thread):
                 self.log(" ".join(args))
                 subprocess.check_call(args)
 
-    def inspect_final_dir(self, working_iindex):
+    def inspect_final_dir(self, working_iindex, excluded=()):
         healthy = True
-        n_healthy = working_iindex["cols"] * working_iindex["rows"]
+        # Only count exclusions inside the grid the images span
+        excluded = set([
+            (col, row) for col, row in excluded
+            if col < working_iindex["cols"] and row < working_iindex["rows"]
+        ])
+        n_healthy = working_iindex["cols"] * working_iindex["rows"] - len(
+            excluded)
         n_actual = len(working_iindex["images"])
         self.log("Have %u / %u images" % (n_actual, n_healthy))
-        open_set = get_open_set(working_iindex)
+        if excluded:
+            self.log("Excluded: %u tiles" % (len(excluded), ))
+        open_set = get_open_set(working_iindex, excluded)
         self.log("Failed to find: %u files" % (len(open_set)))
         for (col, row) in sorted(open_set):
             self.log("  c%03u_r%03u.jpg" % (col, row))
             healthy = False
         return healthy
 
-    '''
     def process_stream(self, *args, **kwargs):
-        StreamCSIP(self, *args, microscope=self.microscope, **kwargs).run()
-    '''
+        return StreamCSIP(self, *args, microscope=self.microscope,
+                          **kwargs).run()
 
     def process_snapshot(self, *args, **kwargs):
         options = kwargs.pop("options", {})
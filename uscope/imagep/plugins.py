@@ -1,4 +1,5 @@
 from uscope.imager.imager_util import format_mm_3dec
+from uscope.imagep.util import npf2im
 
 import subprocess
 import shutil
@@ -9,6 +10,7 @@ import numpy as np
 import glob
 import os
 import math
+import threading
 from uscope import config
 import cv2
 from pathlib import Path
@@ -22,6 +24,20 @@ class IPPlugin:
     Thread safe: no
     If you want to do multiple in parallel create multiple instances
     """
+
+    # Bump when output changes for the same inputs and options
+    # Invalidates results in the result cache
+    version = 1
+
+    @classmethod
+    def cache_deps(cls, usc, task_name):
+        """
+        Return JSON-able state other than inputs and options the output depends on
+        Used to key the result cache
+        "files": filenames whose contents matter (ex: calibration)
+        """
+        return {"config": usc.ipp.get_plugin(task_name)}
+
     def __init__(self,
                  log=None,
                  need_tmp_dir=False,
@@ -90,6 +106,51 @@ class IPPlugin:
         assert 0, "required"
 
 
+"""
+Image pyramid helpers shared by native fusion plugins
+"""
+
+
+def gaussian_pyramid(imf, levels):
+    pyr = [imf]
+    for _leveli in range(levels):
+        pyr.append(cv2.pyrDown(pyr[-1]))
+    return pyr
+
+
+def laplacian_pyramid(imf, levels):
+    """
+    imf: float32 HxWxC array
+    Returns levels Laplacian bands + the final Gaussian residual
+    """
+    pyr = []
+    cur = imf
+    for _leveli in range(levels):
+        down = cv2.pyrDown(cur)
+        up = cv2.pyrUp(down, dstsize=(cur.shape[1], cur.shape[0]))
+        pyr.append(cv2.subtract(cur, up))
+        cur = down
+    pyr.append(cur)
+    return pyr
+
+
+def collapse_laplacian_pyramid(pyr):
+    cur = pyr[-1]
+    for band in reversed(pyr[:-1]):
+        cur = cv2.pyrUp(cur, dstsize=(band.shape[1], band.shape[0]))
+        cur = cv2.add(cur, band)
+    return cur
+
+
+def pyramid_levels(width, height, min_size=32, max_levels=8):
+    levels = 0
+    while levels < max_levels and min(width, height) >= 2 * min_size:
+        width //= 2
+        height //= 2
+        levels += 1
+    return levels
+
+
 class HDREnfusePlugin(IPPlugin):
     def __init__(self, log, default_options={}, microscope=None):
         super().__init__(log=log,
@@ -124,6 +185,132 @@ class HDREnfusePlugin(IPPlugin):
                 traceback.print_exc()
 
 
+"""
+In process exposure fusion (Mertens et al)
+No temp files or subprocesses
+Weight maps and pyramid accumulators are kept between runs
+so a scan's worth of same sized buckets doesn't reallocate them
+"""
+
+
+class ExposureFuser:
+    """
+    Thread safe: no
+    """
+    def __init__(self,
+                 contrast_weight=1.0,
+                 saturation_weight=1.0,
+                 exposure_weight=1.0):
+        self.contrast_weight = contrast_weight
+        self.saturation_weight = saturation_weight
+        self.exposure_weight = exposure_weight
+        # Per input image HxW float32
+        self.weights = []
+        # Per pyramid level HxWx3 float32
+        self.acc = []
+
+    def get_weights(self, n, shape):
+        if self.weights and self.weights[0].shape != shape:
+            self.weights = []
+        while len(self.weights) < n:
+            self.weights.append(np.empty(shape, dtype=np.float32))
+        return self.weights[0:n]
+
+    def get_acc(self, pyr):
+        shapes = [band.shape for band in pyr]
+        if [band.shape for band in self.acc] != shapes:
+            self.acc = [np.empty(shape, dtype=np.float32) for shape in shapes]
+        for band in self.acc:
+            band.fill(0.0)
+        return self.acc
+
+    def to_float(self, im_np):
+        return np.multiply(im_np, 1.0 / 255, dtype=np.float32)
+
+    def weight(self, imf, out):
+        """
+        Contrast * saturation * well exposedness
+        """
+        gray = cv2.cvtColor(imf, cv2.COLOR_RGB2GRAY)
+        np.abs(cv2.Laplacian(gray, cv2.CV_32F), out=out)
+        if self.contrast_weight != 1.0:
+            np.power(out, self.contrast_weight, out=out)
+
+        saturation = imf.std(axis=2)
+        if self.saturation_weight != 1.0:
+            np.power(saturation, self.saturation_weight, out=saturation)
+        out *= saturation
+
+        exposedness = imf - 0.5
+        np.square(exposedness, out=exposedness)
+        exposedness *= -1.0 / (2 * 0.2**2)
+        np.exp(exposedness, out=exposedness)
+        exposedness = exposedness.prod(axis=2)
+        if self.exposure_weight != 1.0:
+            np.power(exposedness, self.exposure_weight, out=exposedness)
+        out *= exposedness
+        out += 1e-12
+
+    def fuse(self, ims_np):
+        """
+        ims_np: list of HxWx3 uint8 arrays
+        Returns HxWx3 uint8
+        """
+        height, width = ims_np[0].shape[0:2]
+        for im_np in ims_np:
+            if im_np.shape != ims_np[0].shape:
+                raise ValueError("HDR image size mismatch")
+        levels = int(math.log2(min(width, height)))
+
+        weights = self.get_weights(len(ims_np), (height, width))
+        for im_np, weight in zip(ims_np, weights):
+            self.weight(self.to_float(im_np), weight)
+        total = np.add.reduce(weights)
+        for weight in weights:
+            weight /= total
+
+        acc = None
+        for im_np, weight in zip(ims_np, weights):
+            lap = laplacian_pyramid(self.to_float(im_np), levels)
+            if acc is None:
+                acc = self.get_acc(lap)
+            gw = gaussian_pyramid(weight, levels)
+            for acc_band, lap_band, gw_band in zip(acc, lap, gw):
+                lap_band *= gw_band[:, :, None]
+                acc_band += lap_band
+
+        ret = collapse_laplacian_pyramid(acc)
+        ret *= 255
+        np.clip(ret, 0, 255, out=ret)
+        return np.rint(ret).astype(np.uint8)
+
+
+class HDRMertensPlugin(IPPlugin):
+    def __init__(self, log, default_options={}, microscope=None):
+        super().__init__(log=log,
+                         microscope=microscope,
+                         default_options=default_options,
+                         need_tmp_dir=False)
+        plugin_config = self.usc.ipp.get_plugin("hdr-mertens")
+        self.fuser = ExposureFuser(
+            contrast_weight=float(plugin_config.get("contrast_weight", 1.0)),
+            saturation_weight=float(plugin_config.get("saturation_weight",
+                                                      1.0)),
+            exposure_weight=float(plugin_config.get("exposure_weight", 1.0)))
+
+    def _run(self, data_in, data_out, options={}):
+        images_in = data_in["images"]
+        ims_np = [image_in.to_np() for image_in in images_in]
+        fused = self.fuser.fuse(ims_np)
+        kwargs = {}
+        exif = images_in[0].to_im().info.get("exif")
+        if exif:
+            kwargs["exif"] = exif
+        data_out["image"].write_im(Image.fromarray(fused),
+                                   quality=90,
+                                   **kwargs)
+
+
 """
 luminance-hdr-cli -o lum.jpg -e '-2,0,+2' c005_r006_h00.jpg c005_r006_h01.jpg c005_r006_h02.jpg
 
@@ -289,6 +476,190 @@ class StackEnfusePlugin(IPPlugin):
                 os.unlink(fn)
 
 
+"""
+In process focus stacking
+No temp files or subprocesses
+Alignment: phase correlation (xy) and/or ECC (affine, covers zoom)
+Fusion: Laplacian pyramid, keep the highest contrast coefficient at each level
+(similar to enfuse --contrast-weight=1 --hard-mask)
+"""
+
+
+class FocusStackFuser:
+    """
+    Streaming Laplacian pyramid contrast fusion
+    Images are added one at a time so memory is bounded by one pyramid
+    plus the running result regardless of stack depth
+    """
+    def __init__(self, levels=None):
+        self.levels = levels
+        self.fused = None
+        self.best = None
+        self.residual_sum = None
+        self.n = 0
+
+    def contrast(self, band):
+        """
+        Local contrast: smoothed absolute Laplacian summed across channels
+        Smoothing keeps the selection mask from speckling on noise
+        """
+        energy = np.abs(band)
+        if energy.ndim == 3:
+            energy = energy.sum(axis=2)
+        return cv2.GaussianBlur(energy, (5, 5), 0)
+
+    def add(self, im_np):
+        imf = im_np.astype(np.float32)
+        if self.levels is None:
+            self.levels = pyramid_levels(imf.shape[1], imf.shape[0])
+        pyr = laplacian_pyramid(imf, self.levels)
+        if self.fused is None:
+            self.fused = pyr[:-1]
+            self.best = [self.contrast(band) for band in self.fused]
+            self.residual_sum = pyr[-1]
+        else:
+            for leveli, band in enumerate(pyr[:-1]):
+                energy = self.contrast(band)
+                mask = energy > self.best[leveli]
+                np.copyto(self.best[leveli], energy, where=mask)
+                if band.ndim == 3:
+                    mask = mask[:, :, None]
+                np.copyto(self.fused[leveli], band, where=mask)
+            # Low frequency content is similar across the stack: average it
+            np.add(self.residual_sum, pyr[-1], out=self.residual_sum)
+        self.n += 1
+
+    def result(self):
+        assert self.n, "No images"
+        pyr = list(self.fused) + [self.residual_sum / self.n]
+        ret = collapse_laplacian_pyramid(pyr)
+        np.clip(ret, 0, 255, out=ret)
+        return np.rint(ret).astype(np.uint8)
+
+
+def focus_stack_align(ref_gray, im_gray, mode, scale=0.5):
+    """
+    Estimate a 2x3 affine warp mapping im onto ref
+    Estimated on downsampled grayscale for speed, scaled back to full resolution
+    mode:
+        phase: translation only
+        ecc: affine (translation + rotation + zoom)
+    """
+    if scale != 1.0:
+        ref_small = cv2.resize(ref_gray, (0, 0),
+                               fx=scale,
+                               fy=scale,
+                               interpolation=cv2.INTER_AREA)
+        im_small = cv2.resize(im_gray, (0, 0),
+                              fx=scale,
+                              fy=scale,
+                              interpolation=cv2.INTER_AREA)
+    else:
+        ref_small = ref_gray
+        im_small = im_gray
+
+    warp = np.eye(2, 3, dtype=np.float32)
+    if mode == "phase":
+        # Window suppresses the edge discontinuity
+        window = cv2.createHanningWindow(
+            (ref_small.shape[1], ref_small.shape[0]), cv2.CV_32F)
+        (dx, dy), _response = cv2.phaseCorrelate(ref_small, im_small, window)
+        warp[0, 2] = -dx
+        warp[1, 2] = -dy
+    elif mode == "ecc":
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 50, 1e-4)
+        _cc, warp = cv2.findTransformECC(ref_small, im_small, warp,
+                                         cv2.MOTION_AFFINE, criteria, None, 5)
+        # findTransformECC returns the ref => im mapping
+        warp = cv2.invertAffineTransform(warp)
+    else:
+        raise ValueError(f"Bad align mode {mode}")
+    warp[:, 2] /= scale
+    return warp
+
+
+class StackNativePlugin(IPPlugin):
+    @classmethod
+    def cache_deps(cls, usc, task_name):
+        ret = super().cache_deps(usc, task_name)
+        # Alignment defaults come from here
+        ret["stack-enfuse"] = usc.ipp.get_plugin("stack-enfuse")
+        return ret
+
+    def __init__(self, log, default_options={}, microscope=None):
+        super().__init__(log=log,
+                         microscope=microscope,
+                         default_options=default_options,
+                         need_tmp_dir=False)
+        # Default to the same alignment policy as enfuse
+        # Its driven by how well the hardware repeats, not the algorithm
+        enfuse_config = self.usc.ipp.get_plugin("stack-enfuse")
+        plugin_config = self.usc.ipp.get_plugin("stack-native")
+        self.align_xy = plugin_config.get("align_xy",
+                                          enfuse_config.get("align_xy", False))
+        self.align_zoom = plugin_config.get(
+            "align_zoom", enfuse_config.get("align_zoom", False))
+        self.align_scale = float(plugin_config.get("align_scale", 0.5))
+        self.levels = plugin_config.get("levels", None)
+
+    def align_mode(self):
+        if self.align_zoom:
+            return "ecc"
+        if self.align_xy:
+            return "phase"
+        return None
+
+    def _run(self, data_in, data_out, options={}):
+        best_effort = options.get("best_effort", False)
+        align_mode = self.align_mode()
+
+        # Keep given order, same as align_image_stack --use-given-order
+        images_in = sorted(data_in["images"], key=lambda x: x.basename())
+        # Align to the middle of the stack, usually the best focus
+        refi = len(images_in) // 2
+        ref_np = images_in[refi].to_np()
+        ref_gray = None
+        if align_mode:
+            ref_gray = cv2.cvtColor(ref_np,
+                                    cv2.COLOR_RGB2GRAY).astype(np.float32)
+
+        fuser = FocusStackFuser(levels=self.levels)
+        exif = images_in[0].to_im().info.get("exif")
+        for imi, image_in in enumerate(images_in):
+            if imi == refi:
+                im_np = ref_np
+            else:
+                im_np = image_in.to_np()
+                if im_np.shape != ref_np.shape:
+                    raise ValueError("Stack image size mismatch")
+                if align_mode:
+                    im_gray = cv2.cvtColor(im_np, cv2.COLOR_RGB2GRAY).astype(
+                        np.float32)
+                    try:
+                        warp = focus_stack_align(ref_gray,
+                                                 im_gray,
+                                                 align_mode,
+                                                 scale=self.align_scale)
+                        im_np = cv2.warpAffine(
+                            im_np,
+                            warp, (im_np.shape[1], im_np.shape[0]),
+                            flags=cv2.INTER_LINEAR,
+                            borderMode=cv2.BORDER_REPLICATE)
+                    except cv2.error:
+                        if not best_effort:
+                            raise
+                        self.log("WARNING: stack align failed, using as is")
+                        traceback.print_exc()
+            fuser.add(im_np)
+
+        kwargs = {}
+        if exif:
+            kwargs["exif"] = exif
+        Image.fromarray(fuser.result()).save(data_out["image"].get_filename(),
+                                             quality=90,
+                                             **kwargs)
+
+
 class StabilizationPlugin(IPPlugin):
     def __init__(self, log, default_options={}, microscope=None):
         super().__init__(log=log,
@@ -324,64 +695,64 @@ Correct uneven illumination using a flat field mask
 """
 
 
-class CorrectFF1Plugin(IPPlugin):
-    def __init__(self, log, default_options={}, microscope=None):
-        super().__init__(log=log,
-                         microscope=microscope,
-                         default_options=default_options,
-                         need_tmp_dir=True)
-        # Plugin is always registered
-        # Maybe should have a mechanism to exclude if it can't actually run?
-        self.ff_im = None
+class FlatFieldEngine:
+    """
+    Vectorized flat field correction over a whole HxWx3 image
 
-        if self.usc.imager.has_ff_cal():
-            self.ff_im = Image.open(self.usc.imager.ff_cal_fn())
-            self.ff_rband_im, self.ff_gband_im, self.ff_bband_im = self.ff_im.split(
-            )
-            self.ff_rband_np = np.array(self.ff_rband_im)
-            self.ff_gband_np = np.array(self.ff_gband_im)
-            self.ff_bband_np = np.array(self.ff_bband_im)
-            self.ff_minmax()
+    Both the input image and the calibration are 8 bit
+    So each output pixel is a function of (band, calibration value, input value)
+    Precompute that function as a 64k entry lookup table per band
+    The table is generated with the same float64 multiply / round / clamp as the original
+    per band code so output is bit identical
 
+    Thread safe: yes
+    Share one instance per calibration file, see get_ff_engine()
+    """
+    def __init__(self, fn, verbose=False):
+        self.fn = fn
+        self.verbose = verbose
+        with Image.open(fn) as ff_im:
+            if ff_im.mode != "RGB":
+                raise ValueError(
+                    f"Flat field calibration must be RGB, got {ff_im.mode}")
+            self.size = ff_im.size
+            ff_np = np.array(ff_im)
+        self.ff_minmax(ff_np)
+
+        # Scratch index buffers are per thread
+        self.local = threading.local()
+        # Per band: calibration value in the upper byte of a uint16 index
+        # Input value is OR'd into the lower byte at correction time
+        self.ff_hi = []
+        self.luts = []
+        values = np.arange(256, dtype=np.uint8)
+        for bandi, ff_max in enumerate(self.ff_maxs):
+            self.ff_hi.append(
+                np.left_shift(ff_np[:, :, bandi].astype(np.uint16), 8))
             # Boost dim values by scalars in the range 1.0 to near 0.0
             # The lower the flat field value, the more it needs to be scaled
             # Values at max flat field value stay the same
-            # Note: dead pixels always 0 not currently handled / will crash
-            self.rband_scalar = self.ff_rmax / self.ff_rband_np
-            self.gband_scalar = self.ff_gmax / self.ff_gband_np
-            self.bband_scalar = self.ff_bmax / self.ff_bband_np
-
-            # It's easy to have an outlier that boosts everything
-            self.verbose and print(f"ffi r: {self.ffi_rmin} : {self.ffi_rmax}")
-            self.verbose and print(f"ffi g: {self.ffi_gmin} : {self.ffi_gmax}")
-            self.verbose and print(f"ffi b: {self.ffi_bmin} : {self.ffi_bmax}")
-
-    def npf2im(self, statef):
-        #return statef, None
-        rounded = np.round(statef)
-        #print("row1: %s" % rounded[1])
-        statei = np.array(rounded, dtype=np.uint16)
-        #print(len(statei), len(statei[0]), len(statei[0]))
-        height = len(statef)
-        width = len(statef[0])
-
-        # for some reason I isn't working correctly
-        # only L
-        # workaround by plotting manually
-        im = Image.new("RGB", (width, height), "Black")
-        for y, row in enumerate(statei):
-            for x, val in enumerate(row):
-                # this causes really weird issues if not done
-                val = tuple(int(x) for x in val)
-                im.putpixel((x, y), val)
-
-        return im
-
-    def ff_minmax(self):
+            # Note: dead pixels (0) saturate
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scalars = ff_max / values
+                lut = np.multiply.outer(scalars, values)
+                lut = np.round(lut)
+                lut = np.minimum(lut, 255)
+                lut = lut.astype(np.uint8)
+            self.luts.append(lut.ravel())
+
+        self.verbose and print(f"ff r: {self.ff_mins[0]} : {self.ff_maxs[0]}")
+        self.verbose and print(f"ff g: {self.ff_mins[1]} : {self.ff_maxs[1]}")
+        self.verbose and print(f"ff b: {self.ff_mins[2]} : {self.ff_maxs[2]}")
+
+    def ff_minmax(self, ff_np):
+        """
+        Find near min/max per band, ignoring 1% outliers on each end
+        It's easy to have an outlier that boosts everything
+        """
         def bounds_close_band(band):
-            hist = band.histogram()
-            width, height = band.size
-            npixels = width * height
+            hist = np.bincount(band.ravel(), minlength=256)
+            npixels = band.size
             thresh = 0.01
 
             low = None
@@ -396,59 +767,129 @@ class CorrectFF1Plugin(IPPlugin):
                     break
             return low, high
 
-        (self.ff_rmin, self.ff_rmax) = bounds_close_band(self.ff_rband_im)
-        (self.ff_gmin, self.ff_gmax) = bounds_close_band(self.ff_gband_im)
-        (self.ff_bmin, self.ff_bmax) = bounds_close_band(self.ff_bband_im)
+        self.ff_mins = []
+        self.ff_maxs = []
+        for bandi in range(3):
+            low, high = bounds_close_band(ff_np[:, :, bandi])
+            self.ff_mins.append(low)
+            self.ff_maxs.append(high)
+
+    def get_scratch(self):
+        scratch = getattr(self.local, "scratch", None)
+        if scratch is None:
+            width, height = self.size
+            scratch = np.empty((height, width), dtype=np.uint16)
+            self.local.scratch = scratch
+        return scratch
+
+    def correct(self, im_np, out=None):
+        """
+        im_np: HxWx3 uint8 array
+        out: optional HxWx3 uint8 array to write into
+            May be im_np itself to correct in place
+        Returns out
+        """
+        width, height = self.size
+        if im_np.shape != (height, width, 3) or im_np.dtype != np.uint8:
+            raise ValueError(
+                "Calibration image size %uw x %uh but got image shape %s %s" %
+                (width, height, im_np.shape, im_np.dtype))
+        if out is None:
+            out = np.empty_like(im_np)
+        elif out.shape != im_np.shape or out.dtype != np.uint8:
+            raise ValueError("Bad out buffer shape %s %s" %
+                             (out.shape, out.dtype))
+
+        scratch = self.get_scratch()
+        for bandi in range(3):
+            np.bitwise_or(self.ff_hi[bandi], im_np[:, :, bandi], out=scratch)
+            # Every index is in range by construction
+            # Non-raise mode avoids numpy buffering the output
+            np.take(self.luts[bandi],
+                    scratch,
+                    out=out[:, :, bandi],
+                    mode="clip")
+        return out
+
+    def correct_im(self, im, out=None):
+        """
+        Correct a PIL image, returning a new PIL image
+        """
+        if im.size != self.size:
+            raise Exception(
+                "Calibration image size %uw x %uh but got image %uw x %uh" %
+                (self.size[0], self.size[1], im.width, im.height))
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        im_np = np.asarray(im)
+        return Image.fromarray(self.correct(im_np, out=out), "RGB")
+
+
+# Cache engines across plugin instances (one per worker thread)
+# key: calibration file name, value: (mtime, engine)
+_ff_engines = {}
+_ff_engines_lock = threading.Lock()
+
+
+def get_ff_engine(fn, verbose=False):
+    """
+    Return a shared FlatFieldEngine for the given calibration file
+    Reloaded if the file changes on disk
+    """
+    fn = os.path.realpath(fn)
+    mtime = os.path.getmtime(fn)
+    with _ff_engines_lock:
+        cached = _ff_engines.get(fn)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        engine = FlatFieldEngine(fn, verbose=verbose)
+        _ff_engines[fn] = (mtime, engine)
+        return engine
+
+
+class CorrectFF1Plugin(IPPlugin):
+    @classmethod
+    def cache_deps(cls, usc, task_name):
+        ret = super().cache_deps(usc, task_name)
+        ret["files"] = [usc.imager.ff_cal_fn()]
+        return ret
+
+    def __init__(self, log, default_options={}, microscope=None):
+        super().__init__(log=log,
+                         microscope=microscope,
+                         default_options=default_options,
+                         need_tmp_dir=True)
+        # Plugin is always registered
+        # Maybe should have a mechanism to exclude if it can't actually run?
+        self.ff_engine = None
+        # Output buffer, reused between images
+        # Plugin instances are per thread so this doesn't need a lock
+        self.out_np = None
+
+        if self.usc.imager.has_ff_cal():
+            self.ff_engine = get_ff_engine(self.usc.imager.ff_cal_fn(),
+                                           verbose=self.verbose)
+
+    def npf2im(self, statef):
+        return npf2im(statef)
 
     def _run(self, data_in, data_out, options={}):
         # Calibration must be loaded
-        assert self.ff_im
+        assert self.ff_engine
 
         print(f"FF1: run")
 
         self.verbose and print("")
 
+        # Pick up calibration changes
+        self.ff_engine = get_ff_engine(self.usc.imager.ff_cal_fn(),
+                                       verbose=self.verbose)
         image_in = data_in["image"]
-        # im_in = "cal/cal06_ff_1.5x/2023-06-20_01-22-25_blue_20x_cal6_1.5x_pic/c000_r001.jpg"
-        im = image_in.to_mutable_im()
-        if im.size != self.ff_im.size:
-            raise Exception(
-                "Calibration image size %uw x %uh but got image %uw x %uh" %
-                (self.ff_im.width, self.ff_im.height, im.width, im.height))
-
-        rband_im, gband_im, bband_im = im.split()
-        # fixme = Image.merge("RGB", (rband_im, gband_im, bband_im))
-        rband_np = np.array(rband_im)
-        gband_np = np.array(gband_im)
-        bband_np = np.array(bband_im)
-
-        # Rescale based on flat field
-        rband_np = np.multiply(rband_np, self.rband_scalar)
-        gband_np = np.multiply(gband_np, self.gband_scalar)
-        bband_np = np.multiply(bband_np, self.bband_scalar)
-
-        # floats aren't ideal for images
-        rband_np = np.round(rband_np)
-        gband_np = np.round(gband_np)
-        bband_np = np.round(bband_np)
-        # print("max", rband_np.max(), gband_np.max(), bband_np.max())
-
-        rband_np = np.minimum(rband_np, 255)
-        gband_np = np.minimum(gband_np, 255)
-        bband_np = np.minimum(bband_np, 255)
-        # print("max", rband_np.max(), gband_np.max(), bband_np.max())
-
-        rband_np = rband_np.astype(np.uint8)
-        gband_np = gband_np.astype(np.uint8)
-        bband_np = bband_np.astype(np.uint8)
-        # print("max", rband_np.max(), gband_np.max(), bband_np.max())
-
-        # Convert back into more standard PIL format
-        final_im_r = Image.fromarray(rband_np, "L")
-        final_im_g = Image.fromarray(gband_np, "L")
-        final_im_b = Image.fromarray(bband_np, "L")
-        final_im = Image.merge("RGB", (final_im_r, final_im_g, final_im_b))
-
+        im = image_in.to_im()
+        if self.out_np is None or self.out_np.shape[0:2] != (im.height,
+                                                             im.width):
+            self.out_np = np.empty((im.height, im.width, 3), dtype=np.uint8)
+        final_im = self.ff_engine.correct_im(im, out=self.out_np)
         final_im.save(data_out["image"].get_filename(), quality=90)
 
 
@@ -687,8 +1128,10 @@ class AnnotateScalebarPlugin(IPPlugin):
 def get_plugin_ctors():
     return {
         "stack-enfuse": StackEnfusePlugin,
+        "stack-native": StackNativePlugin,
         "hdr-enfuse": HDREnfusePlugin,
         "hdr-luminance": HDRLuminancePlugin,
+        "hdr-mertens": HDRMertensPlugin,
         "stabilization": StabilizationPlugin,
         "correct-ff1": CorrectFF1Plugin,
         "correct-sharp1": CorrectSharp1Plugin,
@@ -1,12 +1,15 @@
 from uscope import cloud_stitch
-from uscope.scan_util import index_scan_images, bucket_group, reduce_iindex_filename, is_tif_scan
+from uscope.scan_util import index_scan_images, bucket_group, reduce_iindex_filename, is_tif_scan, iindex_parse_fn, scan_excluded_tiles
 from uscope import config
 from uscope.imagep.util import TaskBarrier, EtherealImageR, EtherealImageW, remove_intermediate_directories, find_qr_code_match, check_valid_image_dir
-from uscope.imagep.summary import write_html_viewer, write_snapshot_grid, write_quick_pano
+from uscope.imagep.summary import write_html_viewer, write_snapshot_grid, write_quick_pano, write_deepzoom
 from uscope.util import writej
+from uscope.spool import spool_fn, has_spool, index_spool_images, spool_to_dir
 import glob
 import shutil
 import os
+import queue
+import threading
 from PIL import Image
 """
 Support the following:
@@ -23,28 +26,77 @@ def get_image_suffix(dir_in):
         return ".jpg"
 
 
+def iindex_image_suffix(iindex):
+    if iindex.get("spool"):
+        return list(iindex["images"].values())[0]["extension"]
+    return get_image_suffix(iindex["dir"])
+
+
+def iindex_image_r(iindex, basename):
+    """
+    Return an EtherealImageR for an image in an iindex
+    Spooled images are read straight out of the spool
+    """
+    if iindex.get("spool"):
+        return EtherealImageR(spool=(iindex["spool"], basename.split(".")[0]))
+    return EtherealImageR(fn=os.path.join(iindex["dir"], basename))
+
+
 class ImageStream:
     def __init__(self):
         pass
 
 
-# FIXME: how to integrate this?
-# might require binding to a plugin and adding a queue
 class PlannerImageStream(ImageStream):
-    def __init__(self, pconfig, directory, planner_image_queue_plugin):
+    """
+    Images as they are saved by an in progress Planner scan
+    Register progress_cb() with Planner.register_progress_callback()
+    """
+    def __init__(self, pconfig, directory):
         self.pconfig = pconfig
         self.directory = directory
-        self.planner_image_queue_plugin = planner_image_queue_plugin
+        self.queue = queue.Queue()
+        self.closed = threading.Event()
+
+    def progress_cb(self, state):
+        # Called from the planner or an image writer thread
+        # Only take images once they are fully written to disk
+        if state["type"] == "image_saved":
+            fn = state.get("image_filename_rel")
+            if fn:
+                self.queue.put(fn)
+        elif state["type"] == "end":
+            self.close()
+
+    def close(self):
+        """
+        No more images will be produced
+        Ex: scan completed or aborted
+        """
+        self.closed.set()
+
+    def done(self):
+        return self.closed.is_set() and self.queue.empty()
 
     def working_dir(self):
         return self.directory
 
-    def new_images(self):
+    def new_images(self, timeout=None):
         """
-        Return an iterable of EtherealImageR
+        Return a list of image filenames saved since the last call
+        Waits up to timeout for at least one
         """
-        fns = self.planner_image_queue_plugin.new_images()
-        return [EtherealImageR(fn=fn) for fn in fns]
+        ret = []
+        try:
+            ret.append(self.queue.get(True, timeout))
+            while True:
+                ret.append(self.queue.get(False))
+        except queue.Empty:
+            pass
+        return ret
+
+    def has_stabilization(self):
+        return "image-stabilization" in self.pconfig
 
     def has_stack(self):
         return "points-stacker" in self.pconfig
@@ -60,11 +112,13 @@ class PlannerImageStream(ImageStream):
         Check the scan config to see if stacks have 3 elements
         """
         if operation == "stack":
-            return self.pconfig["points-stacker"]["number"]
+            return int(self.pconfig["points-stacker"]["number"])
         elif operation == "hdr":
             return len(self.pconfig["imager"]["hdr"]["properties_list"])
+        elif operation == "stabilization":
+            return int(self.pconfig["image-stabilization"]["n"])
         else:
-            assert 0, "FIXME"
+            assert 0, f"bad operation {operation}"
 
 
 """
@@ -110,6 +164,13 @@ class IPPConfigJ:
         # This takes up disk space => off by default
         return bool(self.j.get("write_quick_pano", False))
 
+    def write_deepzoom(self):
+        """
+        Write quick pano as a DeepZoom tile pyramid + zoomable .html viewer
+        """
+        # Many small files => off by default
+        return bool(self.j.get("write_deepzoom", False))
+
     def keep_intermediates(self):
         # https://github.com/Labsmore/pyuscope/issues/410
         # Keep GUI default but more conservative here
@@ -152,14 +213,14 @@ class DirCSIP:
                    lazy=True):
         if not os.path.exists(dir_out):
             os.mkdir(dir_out)
-        image_suffix = get_image_suffix(iindex_in["dir"])
+        image_suffix = iindex_image_suffix(iindex_in)
         buckets = bucket_group(iindex_in, bucket_name)
 
         tb = TaskBarrier()
         # Must be in exposure order?
         for fn_prefix, hdrs in sorted(buckets.items()):
-            fns = [
-                os.path.join(iindex_in["dir"], fn)
+            images = [
+                iindex_image_r(iindex_in, fn)
                 for _i, fn in sorted(hdrs.items())
             ]
             fn_out = os.path.join(dir_out, fn_prefix + image_suffix)
@@ -170,7 +231,7 @@ class DirCSIP:
                 self.log("  %s" % (hdrs.items(), ))
                 self.log("Queing task")
                 self.csip.queue_n_to_1_plugin(task_name=task_name,
-                                              fns_in=fns,
+                                              data_in={"images": images},
                                               fn_out=fn_out,
                                               tb=tb)
         tb.wait()
@@ -187,11 +248,11 @@ class DirCSIP:
             if lazy and os.path.exists(fn_out):
                 self.log(f"lazy: skip {fn_out}")
             else:
-                self.csip.queue_1_to_1_plugin(plugin=plugin,
-                                              fn_in=os.path.join(
-                                                  iindex_in["dir"], fn_in),
-                                              fn_out=fn_out,
-                                              tb=tb)
+                self.csip.queue_1_to_1_plugin(
+                    plugin=plugin,
+                    data_in={"image": iindex_image_r(iindex_in, fn_in)},
+                    fn_out=fn_out,
+                    tb=tb)
         # print("TB: wait w/ alloc %s vs completed %s" % (tb.ntasks_allocated, tb.ntasks_completed))
         tb.wait()
 
@@ -204,19 +265,21 @@ class DirCSIP:
             if lazy and os.path.exists(fn_out):
                 self.log(f"lazy: skip {fn_out}")
             else:
-                self.csip.queue_1_to_1_plugin(plugin=task_name,
-                                              fn_in=os.path.join(
-                                                  iindex_in["dir"], fn_in),
-                                              fn_out=fn_out,
-                                              tb=tb)
+                self.csip.queue_1_to_1_plugin(
+                    plugin=task_name,
+                    data_in={"image": iindex_image_r(iindex_in, fn_in)},
+                    fn_out=fn_out,
+                    tb=tb)
         # print("TB: wait w/ alloc %s vs completed %s" % (tb.ntasks_allocated, tb.ntasks_completed))
         tb.wait()
 
     def hdr_run(self, **kwargs):
-        self.run_n_to_1(task_name="hdr-luminance", bucket_name="hdr", **kwargs)
+        self.run_n_to_1(task_name=config.get_usc().ipp.hdr_plugin(),
+                        bucket_name="hdr",
+                        **kwargs)
 
     def stack_run(self, **kwargs):
-        self.run_n_to_1(task_name="stack-enfuse",
+        self.run_n_to_1(task_name=config.get_usc().ipp.stack_plugin(),
                         bucket_name="stack",
                         **kwargs)
 
@@ -239,6 +302,9 @@ class DirCSIP:
 
         self.log("Reading metadata...")
         working_iindex = index_scan_images(self.directory)
+        if not working_iindex["images"] and has_spool(self.directory):
+            self.log("Reading frames from spool")
+            working_iindex = index_spool_images(spool_fn(self.directory))
         dst_basename = os.path.basename(os.path.abspath(self.directory))
 
         print("Microscope: %s" % (self.microscope.name, ))
@@ -249,6 +315,7 @@ class DirCSIP:
         print("  Write HTML viewer:", self.ipp_config.write_html_viewer())
         print("  Write snapshot grid:", self.ipp_config.write_snapshot_grid())
         print("  Write quick pano:", self.ipp_config.write_quick_pano())
+        print("  Write DeepZoom:", self.ipp_config.write_deepzoom())
         print("  Snapshot correction:", self.ipp_config.snapshot_correction())
         print("  Cloud stitch:", self.ipp_config.cloud_stitch())
 
@@ -324,8 +391,16 @@ class DirCSIP:
             self.correct_ff1_run(iindex_in=working_iindex, dir_out=next_dir)
             working_iindex = index_scan_images(next_dir)
 
+        if working_iindex.get("spool"):
+            # Nothing to process: downstream (CloudStitch, etc) needs files
+            self.log("Converting spool to images")
+            spool_to_dir(working_iindex["spool"])
+            working_iindex = index_scan_images(self.directory)
+
         self.verbose and self.log("")
-        healthy = self.csip.inspect_final_dir(working_iindex)
+        # ROI exclusions aren't missing images
+        excluded = scan_excluded_tiles(self.directory)
+        healthy = self.csip.inspect_final_dir(working_iindex, excluded)
         self.verbose and self.log("")
 
         if not healthy and self.best_effort:
@@ -334,11 +409,11 @@ class DirCSIP:
                     "Need to fix data to continue, but --fix not specified")
             self.log("WARNING: data is incomplete but trying to patch")
             next_dir = os.path.join(working_iindex["dir"], "fix")
-            self.fix_dir(working_iindex, next_dir)
+            self.csip.fix_dir(working_iindex, next_dir, excluded)
             working_iindex = index_scan_images(next_dir)
             self.verbose and self.log("")
             self.verbose and self.log("re-inspecting new dir")
-            healthy = self.csip.inspect_final_dir(working_iindex)
+            healthy = self.csip.inspect_final_dir(working_iindex, excluded)
             assert healthy
             self.log("")
 
@@ -374,11 +449,18 @@ class DirCSIP:
             if self.ipp_config.write_quick_pano():
                 self.verbose and self.log("Writing quick pano")
                 write_quick_pano(working_iindex)
+
+            if self.ipp_config.write_deepzoom():
+                self.verbose and self.log("Writing DeepZoom")
+                write_deepzoom(working_iindex)
         else:
             self.log(
                 "WARNING: skipping generating summary output on incomplete processed scan"
             )
 
+        if self.csip.result_cache:
+            self.log("Result cache: " + self.csip.result_cache.stats_str())
+
         outj = {
             "type": "processing",
         }
@@ -524,159 +606,173 @@ class SnapshotCSIP:
 
 
 """
-WIP, not tested / used currently
+Second generation image processing orchestrator
 See https://github.com/Labsmore/pyuscope/issues/190
 
-Second generation image processing orchestrator
-Constructs a pipeline based on expected input data
-Expects all images to be present
-If it fails you'll need to fall back to DirCSIP
+Processes images while the planner is still capturing them
+Each HDR / stack / etc bucket is queued as soon as it is complete
+Writes the same directory layout as DirCSIP
+DirCSIP can then be run lazily to finish up (summary files, CloudStitch, etc)
+and pick up anything that didn't complete (ex: aborted scan)
 """
-'''
+
+
 class StreamCSIP:
-    def __init__(self, csip, image_stream, microscope=None, upload=False):
-        assert 0, "WIP"
+    def __init__(self,
+                 csip,
+                 image_stream,
+                 configj={},
+                 microscope=None,
+                 verbose=True):
         self.csip = csip
+        self.log = csip.log
         self.image_stream = image_stream
         self.microscope = microscope
+        self.ipp_config = IPPConfigJ(configj)
+        self.verbose = verbose
+        # (stagei, fn_out, result) from worker threads
+        self.completed = queue.Queue()
+        self.tasks_pending = 0
+        self.tasks_failed = 0
+        self.final_images = []
 
-        # TODO: auto figure this out
-        # Might also want to move these to be objects
+        # Mirror DirCSIP.run() order
         self.pipeline = []
+
+        def add_1_to_1(plugin, dir_name):
+            self.pipeline.append({
+                "plugin": plugin,
+                "dir_name": dir_name,
+                "bucket_key": None,
+                "bucket_size": 1,
+            })
+
+        def add_n_to_1(plugin, bucket_key):
+            self.pipeline.append({
+                "plugin":
+                plugin,
+                "dir_name":
+                bucket_key,
+                "bucket_key":
+                bucket_key,
+                "bucket_size":
+                self.image_stream.bucket_size(bucket_key),
+            })
+
+        usc = config.get_usc()
+        for pipeline_this in usc.ipp.pipeline_first():
+            add_1_to_1(pipeline_this["plugin"], pipeline_this["dir"])
+        if self.image_stream.has_stabilization():
+            add_n_to_1("stabilization", "stabilization")
         if self.image_stream.has_hdr():
-            self.pipeline.append({"plugin": "hdr-enfuse"})
+            add_n_to_1(usc.ipp.hdr_plugin(), "hdr")
         if self.image_stream.has_stack():
-            self.pipeline.append({"plugin": "stack-enfuse"})
-        # Should this be before or after other steps?
-        # Currently expensive so put at the end
-        if config.get_usc().imager.has_ff_cal():
-            self.pipeline.append({"plugin": "correct-illumination"})
+            add_n_to_1(usc.ipp.stack_plugin(), "stack")
+        if self.ipp_config.snapshot_correction():
+            for pipeline_this in usc.ipp.snapshot_correction():
+                add_1_to_1(pipeline_this["plugin"], pipeline_this["dir"])
+        if usc.imager.has_ff_cal():
+            add_1_to_1("correct-ff1", "ff1")
 
-        next_directory = self.image_stream.working_dir()
+        dir_in = os.path.realpath(self.image_stream.working_dir())
         for pipe in self.pipeline:
-            """
-            keys are the next file basename w/o extension
-            ex: 
-            """
-            plugin = pipe["plugin"]
-
-            if plugin == "hdr-enfuse":
-                ptype = "hdr"
-            elif plugin == "stack-enfuse":
-                ptype = "stack"
-            elif plugin == "correct-illumination":
-                ptype = "correct"
-            else:
-                assert 0, plugin
-
+            # bucket name => {bucket index: filename}
             pipe["buckets"] = {}
-            pipe["type"] = ptype
-            pipe["remove_key"] = ptype
-            pipe["dir_in"] = next_directory
-            """
-            Nest directories like .../mz_mit20x/hdr/stack/
-            """
-            next_directory = os.path.join(next_directory, ptype)
-            pipe["dir_out"] = next_directory
-
-        self.tb = TaskBarrier()
-
-    def bucket_images(self, pipe, images):
+            pipe["dir_in"] = dir_in
+            # Nest directories like .../mz_mit20x/hdr/stack/
+            dir_in = os.path.join(dir_in, pipe["dir_name"])
+            pipe["dir_out"] = dir_in
+
+    def add_image(self, stagei, fn):
         """
-        Place new images into given pipeline stage
-        Don't trigger any processing, even if it could be done now
+        Image is ready for the given pipeline stage
+        Queue it immediately if it completes a bucket
         """
-        for image in images:
-            # iindex_filename_key[image.get_filename]
-            fn = image.get_filename()
-            bucketk = reduce_iindex_filename(fn, remove_key=pipe["remove_key"])
-            pipe.buckets.setdefault(bucketk, set()).add(os.path.basename(fn))
-
-    def bucket_full(self, statei, bucketk):
-        plugin = self.pipeline[statei]
-        if plugin == "hdr-enfuse":
-            expected = self.image_stream.bucket_size("hdr")
-        elif plugin == "stack-enfuse":
-            expected = self.image_stream.bucket_size("stack")
-        elif plugin == "correct-illumination":
-            expected = 1
+        if stagei == len(self.pipeline):
+            self.final_images.append(fn)
+            return
+        pipe = self.pipeline[stagei]
+        basename = os.path.basename(fn)
+        bucket_key = pipe["bucket_key"]
+        if bucket_key is None:
+            bucketk = basename
+            index = 0
         else:
-            assert 0, f"bad plugin {plugin}"
-        return len(self.state[statei][bucketk]) >= expected
-
-    def process_bucket(self, pipe, bucketk):
-        if not self.bucket_full(pipe, bucketk):
+            bucketk = reduce_iindex_filename(basename, remove_key=bucket_key)
+            index = iindex_parse_fn(basename)[bucket_key]
+        bucket = pipe["buckets"].setdefault(bucketk, {})
+        bucket[index] = fn
+        if len(bucket) >= pipe["bucket_size"]:
+            del pipe["buckets"][bucketk]
+            self.process_bucket(stagei, bucketk, bucket)
+
+    def process_bucket(self, stagei, bucketk, bucket):
+        pipe = self.pipeline[stagei]
+        if not os.path.exists(pipe["dir_out"]):
+            os.mkdir(pipe["dir_out"])
+        fns_in = [fn for _i, fn in sorted(bucket.items())]
+
+        def callback(_ip_params, result, _info):
+            # Called from worker thread
+            self.completed.put((stagei, fn_out, result))
+
+        self.tasks_pending += 1
+        if pipe["bucket_key"] is None:
+            fn_out = os.path.join(pipe["dir_out"], bucketk)
+            self.verbose and self.log(f"stream: {pipe['plugin']} {fn_out}")
+            self.csip.queue_1_to_1_plugin(plugin=pipe["plugin"],
+                                          fn_in=fns_in[0],
+                                          fn_out=fn_out,
+                                          callback=callback)
+        else:
+            extension = os.path.splitext(fns_in[0])[1]
+            fn_out = os.path.join(pipe["dir_out"], bucketk + extension)
+            self.verbose and self.log(
+                f"stream: {pipe['plugin']} {fn_out} ({len(fns_in)} images)")
+            self.csip.queue_n_to_1_plugin(task_name=pipe["plugin"],
+                                          fns_in=fns_in,
+                                          fn_out=fn_out,
+                                          callback=callback)
+
+    def poll_completed(self, timeout):
+        try:
+            stagei, fn_out, result = self.completed.get(True, timeout)
+        except queue.Empty:
             return
-        plugin = pipe["plugin"]
-        if plugin == "hdr-enfuse":
-            fn_out = os.path.join(pipe["dir_out"], bucketk + ".tif")
-            self.csip.queue_hdr_enfuse(fns_in=pipe["buckets"][bucketk],
-                                       fn_out=fn_out)
-        elif plugin == "stack-enfuse":
-            fn_out = os.path.join(pipe["dir_out"], bucketk + ".tif")
-            self.csip.queue_stack_enfuse(fns_in=pipe["buckets"][bucketk],
-                                         fn_out=fn_out)
-        elif plugin == "correct-illumination":
-            fn_out = os.path.join(pipe["dir_out"], bucketk + ".tif")
-            fns_in = list(pipe["buckets"][bucketk])
-            assert len(fns_in) == 1
-            self.csip.queue_correct_illumination(fn_in=fns_in[0],
-                                                 fn_out=fn_out)
-        elif plugin == "save-jpg":
-            fns_in = list(pipe["buckets"][bucketk])
-            assert len(fns_in) == 1
-            fn_out = os.path.join(pipe["dir_out"], bucketk + ".jpg")
-            self.csip.queue_convert_jpg(fn_in=fns_in[0], fn_out=fn_out)
+        self.tasks_pending -= 1
+        if result == "ok":
+            self.add_image(stagei + 1, fn_out)
         else:
-            assert 0, f"bad plugin {plugin}"
-        del self.pipe["buckets"][bucketk]
+            # DirCSIP will retry since the output wasn't written
+            self.tasks_failed += 1
+            self.log(f"WARNING: stream: failed to generate {fn_out}")
 
     def run(self):
         """
         Stream images (ie from an in progress capture)
-        Two steams of data:
-        -Raw images
-        -Completed intermediate steps
-        Could also just grab from a filesystem hmm
-        """
+        Returns once the stream is done and all queued tasks have completed
         """
-        Keep track of images at each state of the pipeline
-        Key them based on file basenames / assume they are written to the filesystem
-        """
-        self.states = []
-        for _element in self.pipeline:
-            # Buckets
-            self.states.append({})
-
+        self.log("stream: pipeline %s" %
+                 ([pipe["plugin"] for pipe in self.pipeline], ))
         # Done when all images have been put into pipeline and all pipeline tasks are processed
-        while not self.image_stream.done() or not self.tb.idle():
-            # New images for the pipeline?
-            new_images = self.image_stream.new_images()
-            self.bucket_images(self.pipeline[0], new_images)
-
-            # In progress images
-            for statei, new_images in self.pop_completed_images():
-                # Move to next pipeline stage if not done
-                if statei != len(self.pipeline) - 1:
-                    self.bucket_images(self.pipeline[statei + 1], new_images)
-
+        while not self.image_stream.done() or self.tasks_pending:
+            if not self.csip.running.is_set():
+                self.log("WARNING: stream: image processor shut down")
+                return False
             # Since images move down the pipeline, any newly completed images will move to next state
-            # Since we check earlier pipeline stages first bias towards BFS
-            # Could reorder if wanted DFS
-            for statei, pipe in enumerate(self.pipeline):
-                for bucketk in list(pipe["state"].keys()):
-                    self.process_bucket(pipe, bucketk)
-        # Finish all remaining allocated tasks
-        self.tb.wait()
-
-        # Last step after all processed
-        if self.upload:
-            assert 0, "fixme"
-            """
-            self.log("Ready to stitch " + working_iindex["dir"])
-            cloud_stitch.upload_dir(working_iindex["dir"],
-                                    cs_info=cs_info,
-                                    dst_basename=dst_basename,
-                                    verbose=verbose)
-            """
-'''
+            for fn in self.image_stream.new_images(timeout=0.05):
+                self.add_image(0, fn)
+            while not self.completed.empty():
+                self.poll_completed(timeout=None)
+            if self.tasks_pending and self.image_stream.done():
+                self.poll_completed(timeout=0.1)
+
+        incomplete = 0
+        for pipe in self.pipeline:
+            for bucketk in sorted(pipe["buckets"].keys()):
+                self.log("WARNING: stream: %s: incomplete bucket %s" %
+                         (pipe["plugin"], bucketk))
+                incomplete += 1
+        self.log("stream: %u final images, %u failed tasks, %u incomplete" %
+                 (len(self.final_images), self.tasks_failed, incomplete))
+        return self.tasks_failed == 0 and incomplete == 0
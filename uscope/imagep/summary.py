@@ -1,8 +1,10 @@
 from uscope.util import add_bool_arg
 from uscope.scan_util import index_scan_images, is_tif_scan
+from uscope.imagep.tiled import MosaicRenderer
+import cv2
+import json
 import os
 from PIL import Image
-import struct
 from uscope.util import readj
 import math
 
@@ -11,16 +13,25 @@ import math
 Image.MAX_IMAGE_PIXELS = None
 
 
-class HugeImage(Exception):
-    pass
+def split_output_filename(output_filename):
+    """
+    Full resolution is always written as a tiled pyramidal BigTIFF
+    Other formats (ex: .jpg) get a preview sized down to fit
+    Return (BigTIFF filename, preview filename or None)
+    """
+    base, ext = os.path.splitext(output_filename)
+    if ext.lower() in (".tif", ".tiff"):
+        return output_filename, None
+    return base + ".tif", output_filename
 
 
-class HugeJPEG(HugeImage):
-    pass
-
-
-class HugeTIF(HugeImage):
-    pass
+def mosaic_mode(im):
+    """
+    Renderer works in 8 bit grayscale or RGB
+    """
+    if im.mode in ("L", "RGB"):
+        return im.mode
+    return "RGB"
 
 
 # FIXME: for some reason this doesn't work on .tif images
@@ -100,7 +111,210 @@ def write_html_viewer(iindex, output_filename=None):
         f.write(out)
 
 
-def write_snapshot_grid(iindex, output_filename=None):
+DEEPZOOM_VIEWER_JS = """\
+const view = document.getElementById("view");
+// Screen pixels per full resolution pixel
+let scale = 1.0;
+// Full resolution pixel at the upper left of the view
+let ox = 0;
+let oy = 0;
+// "level/col_row" => img
+const shown = new Map();
+
+function levelFactor(level) {
+    return Math.pow(2, DZ.max_level - level);
+}
+
+function levelSize(level) {
+    const f = levelFactor(level);
+    return [Math.ceil(DZ.width / f), Math.ceil(DZ.height / f)];
+}
+
+function tileSpan(i, size) {
+    return [Math.max(0, i * DZ.tile - DZ.overlap),
+            Math.min(size, (i + 1) * DZ.tile + DZ.overlap)];
+}
+
+function wantLevel(want, level) {
+    const f = levelFactor(level);
+    const [lw, lh] = levelSize(level);
+    const c0 = Math.max(0, Math.floor(ox / f / DZ.tile));
+    const c1 = Math.min(Math.ceil(lw / DZ.tile) - 1,
+        Math.floor((ox + view.clientWidth / scale) / f / DZ.tile));
+    const r0 = Math.max(0, Math.floor(oy / f / DZ.tile));
+    const r1 = Math.min(Math.ceil(lh / DZ.tile) - 1,
+        Math.floor((oy + view.clientHeight / scale) / f / DZ.tile));
+    for (let row = r0; row <= r1; row++) {
+        for (let col = c0; col <= c1; col++) {
+            const [x0, x1] = tileSpan(col, lw);
+            const [y0, y1] = tileSpan(row, lh);
+            want.set(level + "/" + col + "_" + row,
+                [level, x0 * f, y0 * f, (x1 - x0) * f, (y1 - y0) * f]);
+        }
+    }
+}
+
+function render() {
+    // Lowest resolution level with at least one image pixel per device pixel
+    let level = DZ.max_level + Math.ceil(Math.log2(scale * window.devicePixelRatio) - 1e-6);
+    level = Math.max(DZ.background_level, Math.min(DZ.max_level, level));
+    const want = new Map();
+    // Always keep a coarse image underneath while tiles load
+    wantLevel(want, DZ.background_level);
+    if (level != DZ.background_level) {
+        wantLevel(want, level);
+    }
+    for (const [key, img] of shown) {
+        if (!want.has(key)) {
+            img.remove();
+            shown.delete(key);
+        }
+    }
+    for (const [key, [level, x, y, w, h]] of want) {
+        let img = shown.get(key);
+        if (!img) {
+            img = document.createElement("img");
+            img.src = DZ.files + "/" + key + "." + DZ.format;
+            img.style.zIndex = level;
+            img.draggable = false;
+            view.appendChild(img);
+            shown.set(key, img);
+        }
+        img.style.left = ((x - ox) * scale) + "px";
+        img.style.top = ((y - oy) * scale) + "px";
+        img.style.width = (w * scale) + "px";
+        img.style.height = (h * scale) + "px";
+    }
+}
+
+function fitScale() {
+    return Math.min(view.clientWidth / DZ.width, view.clientHeight / DZ.height);
+}
+
+function fit() {
+    scale = fitScale();
+    ox = (DZ.width - view.clientWidth / scale) / 2;
+    oy = (DZ.height - view.clientHeight / scale) / 2;
+    render();
+}
+
+let drag = null;
+view.addEventListener("mousedown", (e) => {
+    drag = [e.clientX, e.clientY];
+});
+window.addEventListener("mouseup", () => {
+    drag = null;
+});
+window.addEventListener("mousemove", (e) => {
+    if (!drag) {
+        return;
+    }
+    ox -= (e.clientX - drag[0]) / scale;
+    oy -= (e.clientY - drag[1]) / scale;
+    drag = [e.clientX, e.clientY];
+    render();
+});
+view.addEventListener("wheel", (e) => {
+    e.preventDefault();
+    const rect = view.getBoundingClientRect();
+    const mx = e.clientX - rect.left;
+    const my = e.clientY - rect.top;
+    // Keep the pixel under the cursor in place
+    const px = ox + mx / scale;
+    const py = oy + my / scale;
+    scale *= Math.exp(-e.deltaY * 0.002);
+    scale = Math.max(fitScale() / 4, Math.min(8, scale));
+    ox = px - mx / scale;
+    oy = py - my / scale;
+    render();
+}, {passive: false});
+view.addEventListener("dblclick", fit);
+window.addEventListener("resize", render);
+fit();
+"""
+
+
+def write_deepzoom_viewer(writer, output_filename):
+    """
+    Write a standalone pan / zoom page for a DeepZoom pyramid
+    Unlike write_html_viewer only the tiles in view are fetched,
+    and only at the resolution needed
+    writer: DeepZoomWriter that made the pyramid
+    """
+    background_level = 0
+    for leveli, level in enumerate(writer.levels):
+        if max(level.width, level.height) <= writer.tile:
+            background_level = leveli
+    dz = {
+        "width":
+        writer.width,
+        "height":
+        writer.height,
+        "tile":
+        writer.tile,
+        "overlap":
+        writer.overlap,
+        "format":
+        writer.format,
+        "max_level":
+        writer.max_level,
+        "background_level":
+        background_level,
+        # Relative so the directory can be moved / served as is
+        "files":
+        os.path.relpath(writer.tiles_dir,
+                        os.path.dirname(output_filename) or "."),
+    }
+    out = """\
+<!DOCTYPE html>
+<html lang="en">
+
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Labsmore Pano View</title>
+    <style>
+        html,
+        body {
+            margin: 0;
+            height: 100%;
+            background-color: #000000;
+        }
+
+        #view {
+            position: relative;
+            overflow: hidden;
+            width: 100%;
+            height: 100%;
+            cursor: move;
+        }
+
+        #view img {
+            position: absolute;
+        }
+    </style>
+</head>
+
+<body>
+    <div id="view"></div>
+    <script>
+"""
+    out += "const DZ = %s;\n" % (json.dumps(dz), )
+    out += DEEPZOOM_VIEWER_JS
+    out += """\
+    </script>
+</body>
+
+</html>
+"""
+    with open(output_filename, "w") as f:
+        f.write(out)
+
+
+def write_snapshot_grid(iindex,
+                        output_filename=None,
+                        preview_max_pixels=2**25,
+                        threads=None):
     if output_filename is None:
         d = os.path.join(iindex["dir"], "summary")
         if not os.path.exists(d):
@@ -112,48 +326,55 @@ def write_snapshot_grid(iindex, output_filename=None):
 
     print('Calculating dimensions...')
 
-    #with Image.open(fns_in[0]) as im0:
     this0 = iindex["crs"][(0, 0)]
-    im0 = Image.open(os.path.join(iindex["dir"], this0["basename"]))
-    spacing = int(im0.height * 0.05)
-    w = im0.size[0] * iindex["cols"] + spacing * (iindex["cols"] - 1)
-    h = im0.size[1] * iindex["rows"] + spacing * (iindex["rows"] - 1)
-    dst = Image.new(im0.mode, (w, h))
-
-    if output_filename.find('.jpg') >= 0:
-        if w >= 2**16 or h >= 2**16:
-            raise HugeJPEG('Image exceeds maximum JPEG w/h')
-        # think this was tiff, not jpg...?
-        if w * h >= 2**32:
-            raise HugeJPEG('Image exceeds maximum JPEG size')
-
+    with Image.open(os.path.join(iindex["dir"], this0["basename"])) as im0:
+        im0_width, im0_height = im0.size
+        mode = mosaic_mode(im0)
+    spacing = int(im0_height * 0.05)
+    w = im0_width * iindex["cols"] + spacing * (iindex["cols"] - 1)
+    h = im0_height * iindex["rows"] + spacing * (iindex["rows"] - 1)
+
+    placements = []
     for this in iindex["images"].values():
-        x = im0.width * this["col"] + spacing * this["col"]
+        x = im0_width * this["col"] + spacing * this["col"]
         # lower left vs uppper left coordinate systems
         row0 = iindex["rows"] - this["row"] - 1
-        y = im0.height * row0 + spacing * row0
-        im = Image.open(os.path.join(iindex["dir"], this["basename"]))
-        dst.paste(im, (x, y))
-
-    print(('Saving %s...' % (output_filename, )))
-    try:
-        dst.save(output_filename, quality=95)
-    # File "/usr/lib/python2.7/dist-packages/PIL/TiffImagePlugin.py", line 550, in _pack
-    #   return struct.pack(self._endian + fmt, *values)
-    # struct.error: 'L' format requires 0 <= number <= 4294967295
-    except struct.error:
-        try:
-            os.remove(output_filename)
-        except OSError:
-            pass
-        raise HugeTIF("Failed to save image of size %uw x %uh" % (w, h))
+        y = im0_height * row0 + spacing * row0
+        placements.append({
+            "filename":
+            os.path.join(iindex["dir"], this["basename"]),
+            "x":
+            x,
+            "y":
+            y,
+            "width":
+            im0_width,
+            "height":
+            im0_height,
+        })
+
+    tiff_filename, preview_filename = split_output_filename(output_filename)
+    print(('Saving %s...' % (tiff_filename, )))
+    dst = MosaicRenderer(w, h, placements, mode=mode, threads=threads)
+    dst.render(tiff_filename,
+               preview_filename=preview_filename,
+               preview_max_pixels=preview_max_pixels)
     print('Done!')
 
 
 class QuickPano:
-    def __init__(self, iindex, output_filename=None):
+    def __init__(self,
+                 iindex,
+                 output_filename=None,
+                 preview_max_pixels=2**25,
+                 threads=None):
+        """
+        output_filename: .jpg etc is a preview next to the full resolution .tif
+        """
         self.iindex = iindex
         self.verbose = False
+        self.preview_max_pixels = preview_max_pixels
+        self.threads = threads
 
         if output_filename is None:
             d = os.path.join(iindex["dir"], "summary")
@@ -229,14 +450,11 @@ class QuickPano:
             f"Calculate image size: {global_width}w x {global_height}h")
         assert global_width > 0 and global_height > 0
 
-        if self.output_filename.find('.jpg') >= 0:
-            if global_width >= 2**16 or global_height >= 2**16:
-                raise HugeJPEG('Image exceeds maximum JPEG w/h')
-            # think this was tiff, not jpg...?
-            if global_width * global_height >= 2**32:
-                raise HugeJPEG('Image exceeds maximum JPEG size')
-
-        self.dst = Image.new(im0.mode, (global_width, global_height))
+        # Tiles are streamed in at save()
+        self.dst = MosaicRenderer(global_width,
+                                  global_height, [],
+                                  mode=mosaic_mode(im0),
+                                  threads=self.threads)
 
     def image_coordinate(self, col, row):
         """
@@ -297,9 +515,18 @@ class QuickPano:
                 info = self.cr2info[(col, row)]
                 x, y = self.image_coordinate(col, row)
                 self.verbose and print(f"{row}r {col}c => {x} x {y} y")
-                im = Image.open(
-                    os.path.join(self.iindex["dir"], info["filename"]))
-                self.dst.paste(im, (x, y))
+                self.dst.placements.append({
+                    "filename":
+                    os.path.join(self.iindex["dir"], info["filename"]),
+                    "x":
+                    x,
+                    "y":
+                    y,
+                    "width":
+                    self.im0.width,
+                    "height":
+                    self.im0.height,
+                })
 
     def fill_dst_rotate(self):
         overlaps = self.get_overlaps()
@@ -312,16 +539,20 @@ class QuickPano:
         trim_y = int(overlaps["y"]["overlap_pixels"] * 0.48)
         # print("x y", trim_x, trim_y)
         # print("rotation_ccw", rotation_ccw)
-        orig_mode = self.dst.mode
-        # self.dst.putalpha(255)
-        self.dst = self.dst.convert('RGBA')
-        print('"Quick pano": slower w/ rotation')
-
-        # assert 0
+        print('"Quick pano": w/ rotation')
+        # All images are the same size => same rotation warp for all of them
+        # Rotate about the center and expand to fit like Image.rotate()
+        rotated_width, rotated_height = Image.new("L", self.im0.size).rotate(
+            rotation_ccw, expand=True).size
+        # OpenCV coordinates are pixel centers
+        warp = cv2.getRotationMatrix2D(
+            ((self.im0.width - 1) / 2, (self.im0.height - 1) / 2),
+            rotation_ccw, 1.0)
+        warp[0][2] += (rotated_width - self.im0.width) / 2
+        warp[1][2] += (rotated_height - self.im0.height) / 2
 
         # Fill from bottom up such that upper left is on top
         for row in range(self.iindex["rows"]):
-            print("  Row %u / %u" % (row + 1, self.iindex["rows"]))
             row = self.iindex["rows"] - row - 1
             for col in range(self.iindex["cols"]):
                 col = self.iindex["cols"] - col - 1
@@ -331,42 +562,38 @@ class QuickPano:
                 info = self.cr2info[(col, row)]
                 x, y = self.image_coordinate(col, row)
                 self.verbose and print(f"{row}r {col}c => {x} x {y} y")
-                im_orig = Image.open(
-                    os.path.join(self.iindex["dir"], info["filename"]))
-
-                im = im_orig.convert('RGBA')
-                # im.putalpha(255)
-                im = im.rotate(rotation_ccw, Image.BICUBIC, expand=True)
-                offset_x = 0
-                offset_y = 0
-                """
-                if rotation_ccw > 0:
-                    offset_x = -int(math.sin(rotation_ccw * 3.14 / 180) * im_orig.height)
-                else:
-                    offset_y = -int(math.sin(-rotation_ccw * 3.14 / 180) * im_orig.width)
-                print("offsets", offset_x, offset_y)
-                """
 
                 crop_x0 = 0
-                crop_x1 = im.width
+                crop_x1 = rotated_width
                 crop_y0 = 0
-                crop_y1 = im.height
+                crop_y1 = rotated_height
                 if col > 0:
                     crop_x0 = trim_x
-                    offset_x += crop_x0
                 if row > 0:
                     crop_y0 = trim_y
-                    offset_y += crop_y0
                 if col < self.iindex["cols"] - 1:
                     crop_x1 -= trim_x
                 if row < self.iindex["rows"] - 1:
                     crop_y1 -= trim_y
                 # print("crop", crop_x0, crop_y0, crop_x1, crop_y1)
-                im = im.crop((crop_x0, crop_y0, crop_x1, crop_y1))
-                # print("paste", (x, y), (x + offset_x, y + offset_y))
-
-                self.dst.paste(im, (x + offset_x, y + offset_y), im)
-        self.dst = self.dst.convert(orig_mode)
+                this_warp = warp.copy()
+                this_warp[0][2] -= crop_x0
+                this_warp[1][2] -= crop_y0
+                self.dst.placements.append({
+                    "filename":
+                    os.path.join(self.iindex["dir"], info["filename"]),
+                    "x":
+                    x + crop_x0,
+                    "y":
+                    y + crop_y0,
+                    "width":
+                    crop_x1 - crop_x0,
+                    "height":
+                    crop_y1 - crop_y0,
+                    # Rotated corners are left transparent
+                    "warp":
+                    this_warp,
+                })
 
     def fill_dst(self):
         if self.get_rotation_ccw():
@@ -375,19 +602,12 @@ class QuickPano:
             self.fill_dst_simple()
 
     def save(self):
-        self.verbose and print(('Saving %s...' % (self.output_filename, )))
-        try:
-            self.dst.save(self.output_filename, quality=95)
-        # File "/usr/lib/python2.7/dist-packages/PIL/TiffImagePlugin.py", line 550, in _pack
-        #   return struct.pack(self._endian + fmt, *values)
-        # struct.error: 'L' format requires 0 <= number <= 4294967295
-        except struct.error:
-            try:
-                os.remove(self.output_filename)
-            except OSError:
-                pass
-            raise HugeTIF("Failed to save image of size %uw x %uh" %
-                          (self.dst.width, self.dst.height))
+        tiff_filename, preview_filename = split_output_filename(
+            self.output_filename)
+        self.verbose and print(('Saving %s...' % (tiff_filename, )))
+        self.dst.render(tiff_filename,
+                        preview_filename=preview_filename,
+                        preview_max_pixels=self.preview_max_pixels)
 
     def run(self):
         assert self.iindex[
@@ -403,6 +623,37 @@ def write_quick_pano(*args, **kwargs):
     QuickPano(*args, **kwargs).run()
 
 
+class DeepZoomPano(QuickPano):
+    """
+    Same placement as QuickPano but written as a DeepZoom tile pyramid
+    plus a viewer page that only loads what is on screen
+    """
+    def __init__(self, iindex, output_filename=None, threads=None):
+        """
+        output_filename: .dzi file. Viewer goes next to it as .html
+        """
+        if output_filename is None:
+            d = os.path.join(iindex["dir"], "summary")
+            if not os.path.exists(d):
+                os.mkdir(d)
+            output_filename = os.path.join(iindex["dir"], "summary",
+                                           "deepzoom.dzi")
+        super().__init__(iindex,
+                         output_filename=output_filename,
+                         threads=threads)
+
+    def save(self):
+        self.verbose and print(('Saving %s...' % (self.output_filename, )))
+        writer = self.dst.render_deepzoom(self.output_filename)
+        write_deepzoom_viewer(
+            writer,
+            os.path.splitext(self.output_filename)[0] + ".html")
+
+
+def write_deepzoom(*args, **kwargs):
+    DeepZoomPano(*args, **kwargs).run()
+
+
 def main():
     import argparse
 
@@ -410,6 +661,7 @@ def main():
     add_bool_arg(parser, "--html", default=True)
     add_bool_arg(parser, "--snapshot-grid", default=True)
     add_bool_arg(parser, "--quick-pano", default=True)
+    add_bool_arg(parser, "--deepzoom", default=False)
     parser.add_argument("dir_in")
     args = parser.parse_args()
 
@@ -421,9 +673,12 @@ def main():
     if args.snapshot_grid:
         write_snapshot_grid(iindex)
 
-    if args.tile_image:
+    if args.quick_pano:
         write_quick_pano(iindex)
 
+    if args.deepzoom:
+        write_deepzoom(iindex)
+
 
 if __name__ == "__main__":
     main()
@@ -41,10 +41,15 @@ class ImageProcessingThreadBase(CommandThreadBase):
         # Then lower level engine
         self.ip.shutdown_join(timeout=timeout)
 
-    def auto_focus(self, objective_config, block=False, done=None):
+    def auto_focus(self,
+                   objective_config,
+                   search=None,
+                   block=False,
+                   done=None):
         j = {
             #"type": "auto_focus",
             "objective_config": objective_config,
+            "search": search,
         }
         self.command("auto_focus", j, block=block, done=done)
 
@@ -58,7 +63,7 @@ class ImageProcessingThreadBase(CommandThreadBase):
                 imager=self.microscope.imager,
                 kinematics=self.microscope.kinematics,
                 log=self.log)
-            af.coarse(j["objective_config"])
+            af.coarse(j["objective_config"], search=j.get("search"))
         except MicroscopeStop:
             self.log("Autofocus cancelled")
             raise
@@ -0,0 +1,614 @@
+"""
+Out of core mosaic rendering
+Mosaics are rendered and written a band of rows at a time
+so memory is bounded by the mosaic width, not the mosaic size
+"""
+
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import io
+import numpy as np
+import os
+import struct
+import zlib
+
+Image.MAX_IMAGE_PIXELS = None
+
+TIFF_TILE = 512
+# JPEG can't go above 65535 w/h
+JPEG_MAX_WH = 65500
+
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_LONG8 = 16
+TIFF_TYPE_FORMATS = {
+    TIFF_SHORT: "H",
+    TIFF_LONG: "I",
+    TIFF_LONG8: "Q",
+}
+
+TIFF_COMPRESSION_NONE = 1
+TIFF_COMPRESSION_JPEG = 7
+TIFF_COMPRESSION_DEFLATE = 8
+TIFF_COMPRESSIONS = {
+    "none": TIFF_COMPRESSION_NONE,
+    "jpeg": TIFF_COMPRESSION_JPEG,
+    "deflate": TIFF_COMPRESSION_DEFLATE,
+}
+
+
+def downsample2(a):
+    """
+    Half size numpy image using a 2x2 box filter
+    Odd edges are replicated
+    """
+    if a.shape[0] % 2:
+        a = np.concatenate((a, a[-1:]), axis=0)
+    if a.shape[1] % 2:
+        a = np.concatenate((a, a[:, -1:]), axis=1)
+    a = a.astype(np.uint16)
+    ret = a[0::2, 0::2] + a[1::2, 0::2] + a[0::2, 1::2] + a[1::2, 1::2]
+    ret += 2
+    ret //= 4
+    return ret.astype(np.uint8)
+
+
+def pyramid_shapes(width, height, min_size=TIFF_TILE):
+    """
+    Return [(width, height)] for full resolution and then each half size level
+    until the image fits in min_size
+    """
+    ret = [(width, height)]
+    while width > min_size or height > min_size:
+        width = (width + 1) // 2
+        height = (height + 1) // 2
+        ret.append((width, height))
+    return ret
+
+
+def preview_level(width, height, max_pixels, min_size=TIFF_TILE):
+    """
+    Return the first pyramid level that can be written as a regular JPEG
+    within max_pixels
+    """
+    for leveli, (w, h) in enumerate(pyramid_shapes(width, height, min_size)):
+        if w <= JPEG_MAX_WH and h <= JPEG_MAX_WH and w * h <= max_pixels:
+            return leveli
+    return leveli
+
+
+class PyramidTiffLevel:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        # Rows fed but not yet written
+        self.pending = []
+        self.npending = 0
+        # Rows written so far
+        self.rows = 0
+        self.tile_offsets = []
+        self.tile_byte_counts = []
+
+    def take_rows(self, n):
+        rows = np.concatenate(self.pending, axis=0)
+        self.pending = [rows[n:]]
+        self.npending = len(rows) - n
+        return rows[:n]
+
+
+class PyramidTiffWriter:
+    """
+    Tiled pyramidal BigTIFF
+    Level 0 is full resolution, each following level is half the size
+    of the previous one
+    Feed full resolution rows top to bottom with write_rows()
+    """
+    def __init__(self,
+                 filename,
+                 width,
+                 height,
+                 channels=3,
+                 tile=TIFF_TILE,
+                 compression="jpeg",
+                 quality=90,
+                 keep_level=None,
+                 executor=None):
+        """
+        compression: jpeg, deflate, or none
+            Scans are usually already JPEG and don't deflate well
+        keep_level: also return this level as a numpy array from close()
+        executor: compress tiles in parallel
+        """
+        assert channels in (1, 3), channels
+        assert tile % 16 == 0, "TIFF tile size must be a multiple of 16"
+        if compression not in TIFF_COMPRESSIONS:
+            raise ValueError("Bad compression %s" % (compression, ))
+        self.filename = filename
+        self.channels = channels
+        self.tile = tile
+        self.compression = compression
+        self.quality = quality
+        self.executor = executor
+        self.levels = [
+            PyramidTiffLevel(w, h)
+            for w, h in pyramid_shapes(width, height, min_size=tile)
+        ]
+        self.keep_level = keep_level
+        self.kept = None
+        if keep_level is not None:
+            level = self.levels[keep_level]
+            self.kept = np.zeros(self.shape(level.height, level.width),
+                                 dtype=np.uint8)
+        self.f = open(filename, "wb")
+        # BigTIFF header: first IFD offset filled in by close()
+        self.f.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+
+    def shape(self, rows, cols):
+        if self.channels == 1:
+            return (rows, cols)
+        return (rows, cols, self.channels)
+
+    def write_rows(self, rows, leveli=0):
+        level = self.levels[leveli]
+        if not len(rows):
+            return
+        assert rows.shape[1] == level.width, (rows.shape, level.width)
+        level.pending.append(rows)
+        level.npending += len(rows)
+        while level.npending >= self.tile:
+            self.write_tile_row(leveli, level.take_rows(self.tile))
+
+    def compress_tile(self, tile):
+        if self.compression == "jpeg":
+            # Complete JPEG per tile (no shared JPEGTables)
+            f = io.BytesIO()
+            Image.fromarray(tile).save(f,
+                                       "JPEG",
+                                       quality=self.quality,
+                                       subsampling="4:2:0")
+            return f.getvalue()
+        elif self.compression == "deflate":
+            return zlib.compress(tile.tobytes(), 6)
+        else:
+            return tile.tobytes()
+
+    def write_tile_row(self, leveli, rows):
+        level = self.levels[leveli]
+        assert level.rows + len(rows) <= level.height, "Too many rows"
+        if self.kept is not None and leveli == self.keep_level:
+            self.kept[level.rows:level.rows + len(rows)] = rows
+        level.rows += len(rows)
+
+        # Edge tiles are padded to full size
+        tiles_across = (level.width + self.tile - 1) // self.tile
+        padded = np.zeros(self.shape(self.tile, tiles_across * self.tile),
+                          dtype=np.uint8)
+        padded[0:len(rows), 0:level.width] = rows
+        tiles = [
+            np.ascontiguousarray(padded[:, x:x + self.tile])
+            for x in range(0, tiles_across * self.tile, self.tile)
+        ]
+        if self.executor:
+            tiles = self.executor.map(self.compress_tile, tiles)
+        else:
+            tiles = map(self.compress_tile, tiles)
+        for data in tiles:
+            level.tile_offsets.append(self.f.tell())
+            level.tile_byte_counts.append(len(data))
+            self.f.write(data)
+
+        if leveli + 1 < len(self.levels):
+            self.write_rows(downsample2(rows), leveli + 1)
+
+    def flush(self):
+        # Top down since each level feeds the next
+        for leveli, level in enumerate(self.levels):
+            if level.npending:
+                self.write_tile_row(leveli, level.take_rows(level.npending))
+            assert level.rows == level.height, "Level %u: got %u / %u rows" % (
+                leveli, level.rows, level.height)
+
+    def write_ifd(self, tags):
+        """
+        tags: list of (tag, type, values)
+        Return (IFD offset, offset of its next IFD pointer)
+        """
+        entries = []
+        for tag, tag_type, values in sorted(tags):
+            data = struct.pack(
+                "<%u%s" % (len(values), TIFF_TYPE_FORMATS[tag_type]), *values)
+            if len(data) <= 8:
+                value = data.ljust(8, b"\0")
+            else:
+                # Too big to fit in the entry
+                if self.f.tell() % 2:
+                    self.f.write(b"\0")
+                value = struct.pack("<Q", self.f.tell())
+                self.f.write(data)
+            entries.append(
+                struct.pack("<HHQ", tag, tag_type, len(values)) + value)
+        if self.f.tell() % 2:
+            self.f.write(b"\0")
+        ifd_offset = self.f.tell()
+        self.f.write(struct.pack("<Q", len(entries)))
+        for entry in entries:
+            self.f.write(entry)
+        next_offset = self.f.tell()
+        self.f.write(struct.pack("<Q", 0))
+        return ifd_offset, next_offset
+
+    def close(self):
+        """
+        Write the directory and return the kept level, if any
+        """
+        self.flush()
+        # Header points to first IFD
+        next_offset = 8
+        for leveli, level in enumerate(self.levels):
+            if self.channels == 1:
+                photometric = 1
+            elif self.compression == "jpeg":
+                # JPEG stores color as YCbCr
+                photometric = 6
+            else:
+                photometric = 2
+            tags = [
+                # Reduced resolution version of the first image
+                (254, TIFF_LONG, [1 if leveli else 0]),
+                (256, TIFF_LONG, [level.width]),
+                (257, TIFF_LONG, [level.height]),
+                (258, TIFF_SHORT, [8] * self.channels),
+                (259, TIFF_SHORT, [TIFF_COMPRESSIONS[self.compression]]),
+                (262, TIFF_SHORT, [photometric]),
+                (277, TIFF_SHORT, [self.channels]),
+                # Chunky
+                (284, TIFF_SHORT, [1]),
+                (322, TIFF_LONG, [self.tile]),
+                (323, TIFF_LONG, [self.tile]),
+                (324, TIFF_LONG8, level.tile_offsets),
+                (325, TIFF_LONG8, level.tile_byte_counts),
+            ]
+            if photometric == 6:
+                # Matches 4:2:0 above
+                tags.append((530, TIFF_SHORT, [2, 2]))
+            ifd_offset, this_next_offset = self.write_ifd(tags)
+            self.f.seek(next_offset)
+            self.f.write(struct.pack("<Q", ifd_offset))
+            self.f.seek(0, os.SEEK_END)
+            next_offset = this_next_offset
+        self.f.close()
+        return self.kept
+
+
+class DeepZoomLevel:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        # Rows received so far but not yet dropped, starting at buf_y0
+        self.buf = None
+        self.buf_y0 = 0
+        self.rows = 0
+        # Next tile row to write
+        self.tile_row = 0
+        # Odd row waiting for a partner before downsampling
+        self.carry = None
+
+
+class DeepZoomWriter:
+    """
+    DeepZoom (.dzi) tile pyramid as used by OpenSeadragon and friends
+    Level max_level is full resolution and each lower level is half
+    the size of the one above it, down to 1x1
+    Feed full resolution rows top to bottom with write_rows()
+    Tiles are written as soon as all of their rows are available
+    """
+    def __init__(self,
+                 filename,
+                 width,
+                 height,
+                 channels=3,
+                 tile=254,
+                 overlap=1,
+                 format="jpg",
+                 quality=90,
+                 executor=None):
+        """
+        filename: .dzi file. Tiles go in <base>_files/<level>/<col>_<row>.<format>
+        executor: encode tiles in parallel
+        """
+        assert channels in (1, 3), channels
+        assert format in ("jpg", "png"), format
+        assert tile > 2 * overlap
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.tile = tile
+        self.overlap = overlap
+        self.format = format
+        self.quality = quality
+        self.executor = executor
+        self.tiles_dir = os.path.splitext(filename)[0] + "_files"
+        # Lowest resolution first to match level numbering
+        shapes = pyramid_shapes(width, height, min_size=1)
+        self.max_level = len(shapes) - 1
+        self.levels = [DeepZoomLevel(w, h) for w, h in reversed(shapes)]
+        for leveli in range(len(self.levels)):
+            d = os.path.join(self.tiles_dir, str(leveli))
+            if not os.path.exists(d):
+                os.makedirs(d)
+
+    def tile_span(self, i, size):
+        """
+        Return [start, end) level pixels covered by tile index i
+        including overlap into neighboring tiles
+        """
+        start = max(0, i * self.tile - self.overlap)
+        end = min(size, (i + 1) * self.tile + self.overlap)
+        return start, end
+
+    def write_rows(self, rows, leveli=None):
+        if leveli is None:
+            leveli = self.max_level
+        level = self.levels[leveli]
+        if not len(rows):
+            return
+        assert rows.shape[1] == level.width, (rows.shape, level.width)
+        assert level.rows + len(rows) <= level.height, "Too many rows"
+        level.rows += len(rows)
+        if level.buf is None:
+            level.buf = rows
+        else:
+            level.buf = np.concatenate((level.buf, rows), axis=0)
+        tiles_down = (level.height + self.tile - 1) // self.tile
+        while level.tile_row < tiles_down:
+            y0, y1 = self.tile_span(level.tile_row, level.height)
+            if level.rows < y1:
+                break
+            self.write_tile_row(leveli, level.tile_row,
+                                level.buf[y0 - level.buf_y0:y1 - level.buf_y0])
+            level.tile_row += 1
+            # Next tile row overlaps into this one
+            next_y0 = min(level.rows,
+                          level.tile_row * self.tile - self.overlap)
+            level.buf = level.buf[next_y0 - level.buf_y0:]
+            level.buf_y0 = next_y0
+
+        if leveli > 0:
+            if level.carry is not None:
+                rows = np.concatenate((level.carry, rows), axis=0)
+                level.carry = None
+            if len(rows) % 2 and level.rows < level.height:
+                level.carry = rows[-1:]
+                rows = rows[:-1]
+            if len(rows):
+                self.write_rows(downsample2(rows), leveli - 1)
+
+    def save_tile(self, args):
+        fn, tile = args
+        im = Image.fromarray(tile)
+        if self.format == "jpg":
+            im.save(fn, "JPEG", quality=self.quality)
+        else:
+            im.save(fn)
+
+    def write_tile_row(self, leveli, row, rows):
+        level = self.levels[leveli]
+        tiles_across = (level.width + self.tile - 1) // self.tile
+        jobs = []
+        for col in range(tiles_across):
+            x0, x1 = self.tile_span(col, level.width)
+            fn = os.path.join(self.tiles_dir, str(leveli),
+                              "%u_%u.%s" % (col, row, self.format))
+            jobs.append((fn, np.ascontiguousarray(rows[:, x0:x1])))
+        if self.executor:
+            list(self.executor.map(self.save_tile, jobs))
+        else:
+            for job in jobs:
+                self.save_tile(job)
+
+    def close(self):
+        for leveli, level in enumerate(self.levels):
+            assert level.rows == level.height, "Level %u: got %u / %u rows" % (
+                leveli, level.rows, level.height)
+        with open(self.filename, "w") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"'
+                    ' Format="%s" Overlap="%u" TileSize="%u">\n'
+                    '    <Size Width="%u" Height="%u"/>\n'
+                    '</Image>\n' % (self.format, self.overlap, self.tile,
+                                    self.width, self.height))
+
+
+class MosaicRenderer:
+    """
+    Paste images onto a virtual canvas a band of rows at a time
+    Images are decoded in parallel just ahead of the band that needs them
+    and dropped once rendering moves past them
+    Bands are disjoint so several are composited in parallel
+
+    placements: list of dicts with at least "x", "y", "width", "height"
+        pasted in order, so later placements end up on top
+        "warp": optional 2x3 affine matrix from image pixels to placement
+            pixels (ex: rotation). Pixels the image doesn't cover are left
+            as is
+    load: placement => numpy image, defaults to opening placement["filename"]
+    """
+    def __init__(self,
+                 width,
+                 height,
+                 placements,
+                 mode="RGB",
+                 load=None,
+                 band_height=TIFF_TILE,
+                 threads=None):
+        assert mode in ("L", "RGB"), mode
+        self.width = width
+        self.height = height
+        self.placements = placements
+        self.mode = mode
+        if load is None:
+            load = self.load_default
+        self.load = load
+        self.band_height = band_height
+        if threads is None:
+            threads = os.cpu_count() or 1
+        self.threads = threads
+
+    def channels(self):
+        return 1 if self.mode == "L" else 3
+
+    def load_default(self, placement):
+        # Decode now (in the worker thread)
+        with Image.open(placement["filename"]) as im:
+            if im.mode != self.mode:
+                im = im.convert(self.mode)
+            return np.asarray(im)
+
+    def bands(self, executor=None):
+        """
+        Yield (y, rows) numpy arrays top to bottom
+        """
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=self.threads)
+        try:
+            yield from self.bands_executor(executor)
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+    def paste(self, band, band_y0, placement, im):
+        """
+        Paste the part of placement that falls in band
+        """
+        px = placement["x"]
+        py = placement["y"]
+        x0 = max(0, px)
+        x1 = min(self.width, px + placement["width"])
+        y0 = max(band_y0, py)
+        y1 = min(band_y0 + len(band), py + placement["height"])
+        if x1 <= x0 or y1 <= y0:
+            return
+        region = band[y0 - band_y0:y1 - band_y0, x0:x1]
+        warp = placement.get("warp")
+        if warp is None:
+            region[...] = im[y0 - py:y1 - py, x0 - px:x1 - px]
+            return
+        # Shift the warp so region is its origin
+        m = np.array(warp, dtype=np.float64)
+        m[0][2] -= x0 - px
+        m[1][2] -= y0 - py
+        out = np.ascontiguousarray(region)
+        cv2.warpAffine(im,
+                       m, (x1 - x0, y1 - y0),
+                       dst=out,
+                       flags=cv2.INTER_CUBIC,
+                       borderMode=cv2.BORDER_TRANSPARENT)
+        region[...] = out
+
+    def composite_band(self, y0, y1, loaded):
+        """
+        loaded: [(placement, future)] in paste order
+        """
+        if self.mode == "L":
+            band = np.zeros((y1 - y0, self.width), dtype=np.uint8)
+        else:
+            band = np.zeros((y1 - y0, self.width, 3), dtype=np.uint8)
+        for placement, future in loaded:
+            self.paste(band, y0, placement, future.result())
+        return band
+
+    def bands_executor(self, executor):
+        # Schedule in the order rendering needs them
+        order = sorted(range(len(self.placements)),
+                       key=lambda i: self.placements[i]["y"])
+        orderi = 0
+        # placement index => future
+        loaded = {}
+        # Bands being composited: (y, future)
+        compositing = []
+        for y0 in range(0, self.height, self.band_height):
+            y1 = min(y0 + self.band_height, self.height)
+            while orderi < len(order) and self.placements[
+                    order[orderi]]["y"] < y1:
+                placementi = order[orderi]
+                loaded[placementi] = executor.submit(
+                    self.load, self.placements[placementi])
+                orderi += 1
+
+            band_loaded = []
+            for placementi in sorted(loaded.keys()):
+                placement = self.placements[placementi]
+                if placement["y"] < y1 and placement["y"] + placement[
+                        "height"] > y0:
+                    band_loaded.append((placement, loaded[placementi]))
+            compositing.append(
+                (y0, executor.submit(self.composite_band, y0, y1,
+                                     band_loaded)))
+
+            # Done with anything that doesn't reach the next band
+            # (still referenced by bands in flight)
+            for placementi in list(loaded.keys()):
+                placement = self.placements[placementi]
+                if placement["y"] + placement["height"] <= y1:
+                    del loaded[placementi]
+
+            # Keep workers busy on the following bands
+            while len(compositing) > self.threads:
+                y, future = compositing.pop(0)
+                yield y, future.result()
+        for y, future in compositing:
+            yield y, future.result()
+
+    def render(self,
+               tiff_filename,
+               preview_filename=None,
+               preview_max_pixels=2**25,
+               compression="jpeg"):
+        """
+        Write a pyramidal BigTIFF
+        Optionally also save the first pyramid level that fits in
+        preview_max_pixels as a regular image (ex: .jpg)
+        Return the preview PIL image, if any
+        """
+        keep_level = None
+        if preview_filename:
+            keep_level = preview_level(self.width, self.height,
+                                       preview_max_pixels)
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            writer = PyramidTiffWriter(tiff_filename,
+                                       self.width,
+                                       self.height,
+                                       channels=self.channels(),
+                                       compression=compression,
+                                       keep_level=keep_level,
+                                       executor=executor)
+            for _y, rows in self.bands(executor=executor):
+                writer.write_rows(rows)
+            kept = writer.close()
+        if not preview_filename:
+            return None
+        preview = Image.fromarray(kept)
+        preview.save(preview_filename, quality=95)
+        return preview
+
+    def render_deepzoom(self, dzi_filename, tile=254, overlap=1, format="jpg"):
+        """
+        Write a DeepZoom tile pyramid
+        Return the DeepZoomWriter for its geometry
+        """
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            writer = DeepZoomWriter(dzi_filename,
+                                    self.width,
+                                    self.height,
+                                    channels=self.channels(),
+                                    tile=tile,
+                                    overlap=overlap,
+                                    format=format,
+                                    executor=executor)
+            for _y, rows in self.bands(executor=executor):
+                writer.write_rows(rows)
+            writer.close()
+        return writer
@@ -1,10 +1,13 @@
 import time
 import os
 from PIL import Image, UnidentifiedImageError
+import numpy as np
+from multiprocessing import shared_memory
 import subprocess
 import tempfile
 import shutil
 import re
+from uscope.spool import open_spool
 # 2024-02-29: this package keeps being problematic
 try:
     import pyzbar
@@ -17,15 +20,89 @@ except ImportError:
 RC_CONST = 1.21966989
 
 
+def npf2im(statef, depth=8):
+    """
+    Convert a numpy array (typically float) into a PIL image in one step
+    Values are rounded and clamped to the output range
+
+    depth 8
+        HxW => "L"
+        HxWx3 => "RGB"
+    depth 16
+        HxW => "I;16"
+        PIL has no 16 bit RGB mode
+    """
+    if depth == 8:
+        dtype = np.uint8
+    elif depth == 16:
+        dtype = np.uint16
+    else:
+        raise ValueError(f"Bad depth {depth}")
+    statef = np.asarray(statef)
+    if statef.ndim == 2:
+        mode = "L" if depth == 8 else "I;16"
+    elif statef.ndim == 3 and statef.shape[2] == 3:
+        if depth != 8:
+            raise ValueError("16 bit RGB images are not supported")
+        mode = "RGB"
+    else:
+        raise ValueError(f"Bad image shape {statef.shape}")
+
+    if statef.dtype != dtype:
+        vmax = np.iinfo(dtype).max
+        if np.issubdtype(statef.dtype, np.floating):
+            statef = np.round(statef)
+        statef = np.clip(statef, 0, vmax).astype(dtype)
+    return Image.fromarray(statef, mode)
+
+
+def im_to_shm(im):
+    """
+    Copy a PIL image into a new shared memory block
+    Returns (shm, desc) where desc is a small picklable description
+    Caller owns shm and must close() + unlink() it
+    Worker processes should be spawned from the owner so they share its resource tracker
+    Uses PIL's raw encoding, not numpy, as that's what frombytes() expects
+    Ex: mode "1" is packed 8 pixels per byte but numpy uses a byte per pixel
+    """
+    data = im.tobytes()
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    shm.buf[:len(data)] = data
+    desc = {
+        "name": shm.name,
+        "mode": im.mode,
+        "size": im.size,
+        "nbytes": len(data),
+    }
+    return shm, desc
+
+
+def im_from_shm(desc, unlink=False):
+    """
+    Return a PIL image copied out of a shared memory block described by im_to_shm()
+    unlink: also free the block (caller is taking ownership)
+    """
+    shm = shared_memory.SharedMemory(name=desc["name"])
+    try:
+        return Image.frombytes(desc["mode"], tuple(desc["size"]),
+                               shm.buf[:desc["nbytes"]])
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+
 class EtherealImageR:
     """
-    An image that may be on filesystem or in memory
+    An image that may be on filesystem, in memory, or in a frame spool
     User tells it what it wants it will munge it into place
     Read only
+    spool: (spool filename, tile name)
     """
-    def __init__(self, im=None, fn=None, meta=None):
+    def __init__(self, im=None, fn=None, meta=None, spool=None):
         self.im = im
         self.fn = fn
+        self.spool = spool
         self.tmp_files = set()
         self.meta = meta
 
@@ -46,9 +123,28 @@ class EtherealImageR:
         """
         if self.fn:
             return self.fn
+        elif self.spool:
+            # Some plugins shell out and need a real file
+            spool_fn, name = self.spool
+            reader = open_spool(spool_fn)
+            fd, fn = tempfile.mkstemp(prefix=name + "_",
+                                      suffix=reader.extension)
+            os.close(fd)
+            self.tmp_files.add(fn)
+            reader.save(name, fn, quality=95)
+            self.fn = fn
+            return fn
         else:
             assert 0, "FIXME"
 
+    def basename(self):
+        """
+        Tile name for ordering images without creating files
+        """
+        if self.spool:
+            return self.spool[1]
+        return os.path.basename(self.get_filename())
+
     def to_filename(self, fn):
         """
         Make image exist at given location
@@ -58,6 +154,9 @@ class EtherealImageR:
         assert fn not in self.tmp_files
         if self.im:
             self.im.write(fn)
+        elif self.spool and not self.fn:
+            spool_fn, name = self.spool
+            open_spool(spool_fn).save(name, fn)
         else:
             os.symlink(self.fn, fn)
         self.tmp_files.add(fn)
@@ -71,6 +170,9 @@ class EtherealImageR:
             assert os.path.exists(fn)
         elif self.im:
             self.im.write(fn)
+        elif self.spool:
+            spool_fn, name = self.spool
+            open_spool(spool_fn).save(name, fn)
         else:
             assert 0
 
@@ -86,6 +188,9 @@ class EtherealImageR:
         """
         if self.im:
             return self.im
+        elif self.spool:
+            spool_fn, name = self.spool
+            return open_spool(spool_fn).to_im(name)
         else:
             return Image.open(self.fn)
 
@@ -96,7 +201,20 @@ class EtherealImageR:
         if self.im:
             return self.im.copy()
         else:
-            return Image.open(self.fn)
+            return self.to_im()
+
+    def to_np(self):
+        """
+        Return a read only HxWx3 RGB uint8 numpy array
+        Spooled frames are a zero copy view of the spool
+        """
+        if self.spool:
+            spool_fn, name = self.spool
+            return open_spool(spool_fn).get(name)
+        im = self.to_im()
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        return np.asarray(im)
 
 
 class EtherealImageW:
@@ -149,7 +267,20 @@ class EtherealImageW:
     def get_filename(self):
         return self.want_fn
 
+    def write_im(self, im, **kwargs):
+        """
+        Deliver a finished PIL image
+        If the caller asked for an image keep it in memory, skipping the temp file
+        Otherwise save it to the requested filename
+        """
+        if self.want_im:
+            self.im = im
+        else:
+            im.save(self.want_fn, **kwargs)
+
     def get_im(self):
+        if self.im is not None:
+            return self.im
         return Image.open(self.want_fn)
 
 
@@ -1,5 +1,6 @@
 import cv2 as cv
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from uscope.imagep.util import RC_CONST
 from uscope.microscope import StopEvent
 
@@ -44,6 +45,243 @@ def choose_best_image(images_iter, log=None, verbose=False):
     return k, fni
 
 
+def focus_roi_gray(im, roi=1 / 3, downsample=1):
+    """
+    Return the center roi fraction of the image as uint8 grayscale
+    im: PIL image or RGB numpy array
+    Optionally shrunk by downsample to reduce scoring cost
+    """
+    im_np = np.asarray(im)
+    height, width = im_np.shape[0:2]
+    left = int((width - width * roi) / 2)
+    top = int((height - height * roi) / 2)
+    right = int((width + width * roi) / 2)
+    bottom = int((height + height * roi) / 2)
+    ret = im_np[top:bottom, left:right]
+    if ret.ndim == 3:
+        ret = cv.cvtColor(ret, cv.COLOR_RGB2GRAY)
+    if downsample > 1:
+        ret = cv.resize(ret, ((right - left) // downsample,
+                              (bottom - top) // downsample),
+                        interpolation=cv.INTER_AREA)
+    return ret
+
+
+"""
+Focus metrics
+Take a uint8 grayscale image and return a score where higher is better focused
+downsample is how much the image was shrunk relative to the sensor
+and can be used to scale filter sizes
+"""
+
+
+def focus_metric_laplacian(im_gray, downsample=1):
+    """
+    Median blurred Laplacian variance
+    Original pyuscope metric: robust to sensor noise
+    """
+    # Scale the original 9 pixel full resolution noise filter to the ROI
+    blur = max(3, (9 // downsample) | 1)
+    filtered = cv.medianBlur(im_gray, blur)
+    laplacian = cv.Laplacian(filtered, cv.CV_32F)
+    return float(laplacian.var())
+
+
+def focus_metric_tenengrad(im_gray, downsample=1):
+    """
+    Mean squared Sobel gradient magnitude
+    """
+    gx = cv.Sobel(im_gray, cv.CV_32F, 1, 0, ksize=3)
+    gy = cv.Sobel(im_gray, cv.CV_32F, 0, 1, ksize=3)
+    return float(np.mean(gx * gx + gy * gy))
+
+
+def focus_metric_normalized_variance(im_gray, downsample=1):
+    """
+    Intensity variance normalized by mean brightness
+    Cheap and insensitive to exposure changes, but weak on low contrast samples
+    """
+    mean, stddev = cv.meanStdDev(im_gray)
+    mean = float(mean[0][0])
+    if mean == 0:
+        return 0.0
+    return float(stddev[0][0])**2 / mean
+
+
+def focus_metric_brenner(im_gray, downsample=1):
+    """
+    Mean squared difference between pixels two columns apart
+    """
+    diff = im_gray[:, 2:].astype(np.int16) - im_gray[:, :-2]
+    return float(np.mean(diff.astype(np.float32)**2))
+
+
+def focus_metric_fft(im_gray, downsample=1, cutoff=0.1):
+    """
+    Fraction of spectral energy above cutoff (fraction of Nyquist)
+    """
+    im_f = im_gray.astype(np.float32)
+    mag = np.abs(np.fft.rfft2(im_f - im_f.mean()))
+    fy = np.abs(np.fft.fftfreq(im_gray.shape[0]))[:, None]
+    fx = np.fft.rfftfreq(im_gray.shape[1])[None, :]
+    # Frequencies are in cycles / pixel, Nyquist is 0.5
+    high = (fx * fx + fy * fy) > (cutoff * 0.5)**2
+    total = float(mag.sum())
+    if total == 0:
+        return 0.0
+    return float(mag[high].sum()) / total
+
+
+FOCUS_METRICS = {
+    "laplacian": focus_metric_laplacian,
+    "tenengrad": focus_metric_tenengrad,
+    "normalized-variance": focus_metric_normalized_variance,
+    "brenner": focus_metric_brenner,
+    "fft": focus_metric_fft,
+}
+
+
+def get_focus_metric(name):
+    ret = FOCUS_METRICS.get(name)
+    if ret is None:
+        raise ValueError("Unknown focus metric %s. Valid: %s" %
+                         (name, ", ".join(FOCUS_METRICS.keys())))
+    return ret
+
+
+def focus_score(im, roi=1 / 3, downsample=1, metric="laplacian"):
+    """
+    Score the center of the image using the given focus metric
+    im: PIL image or RGB numpy array
+    Higher is better focused
+    """
+    im_gray = focus_roi_gray(im, roi=roi, downsample=downsample)
+    return get_focus_metric(metric)(im_gray, downsample=downsample)
+
+
+class FocusScorer:
+    """
+    Score autofocus frames on a worker pool
+    Lets the stage move to the next position while the previous frame is scored
+    OpenCV releases the GIL so threads are enough
+
+    Frames must be submitted in sweep order for early stopping to work
+    """
+    def __init__(self,
+                 nthreads=2,
+                 downsample=2,
+                 roi=1 / 3,
+                 metric="laplacian",
+                 early_stop=False,
+                 patience=2,
+                 drop=0.2):
+        # Fail early on a bad config
+        get_focus_metric(metric)
+        self.executor = ThreadPoolExecutor(max_workers=nthreads)
+        self.downsample = downsample
+        self.metric = metric
+        self.roi = roi
+        self.early_stop = early_stop
+        # Need this many frames after the peak...
+        self.patience = patience
+        # ...each scoring this fraction below it
+        self.drop = drop
+        # (imagek, future) in submission order
+        self.futures = []
+        # Scores completed so far, in submission order
+        self.scores = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for _imagek, future in self.futures:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+    def submit(self, imagek, im):
+        future = self.executor.submit(focus_score,
+                                      im,
+                                      roi=self.roi,
+                                      downsample=self.downsample,
+                                      metric=self.metric)
+        self.futures.append((imagek, future))
+
+    def poll(self):
+        """
+        Collect completed scores without blocking
+        """
+        while len(self.scores) < len(self.futures):
+            _imagek, future = self.futures[len(self.scores)]
+            if not future.done():
+                break
+            self.scores.append(future.result())
+
+    def passed_peak(self):
+        """
+        True if the score curve has clearly gone over its peak
+        Only considers frames already scored
+        """
+        if not self.early_stop:
+            return False
+        self.poll()
+        if len(self.scores) <= self.patience:
+            return False
+        peaki = int(np.argmax(self.scores))
+        after = self.scores[peaki + 1:]
+        if len(after) < self.patience:
+            return False
+        threshold = self.scores[peaki] * (1 - self.drop)
+        return all(score < threshold for score in after[-self.patience:])
+
+    def best(self):
+        """
+        Wait for all frames to be scored
+        Return (imagek, index) of the best focused frame
+        """
+        for _imagek, future in self.futures[len(self.scores):]:
+            self.scores.append(future.result())
+        fni = int(np.argmax(self.scores))
+        return self.futures[fni][0], fni
+
+    def scored(self):
+        """
+        Return [(imagek, score)] for frames scored so far
+        """
+        self.poll()
+        return [(imagek, score)
+                for (imagek, _future), score in zip(self.futures, self.scores)]
+
+
+# Search strategies for Autofocus.coarse()
+# sweep: coarse sweep then fine sweep (original algorithm)
+# coarse-fine: coarse sweep then repeatedly narrow around the best point
+# golden: golden-section search over the coarse sweep range
+# parabolic: coarse sweep then parabolic interpolation of the peak
+AUTOFOCUS_SEARCHES = ("sweep", "coarse-fine", "golden", "parabolic")
+
+GOLDEN_RATIO = (5**0.5 - 1) / 2
+
+
+def parabolic_peak(x0, y0, x1, y1, x2, y2):
+    """
+    Vertex of the parabola through three equally spaced points
+    Assumes y1 is the largest
+    """
+    h = x1 - x0
+    denom = y0 - 2 * y1 + y2
+    if denom >= 0:
+        # Flat or not a maximum
+        return x1
+    offset = h * (y0 - y2) / (2 * denom)
+    # Vertex should be between the outer points
+    offset = max(-h, min(h, offset))
+    return x1 + offset
+
+
 class Autofocus:
     # FIXME: pass in a Microscope object w/ correct / thread safe objects
     def __init__(self,
@@ -61,17 +299,59 @@ class Autofocus:
         self.imager = imager
         self.kinematics = kinematics
         self.poll = poll
+        self.verbose = False
+        # Stage moves during the current autofocus
+        # Settling after each is the dominant cost
+        self.moves = 0
+        # Machine z step => score
+        self.score_cache = {}
 
     def move_absolute_wait(self, pos):
         self.move_absolute(pos, block=True)
         self.kinematics.wait_autofocus()
+        self.moves += 1
+
+    def poll_all(self, se):
+        se.poll()
+        if self.poll:
+            self.poll()
+
+    def z_epsilon(self):
+        return self.kinematics.microscope.motion.epsilon()["z"]
+
+    def z_key(self, z):
+        return int(round(z / self.z_epsilon()))
+
+    def round_z(self, z):
+        """
+        Round to a position the machine can actually move to
+        """
+        return self.z_key(z) * self.z_epsilon()
+
+    def measure(self, se, z, metric):
+        """
+        Return focus score at z, moving there if not already scored
+        """
+        k = self.z_key(z)
+        ret = self.score_cache.get(k)
+        if ret is not None:
+            return ret
+        self.poll_all(se)
+        self.move_absolute_wait({"z": self.round_z(z)})
+        ret = focus_score(
+            self.imager.get().to_np(),
+            downsample=self.microscope.usc.autofocus.downsample(),
+            metric=metric)
+        self.score_cache[k] = ret
+        return ret
 
     def auto_focus_pass(self,
                         se,
                         step_size,
                         step_pm,
                         move_target=True,
-                        start_pos=None):
+                        start_pos=None,
+                        metric=None):
         """
         for outer_i in range(3):
             self.log("autofocus: try %u / 3" % (outer_i + 1,))
@@ -88,29 +368,33 @@ class Autofocus:
             start_pos = self.pos()["z"]
         steps = step_pm * 2 + 1
 
-        # Doing generator allows easier to process images as movement is done / settling
-        def gen_images():
+        self.poll_all(se)
+        config = self.microscope.usc.autofocus
+        if metric is None:
+            metric = config.metric()
+        moves_start = self.moves
+        with FocusScorer(nthreads=config.scoring_threads(),
+                         downsample=config.downsample(),
+                         metric=metric,
+                         early_stop=config.early_stop()) as scorer:
             for focusi in range(steps):
-                se.poll()
-                if self.poll:
-                    self.poll()
+                self.poll_all(se)
                 # FIXME: use backlash compensation direction here
                 target_pos = start_pos + -(focusi - step_pm) * step_size
                 0 and self.log("autofocus round %u / %u: try %0.6f" %
                                (focusi + 1, steps, target_pos))
                 self.move_absolute_wait({"z": target_pos})
-                im_pil = self.imager.get().image
-                yield target_pos, im_pil
-
-        se.poll()
-        if self.poll:
-            self.poll()
-        target_pos, fni = choose_best_image(gen_images())
-        self.log("autofocus: set %0.6f at %u / %u" %
-                 (target_pos, fni + 1, steps))
-        se.poll()
-        if self.poll:
-            self.poll()
+                # Scored in the background while the stage moves on
+                scorer.submit(target_pos, self.imager.get().to_np())
+                if scorer.passed_peak():
+                    self.log("autofocus: passed peak, stopping early")
+                    break
+            target_pos, fni = scorer.best()
+            for imagek, score in scorer.scored():
+                self.score_cache[self.z_key(imagek)] = score
+        self.log("autofocus: set %0.6f at %u / %u (%u moves)" %
+                 (target_pos, fni + 1, steps, self.moves - moves_start))
+        self.poll_all(se)
         if move_target:
             self.move_absolute_wait({"z": target_pos})
         return target_pos
@@ -141,23 +425,150 @@ class Autofocus:
             "step_pm": 3,
         }
 
-    def coarse(self, objective_config):
+    def objective_metric(self, objective_config):
+        """
+        Objectives may override the microscope default focus metric
+        Ex: low magnification objectives may do better with tenengrad
+        """
+        return objective_config.get("autofocus_metric",
+                                    self.microscope.usc.autofocus.metric())
+
+    def objective_search(self, objective_config):
+        return objective_config.get("autofocus_search",
+                                    self.microscope.usc.autofocus.search())
+
+    def search_sweep(self, se, objective_config, metric):
+        self.log("autofocus: coarse")
+        parameters = self.coarse_parameters(objective_config)
+        coarse_z = self.auto_focus_pass(se,
+                                        step_size=parameters["step_size"],
+                                        step_pm=parameters["step_pm"],
+                                        move_target=False,
+                                        metric=metric)
+        self.log("autofocus: fine")
+        parameters = self.fine_parameters(objective_config)
+        return self.auto_focus_pass(se,
+                                    step_size=parameters["step_size"],
+                                    step_pm=parameters["step_pm"],
+                                    start_pos=coarse_z,
+                                    move_target=False,
+                                    metric=metric)
+
+    def search_coarse_fine(self, se, objective_config, metric):
+        """
+        Coarse sweep then check either side of the best point
+        at 1/3 the step size until reaching the fine step size
+        Each level costs at most two moves
+        """
+        self.log("autofocus: coarse")
+        parameters = self.coarse_parameters(objective_config)
+        step = parameters["step_size"]
+        best_z = self.auto_focus_pass(se,
+                                      step_size=step,
+                                      step_pm=parameters["step_pm"],
+                                      move_target=False,
+                                      metric=metric)
+        fine_step = self.fine_parameters(objective_config)["step_size"]
+        while step > fine_step:
+            step = max(fine_step, self.round_z(step / 3))
+            candidates = [best_z - step, best_z, best_z + step]
+            scores = [self.measure(se, z, metric) for z in candidates]
+            best_z = candidates[int(np.argmax(scores))]
+            self.log("autofocus: step %0.6f => %0.6f" % (step, best_z))
+        return best_z
+
+    def search_golden(self, se, objective_config, metric):
+        """
+        Golden-section search over the coarse sweep range
+        Assumes the focus curve is unimodal within the range
+        """
+        parameters = self.coarse_parameters(objective_config)
+        fine_step = self.fine_parameters(objective_config)["step_size"]
+        center = self.pos()["z"]
+        distance = parameters["step_size"] * parameters["step_pm"]
+        lo = center - distance
+        hi = center + distance
+        # Interior points, rounded so cache hits work as the bracket shrinks
+        z1 = self.round_z(hi - GOLDEN_RATIO * (hi - lo))
+        z2 = self.round_z(lo + GOLDEN_RATIO * (hi - lo))
+        s1 = self.measure(se, z1, metric)
+        s2 = self.measure(se, z2, metric)
+        # Rounding to machine steps can stall convergence, so bound iterations
+        for _i in range(32):
+            if hi - lo <= fine_step or z1 >= z2:
+                break
+            if s1 >= s2:
+                hi = z2
+                z2, s2 = z1, s1
+                z1 = self.round_z(hi - GOLDEN_RATIO * (hi - lo))
+                s1 = self.measure(se, z1, metric)
+            else:
+                lo = z1
+                z1, s1 = z2, s2
+                z2 = self.round_z(lo + GOLDEN_RATIO * (hi - lo))
+                s2 = self.measure(se, z2, metric)
+            self.verbose and self.log("autofocus: bracket %0.6f to %0.6f" %
+                                      (lo, hi))
+        if s1 >= s2:
+            return z1
+        else:
+            return z2
+
+    def search_parabolic(self, se, objective_config, metric):
+        """
+        Coarse sweep then fit a parabola through the peak and its neighbors
+        Gets sub step precision without a fine sweep
+        """
+        self.log("autofocus: coarse")
+        parameters = self.coarse_parameters(objective_config)
+        step = parameters["step_size"]
+        best_z = self.auto_focus_pass(se,
+                                      step_size=step,
+                                      step_pm=parameters["step_pm"],
+                                      move_target=False,
+                                      metric=metric)
+        lo = self.score_cache.get(self.z_key(best_z - step))
+        hi = self.score_cache.get(self.z_key(best_z + step))
+        if lo is None or hi is None:
+            # Peak at edge of sweep (or stopped early before the far side)
+            self.log("autofocus: peak not bracketed, skipping interpolation")
+            return best_z
+        peak = self.score_cache[self.z_key(best_z)]
+        # Focus curves are closer to Gaussian than parabolic
+        # so fit in log space
+        lo, peak, hi = [np.log(max(score, 1e-12)) for score in (lo, peak, hi)]
+        return self.round_z(
+            parabolic_peak(best_z - step, lo, best_z, peak, best_z + step, hi))
+
+    def coarse(self, objective_config, search=None):
+        """
+        Focus at the current position
+        search: one of AUTOFOCUS_SEARCHES
+        Default from objective config "autofocus_search" then microscope config
+        """
+        if search is None:
+            search = self.objective_search(objective_config)
+        searches = {
+            "sweep": self.search_sweep,
+            "coarse-fine": self.search_coarse_fine,
+            "golden": self.search_golden,
+            "parabolic": self.search_parabolic,
+        }
+        search_func = searches.get(search)
+        if search_func is None:
+            raise ValueError("Unknown autofocus search %s" % (search, ))
         with StopEvent(self.microscope) as se:
             # MVP intended for 20x
             # 2 um is standard focus step size
-            self.log("autofocus: coarse")
-            parameters = self.coarse_parameters(objective_config)
-            coarse_z = self.auto_focus_pass(se,
-                                            step_size=parameters["step_size"],
-                                            step_pm=parameters["step_pm"],
-                                            move_target=False)
-            self.log("autofocus: fine")
-            parameters = self.fine_parameters(objective_config)
-            self.auto_focus_pass(se,
-                                 step_size=parameters["step_size"],
-                                 step_pm=parameters["step_pm"],
-                                 start_pos=coarse_z)
-            self.log("autofocus: done")
+            self.moves = 0
+            self.score_cache = {}
+            metric = self.objective_metric(objective_config)
+            target_z = search_func(se, objective_config, metric)
+            self.poll_all(se)
+            self.move_absolute_wait({"z": target_z})
+            self.log("autofocus: done, %s set %0.6f in %u moves" %
+                     (search, target_z, self.moves))
+            return target_z
 
 
 class AutoStacker:
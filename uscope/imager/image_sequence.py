@@ -1,4 +1,5 @@
 import threading
+import numpy as np
 from PIL import Image
 """
 PIL im objects are core
@@ -7,12 +8,46 @@ However EXIF and stuff isn't written until end in some API contexts
 
 
 class CapturedImage:
-    def __init__(self, image, meta=None, exif_bytes=None, microscope=None):
-        self.image = image
+    def __init__(self,
+                 image=None,
+                 meta=None,
+                 exif_bytes=None,
+                 microscope=None,
+                 array=None):
+        """
+        image: PIL image
+        array: RGB uint8 numpy array (height, width, 3)
+        Either may be given, the other form is created on demand
+        """
+        assert image is not None or array is not None
+        self._image = image
+        self._array = array
         self.meta = meta
         self.exif_bytes = exif_bytes
         self.microscope = microscope
 
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = Image.fromarray(self._array)
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        # Array form is now stale
+        self._array = None
+
+    def to_np(self):
+        """
+        Return image as an RGB uint8 numpy array
+        Doesn't touch PIL if captured as an array
+        Treat as read only: may share memory with the capture
+        """
+        if self._array is None:
+            self._array = np.asarray(self._image)
+        return self._array
+
     def save(self, fn, **kwargs):
         if self.exif_bytes is not None:
             kwargs["exif"] = self.exif_bytes
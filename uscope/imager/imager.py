@@ -153,7 +153,11 @@ class MockImager(Imager):
     def get(self):
         # Small test image
         return CapturedImage(
-            im=Image.new("RGB", (self.width, self.height), 'white'))
+            image=Image.new("RGB", (self.width, self.height), 'white'))
+
+    def get_by_mode(self, mode=None, **kwargs):
+        # No processing pipeline: every mode is the raw frame
+        return self.get()
 
     def _set_properties(self, vals):
         for k, v in vals.items():
@@ -1,5 +1,6 @@
 from uscope.gui.imager import GstGUIImager
 from uscope.gui.gstwidget import SinkxZoomableWidget
+from PIL import Image
 
 
 class ArgusImagerPlugin:
@@ -56,5 +57,13 @@ class ArgusGstImagerPlugin(ArgusImagerPlugin):
     def get_imager(self):
         return GstGUIImager(self.ac)
 
-    def gst_decode_image(self, image_dict):
+    def gst_decode_array(self, image_dict):
+        """
+        Return the captured frame as an RGB uint8 numpy array (height, width, 3)
+        image_dict["array"] is the raw frame as a flat uint8 array
+        Avoid copying when the raw format is already RGB
+        """
         assert 0, "Required"
+
+    def gst_decode_image(self, image_dict):
+        return Image.fromarray(self.gst_decode_array(image_dict))
@@ -1,6 +1,5 @@
 from uscope.imager.plugins.aplugin import ArgusGstImagerPlugin
 from .widgets import TTControlScroll
-from PIL import Image
 
 import gi
 
@@ -59,8 +58,8 @@ class Plugin(ArgusGstImagerPlugin):
                 return "gst-toupcamsrc"
         '''
 
-    def gst_decode_image(self, image_dict):
-        buf = image_dict["bytes"]
+    def gst_decode_array(self, image_dict):
+        buf = image_dict["array"]
         width = image_dict["width"]
         height = image_dict["height"]
         # xxx: sometimes get too much data...is this the right fix?
@@ -70,5 +69,5 @@ class Plugin(ArgusGstImagerPlugin):
             (width * height * 3, len(buf), width, height))
         # Need 59535360 bytes, got 59535360
         # print("Need %u bytes, got %u" % (3 * width * height, len(buf)))
-        return Image.frombytes('RGB', (width, height), bytes(buf), 'raw',
-                               'RGB')
+        # Already RGB: view, no copy
+        return buf.reshape((height, width, 3))
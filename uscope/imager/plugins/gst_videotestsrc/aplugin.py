@@ -2,8 +2,6 @@ from uscope.imager.plugins.aplugin import ArgusGstImagerPlugin
 from uscope.imager.plugins.gst_videotestsrc.widgets import TestSrcScroll
 # from uscope.imager.plugins.gst_videotestsrc.widgets import TestSrcScroll
 import cv2
-import numpy as np
-from PIL import Image
 
 import gi
 
@@ -30,14 +28,12 @@ class Plugin(ArgusGstImagerPlugin):
         # self.verbose and print('WARNING: using test source')
         return Gst.ElementFactory.make('videotestsrc', name)
 
-    def gst_decode_image(self, image_dict):
-        buf = image_dict["bytes"]
+    def gst_decode_array(self, image_dict):
+        buf = image_dict["array"]
         width = image_dict["width"]
         height = image_dict["height"]
         w = width
         h = height
         shape = (h, w, 4)
-        rgba = np.frombuffer(buf, dtype=np.uint8)
-        rgba = rgba.reshape(shape)
-        rgb = cv2.cvtColor(rgba, cv2.COLOR_BGRA2RGB)
-        return Image.fromarray(rgb)
+        rgba = buf.reshape(shape)
+        return cv2.cvtColor(rgba, cv2.COLOR_BGRA2RGB)
@@ -45,24 +45,24 @@ class ImagerControlThreadBase:
         take_center = True
         # XXX: I think exposure is actually on here
         capim = self.microscope.imager_ts().get()
-        im_pil = capim.image
+        # Avoid PIL: frame is captured as an array
+        im_np = capim.to_np()
         # exposure_now = self.microscope.imager.get_exposure_cache()
         exposure_now = capim.exposure()
         #if self._exposure_last is None:
         #    self._exposure_last = exposure_now
 
         if take_center:
-            width, height = im_pil.size
+            height, width = im_np.shape[0:2]
 
-            left = (width - width / 3) / 2
-            top = (height - height / 3) / 2
-            right = (width + width / 3) / 2
-            bottom = (height + height / 3) / 2
+            left = int((width - width / 3) / 2)
+            top = int((height - height / 3) / 2)
+            right = int((width + width / 3) / 2)
+            bottom = int((height + height / 3) / 2)
 
-            # Crop the center of the image
-            im_pil = capim.image.crop((left, top, right, bottom))
+            # Crop the center of the image (view, no copy)
+            im_np = im_np[top:bottom, left:right]
 
-        im_np = np.array(im_pil)
         """
         If image is half as bright as it should be,
         double the exposure
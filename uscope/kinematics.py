@@ -1,12 +1,50 @@
 import time
+import collections
+import cv2
+import numpy as np
 from uscope.util import LogTimer
 
 
+class SettleStats:
+    """
+    Adaptive settle times observed for one objective
+    """
+    def __init__(self, n=32):
+        self.times = collections.deque(maxlen=n)
+        self.timeouts = 0
+
+    def add(self, t):
+        self.times.append(t)
+
+    def add_timeout(self):
+        self.timeouts += 1
+
+    def min_wait(self):
+        """
+        Time after moving that frames are almost certainly still moving
+        No point in grabbing frames before then
+        """
+        if len(self.times) < 4:
+            return 0.0
+        return 0.75 * min(self.times)
+
+    def to_dict(self):
+        ret = {
+            "n": len(self.times),
+            "timeouts": self.timeouts,
+        }
+        if len(self.times):
+            ret["mean"] = float(np.mean(self.times))
+            ret["max"] = max(self.times)
+        return ret
+
+
 class Kinematics:
     def __init__(
         self,
         microscope=None,
         log=None,
+        settle_stats=None,
     ):
         self.microscope = microscope
         self.verbose = False
@@ -16,11 +54,19 @@ class Kinematics:
                 print(s)
 
         self.log = log
+        # objective name => SettleStats
+        # Pass in to keep learning across instances
+        if settle_stats is None:
+            settle_stats = {}
+        self.settle_stats = settle_stats
+        self.objective = None
+        self.settle_window = None
 
     def configure(self,
                   tsettle_motion=None,
                   tsettle_hdr=None,
-                  tsettle_autofocus=None):
+                  tsettle_autofocus=None,
+                  settle_mode=None):
         # some CLI apps don't require these
         # assert self.microscope.imager
         # assert self.microscope.motion
@@ -42,6 +88,17 @@ class Kinematics:
         self.should_frame_sync = self.microscope.usc.kinematics.frame_sync()
         self.tsettle_video_pipeline = 3.0
 
+        if settle_mode is None:
+            settle_mode = self.microscope.usc.kinematics.settle_mode()
+        self.settle_mode = settle_mode
+        self.settle_width = self.microscope.usc.kinematics.settle_width()
+        self.settle_shift_pix = self.microscope.usc.kinematics.settle_shift_pix(
+        )
+        self.settle_exposure_tolerance = self.microscope.usc.kinematics.settle_exposure_tolerance(
+        )
+        self.settle_still_frames = self.microscope.usc.kinematics.settle_still_frames(
+        )
+
         # self.diagnostic_info()
 
     # May be updated as objective is changed
@@ -54,6 +111,90 @@ class Kinematics:
     def set_tsettle_autofocus(self, tsettle_autofocus):
         self.tsettle_autofocus = tsettle_autofocus
 
+    def set_objective(self, objective):
+        """
+        Objective name
+        Adaptive settle statistics are kept per objective
+        """
+        self.objective = objective
+
+    def get_settle_stats(self):
+        return self.settle_stats.setdefault(self.objective, SettleStats())
+
+    def settle_frame(self):
+        """
+        Grab a new live frame as a small grayscale image
+        """
+        im = self.microscope.imager_ts().get().to_np()
+        # Fresh frame after the change: no need to frame sync
+        self.last_frame_sync = time.time()
+        if im.ndim == 3:
+            im = cv2.cvtColor(im, cv2.COLOR_RGB2GRAY)
+        scale = self.settle_width / im.shape[1]
+        if scale < 1.0:
+            im = cv2.resize(im, (0, 0),
+                            fx=scale,
+                            fy=scale,
+                            interpolation=cv2.INTER_AREA)
+        return im.astype(np.float32)
+
+    def frames_settled(self, prev, cur, exposure=False):
+        """
+        Are two consecutive frames the same within tolerance?
+        exposure: also require mean brightness to be stable
+        """
+        if exposure:
+            prev_mean = float(prev.mean())
+            if abs(float(cur.mean()) -
+                   prev_mean) > self.settle_exposure_tolerance * max(
+                       prev_mean, 1.0):
+                return False
+        if self.settle_window is None or self.settle_window.shape != cur.shape:
+            # Window suppresses the edge discontinuity
+            self.settle_window = cv2.createHanningWindow(
+                (cur.shape[1], cur.shape[0]), cv2.CV_32F)
+        # Some OpenCV versions apply the window in place: frames get reused
+        (dx, dy), _response = cv2.phaseCorrelate(prev.copy(), cur.copy(),
+                                                 self.settle_window)
+        return (dx * dx + dy * dy)**0.5 < self.settle_shift_pix
+
+    def wait_settle(self, tsettle, since_change, exposure=False, stats=None):
+        """
+        Adaptive settle: wait until consecutive live frames agree
+        Gives up once tsettle has passed since the change
+        since_change: function returning seconds since the motion / property change
+        stats: SettleStats to learn from
+        Return settle time or None if timed out
+        """
+        if stats is not None:
+            tmin = min(stats.min_wait(), tsettle) - since_change()
+            if tmin > 0.0:
+                self.sleep(tmin)
+        prev = self.settle_frame()
+        still = 0
+        while since_change() < tsettle:
+            cur = self.settle_frame()
+            if self.frames_settled(prev, cur, exposure=exposure):
+                still += 1
+            else:
+                still = 0
+            prev = cur
+            if still >= self.settle_still_frames:
+                t = since_change()
+                self.verbose and self.log("kinematics settled in %0.3f" %
+                                          (t, ))
+                if stats is not None:
+                    stats.add(t)
+                return t
+        self.verbose and self.log("kinematics settle timed out after %0.3f" %
+                                  (tsettle, ))
+        if stats is not None:
+            stats.add_timeout()
+        return None
+
+    def adaptive(self):
+        return self.settle_mode == "adaptive" and self.microscope.imager is not None
+
     def sleep(self, t):
         self.verbose and self.log("kinematics sleep %0.3f" % t)
         time.sleep(t)
@@ -61,8 +202,11 @@ class Kinematics:
     def wait_video_pipeline(self):
         if self.microscope.imager is None or self.tsettle_video_pipeline <= 0:
             return
-        tsettle = self.tsettle_video_pipeline - self.microscope.imager.since_last_restart(
-        )
+        since_last_restart = self.microscope.imager.since_last_restart()
+        # Never restarted
+        if since_last_restart is None:
+            return
+        tsettle = self.tsettle_video_pipeline - since_last_restart
         if tsettle > 0.0:
             self.log(
                 "Kinematics sleeping due to video pipeline restart: %0.3f" %
@@ -76,6 +220,11 @@ class Kinematics:
         )
         self.verbose and self.log(
             "FIXME TMP: this tsettle_motion: %0.3f" % tsettle)
+        if tsettle > 0.0 and self.adaptive():
+            self.wait_settle(self.tsettle_motion,
+                             self.microscope.motion.since_last_motion,
+                             stats=self.get_settle_stats())
+            return
         if tsettle > 0.0:
             self.sleep(tsettle)
 
@@ -86,6 +235,11 @@ class Kinematics:
         )
         self.verbose and self.log(
             "FIXME TMP: this tsettle_hdr: %0.3f" % tsettle)
+        if tsettle > 0.0 and self.adaptive():
+            self.wait_settle(self.tsettle_hdr,
+                             self.microscope.imager.since_properties_change,
+                             exposure=True)
+            return
         if tsettle > 0.0:
             self.sleep(tsettle)
 
@@ -98,6 +252,10 @@ class Kinematics:
             return
         tsettle = self.tsettle_autofocus - self.microscope.motion.since_last_motion(
         )
+        if tsettle > 0.0 and self.adaptive():
+            self.wait_settle(self.tsettle_autofocus,
+                             self.microscope.motion.since_last_motion)
+            return
         if tsettle > 0.0:
             self.sleep(tsettle)
 
@@ -152,3 +310,7 @@ class Kinematics:
         log(indent + "tsettle_autofocus: %0.3f" % self.tsettle_autofocus)
         log(indent +
             "tsettle_video_pipeline: %0.3f" % self.tsettle_video_pipeline)
+        log(indent + "settle_mode: %s" % self.settle_mode)
+        if verbose:
+            for objective, stats in self.settle_stats.items():
+                log(indent + "settle %s: %s" % (objective, stats.to_dict()))
@@ -16,6 +16,8 @@ import serial
 import time
 import os
 import threading
+import collections
+import queue
 import glob
 import struct
 import hashlib
@@ -46,6 +48,11 @@ class NoGRBL(GrblException):
     pass
 
 
+# GRBL 1.1 has a 128 byte serial RX buffer
+# Streaming keeps one byte spare as recommended by the GRBL streaming docs
+GRBL_RX_BUFFER_SIZE = 127
+
+
 def default_port():
     port = os.getenv("GRBL_PORT", None)
     if port:
@@ -260,6 +267,211 @@ def print_configs(l, log=print):
         print_config(s, prefix="", log=log)
 
 
+class GrblStatus:
+    """
+    Parsed status report
+    <Idle|MPos:0.000,0.000,0.000|FS:0,0|WCO:0.000,0.000,0.000>
+    """
+    def __init__(self, raw, t=None):
+        """
+        raw: status line with or without the <> markers
+        Raises ValueError on a garbled line
+        """
+        if raw and raw[0] == "<":
+            raw = trim_status_line(raw)
+        self.raw = raw
+        # When the report was received
+        self.t = t if t is not None else time.time()
+        parts = raw.split("|")
+        # Idle, Jog, Run, Hold:0, Alarm, etc
+        self.state = parts[0]
+        if not self.state:
+            raise ValueError("bad status line: %s" % (raw, ))
+        self.fields = {}
+        for part in parts[1:]:
+            # Strict: extra colons indicate dropped characters
+            k, v = part.split(":")
+            if k == "MPos":
+                v = [float(x) for x in v.split(",")]
+                v = dict(zip("xyz", v))
+            self.fields[k] = v
+        self.mpos = self.fields.get("MPos")
+
+    def idle(self):
+        return self.state == "Idle"
+
+    def to_dict(self):
+        """
+        GRBL.qstatus() format
+        """
+        ret = {
+            "status": self.state,
+        }
+        for k, v in self.fields.items():
+            if k == "MPos":
+                v = dict(v)
+            ret[k] = v
+        return ret
+
+
+class GrblStatusReader:
+    """
+    Owns the serial RX side of a GRBLSer
+    -Polls status (?) at poll_hz and publishes parsed GrblStatus objects
+    -Everything else (ok, error, data, messages) is queued for readline()
+
+    Status waiters wake up on the next report instead of sleep polling
+    and status callbacks no longer compete with command traffic
+    """
+    def __init__(self, gs, poll_hz=20.0):
+        assert poll_hz > 0, poll_hz
+        self.gs = gs
+        self.poll_hz = poll_hz
+        self.period = 1.0 / poll_hz
+        self.lines = queue.Queue()
+        self.cond = threading.Condition()
+        # Most recent GrblStatus
+        self.status = None
+        # Incremented on each report
+        self.status_seq = 0
+        self.bad_status = 0
+        self.status_cbs = []
+        # Exception that stopped the thread, if any
+        self.error = None
+        self.running = threading.Event()
+        self.thread = None
+
+    def register_status_cb(self, cb):
+        """
+        cb(GrblStatus) is called from the reader thread
+        Keep it short
+        """
+        self.status_cbs.append(cb)
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self.run,
+                                       name="GrblStatusReader",
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(1.0)
+        self.thread = None
+
+    def publish(self, status):
+        with self.cond:
+            self.status = status
+            self.status_seq += 1
+            self.cond.notify_all()
+        for cb in self.status_cbs:
+            try:
+                cb(status)
+            except Exception as e:
+                self.gs.verbose and print(
+                    "WARNING: status callback failed: %s" % (e, ))
+
+    def run(self):
+        tnext = time.time()
+        try:
+            while self.running.is_set():
+                if time.time() >= tnext:
+                    self.gs.txb(b"?")
+                    tnext = time.time() + self.period
+                l = self.gs.rx_line()
+                if not l:
+                    continue
+                self.gs.verbose and print("rx '%s'" % (l, ))
+                if l[0] == "<" and l[-1] == ">":
+                    try:
+                        status = GrblStatus(l)
+                    except ValueError:
+                        # Corrupted report, next one is only a period away
+                        self.bad_status += 1
+                        continue
+                    self.publish(status)
+                else:
+                    self.lines.put(l)
+        except Exception as e:
+            self.error = e
+            # Wake up waiters so they see the error
+            with self.cond:
+                self.cond.notify_all()
+
+    def check(self):
+        if self.error is not None:
+            raise GrblException("Status reader failed: %s" % (self.error, ))
+
+    def readline(self, timeout=None):
+        """
+        Next non-status line or "" on timeout
+        """
+        try:
+            return self.lines.get(timeout=timeout)
+        except queue.Empty:
+            self.check()
+            return ""
+
+    def latest(self):
+        return self.status
+
+    def wait_status(self, after_seq=None, timeout=1.0):
+        """
+        Wait for a status report newer than after_seq
+        (default: any report received after this call)
+        """
+        with self.cond:
+            if after_seq is None:
+                after_seq = self.status_seq
+            tstart = time.time()
+            while self.status_seq <= after_seq:
+                self.check()
+                remaining = timeout - (time.time() - tstart)
+                if remaining <= 0:
+                    raise Timeout(
+                        f"Timed out after {timeout} sec waiting for status")
+                self.cond.wait(remaining)
+            return self.status
+
+    def poll(self, timeout=1.0):
+        """
+        Request a status report now and return it
+        """
+        seq = self.status_seq
+        self.gs.txb(b"?")
+        return self.wait_status(after_seq=seq, timeout=timeout)
+
+    def wait_idle(self, timeout=None):
+        """
+        Wait for an Idle report received after this call
+        Reports already received may predate the last accepted command
+        """
+        seq = self.status_seq
+        tstart = time.time()
+        while True:
+            if timeout is not None:
+                remaining = timeout - (time.time() - tstart)
+                if remaining <= 0:
+                    raise Timeout(
+                        f"Timed out after {timeout} sec waiting for idle")
+            else:
+                remaining = 1.0
+            # Normally a report every period
+            # Nudge if one was lost
+            try:
+                status = self.wait_status(after_seq=seq,
+                                          timeout=min(remaining,
+                                                      4 * self.period))
+            except Timeout:
+                self.gs.txb(b"?")
+                continue
+            if status.idle():
+                return status
+            seq = self.status_seq
+
+
 class GRBLSer:
     def __init__(
         self,
@@ -270,6 +482,11 @@ class GRBLSer:
         flush=True,
         verbose=None):
         self.serial = None
+        # See start_reader()
+        self.reader = None
+        # Status polls are written from the reader thread
+        self.tx_lock = threading.Lock()
+        self.rx_partial = b""
         if port is None:
             port = default_port()
         self.verbose = verbose if verbose is not None else bool(
@@ -278,6 +495,7 @@ class GRBLSer:
         self.check_threads = get_bc().dev_mode()
         self.last_thread = None
         self.ser_timeout = ser_timeout
+        self.stream_reset()
 
         self.verbose and print("opening %s in thread %s" %
                                (port, threading.get_ident()))
@@ -323,6 +541,7 @@ class GRBLSer:
             self.flush()
 
     def close(self):
+        self.stop_reader()
         if self.serial:
             self.serial.close()
             self.serial = None
@@ -337,26 +556,66 @@ class GRBLSer:
         NOTE: blue system
         flushing b'[MSG:Estop is activated!]\r\nok\r\n[MSG:Estop is activated!]\r\nok\r\n'
         """
+        if self.reader:
+            return self.flush_reader()
         self.serial.flushInput()
         self.serial.flushOutput()
+        # Any acks in flight are gone
+        self.stream_reset()
         timeout = self.serial.timeout
         try:
             self.serial.timeout = 0.1
             while True:
                 c = self.serial.read(1024)
-                if b"Estop is activated" in c:
-                    raise Estop(
-                        "Emergency stop is activated. Check estop button and/or power supply and then re-home"
-                    )
-                if b"Check Limits" in c:
-                    raise LimitSwitchActive(
-                        "Limit switch tripped. Manually move away from limit switches and then re-home"
-                    )
+                self.check_flushed(c)
                 if not c:
                     return
         finally:
             self.serial.timeout = timeout
 
+    def check_flushed(self, c):
+        if b"Estop is activated" in c:
+            raise Estop(
+                "Emergency stop is activated. Check estop button and/or power supply and then re-home"
+            )
+        if b"Check Limits" in c:
+            raise LimitSwitchActive(
+                "Limit switch tripped. Manually move away from limit switches and then re-home"
+            )
+
+    def flush_reader(self):
+        """
+        flush() when the reader thread owns RX
+        Drop queued responses until the line goes quiet
+        """
+        self.stream_reset()
+        while True:
+            l = self.reader.readline(timeout=0.1)
+            self.check_flushed(tobytes(l))
+            if not l:
+                return
+
+    def start_reader(self, poll_hz=20.0):
+        """
+        Hand the RX side to a GrblStatusReader thread
+        readline() then returns non-status lines queued by the reader
+        """
+        if self.reader is None:
+            # Keep rx_line() responsive so polls go out on time
+            if self.serial:
+                self.serial.timeout = min(self.ser_timeout, 0.5 / poll_hz)
+            self.reader = GrblStatusReader(self, poll_hz=poll_hz)
+            self.reader.start()
+        return self.reader
+
+    def stop_reader(self):
+        if self.reader is None:
+            return
+        self.reader.stop()
+        self.reader = None
+        if self.serial:
+            self.serial.timeout = self.ser_timeout
+
     def update_check_thread(self):
         self.last_thread = threading.get_ident()
         if self.check_threads:
@@ -376,16 +635,33 @@ class GRBLSer:
             out = out + '\r'
         out = out.encode('ascii')
         # util.hexdump(out)
-        self.serial.write(out)
-        self.serial.flush()
+        with self.tx_lock:
+            self.serial.write(out)
+            self.serial.flush()
 
     def txb(self, out):
         # self.verbose and print("tx '%s'" % (out, ))
         # util.hexdump(out)
-        self.serial.write(out)
-        self.serial.flush()
+        with self.tx_lock:
+            self.serial.write(out)
+            self.serial.flush()
+
+    def rx_line(self):
+        """
+        Read one raw line from the port for the reader thread
+        Return "" on timeout
+        A partial line is kept until the rest arrives
+        """
+        self.rx_partial += self.serial.readline()
+        if not self.rx_partial.endswith(b"\n"):
+            return ""
+        b = self.rx_partial
+        self.rx_partial = b""
+        return b.decode("ascii", errors="replace").strip()
 
     def readline(self):
+        if self.reader:
+            return self.reader.readline(timeout=self.ser_timeout)
         tstart = time.time()
         b = self.serial.readline()
         if self.verbose:
@@ -395,12 +671,116 @@ class GRBLSer:
                 util.hexdump(b)
         return b.decode("ascii").strip()
 
+    def stream_reset(self):
+        """
+        Forget streamed commands
+        Ex: controller was reset and dropped its buffers
+        """
+        # (sequence number, command, bytes in RX buffer)
+        self.stream_pending = collections.deque()
+        self.stream_pending_bytes = 0
+        self.stream_seq = 0
+        self.stream_acked_seq = 0
+        self.stream_error = None
+        self.rx_buffer_size = GRBL_RX_BUFFER_SIZE
+        # ok is delayed while the planner is full, so allow for a long move
+        self.stream_timeout = 60.0
+
+    def stream(self, out):
+        """
+        Send a command without waiting for its ok
+        Uses character counting flow control: only blocks while the
+        controller RX buffer can't hold the line
+        Lets GRBL's planner look ahead across back to back moves
+        Return the command's sequence number (see stream_acked())
+        """
+        self.stream_check()
+        n = len(out) + 1
+        if n > self.rx_buffer_size:
+            raise ValueError("Command too long to stream: %s" % (out, ))
+        tstart = time.time()
+        while self.stream_pending_bytes + n > self.rx_buffer_size:
+            if time.time() - tstart > self.stream_timeout:
+                raise Timeout(
+                    f"Timed out after {self.stream_timeout} sec waiting for RX buffer"
+                )
+            self.stream_rx()
+        self.tx(out)
+        self.stream_seq += 1
+        self.stream_pending.append((self.stream_seq, out, n))
+        self.stream_pending_bytes += n
+        return self.stream_seq
+
+    def stream_ack(self, l):
+        """
+        ok / error response to the oldest streamed command
+        """
+        seq, out, n = self.stream_pending.popleft()
+        self.stream_pending_bytes -= n
+        self.stream_acked_seq = seq
+        self.verbose and print("stream ack %u '%s': %s" % (seq, out, l))
+        if l != "ok" and self.stream_error is None:
+            self.stream_error = GrblError(l)
+            self.stream_error.command = out
+
+    def stream_rx(self):
+        """
+        Read one line and account for it if its a streamed command response
+        Return the line ("" on serial timeout)
+        """
+        l = self.readline()
+        self.verbose and print("rx '%s'" % (l, ))
+        if self.stream_pending and (l == "ok" or l.find("error") == 0):
+            self.stream_ack(l)
+        elif l.find("ALARM") == 0 and self.stream_error is None:
+            # Controller will reject everything until cleared
+            self.stream_error = GrblException("Streaming failed: " + l)
+        return l
+
+    def stream_acked(self, seq):
+        """
+        Has the controller accepted (or rejected) streamed command seq?
+        """
+        return seq <= self.stream_acked_seq
+
+    def stream_check(self):
+        """
+        Raise the first error from a streamed command, if any
+        """
+        if self.stream_error is not None:
+            e = self.stream_error
+            self.stream_error = None
+            raise e
+
+    def stream_wait(self, seq=None):
+        """
+        Wait until all streamed commands (or those up to seq)
+        have been accepted into the planner
+        Moves may still be running
+        """
+        tstart = time.time()
+        last_pending = len(self.stream_pending)
+        while self.stream_pending and (seq is None
+                                       or not self.stream_acked(seq)):
+            # Timeout since the last ack
+            if len(self.stream_pending) != last_pending:
+                last_pending = len(self.stream_pending)
+                tstart = time.time()
+            if time.time() - tstart > self.stream_timeout:
+                raise Timeout(
+                    f"Timed out after {self.stream_timeout} sec waiting for {last_pending} streamed commands"
+                )
+            self.stream_rx()
+        self.stream_check()
+
     def txrxs(self, out, nl=True, trim_data=True, timeout=None):
         """
         Send a command and return array of lines before ok line
         """
         if timeout is None:
             timeout = self.ser_timeout
+        # Otherwise can't tell which ok is ours
+        self.stream_wait()
         self.tx(out, nl=nl)
         ret = []
         tstart = time.time()
@@ -448,6 +828,8 @@ class GRBLSer:
         Grbl 1.1f ['$' for help]
         """
         self.tx("\x18", nl=False)
+        # Buffers are cleared, no acks coming
+        self.stream_reset()
         # Leave recovery to higher level logic
         """
         l = self.readline().strip()
@@ -527,10 +909,16 @@ class GRBLSer:
         <Idle|MPos:0.000,0.000,0.000|FS:0,0|Ov:100,100,100>
         <Idle|MPos:0.000,0.000,0.000|FS:0,0>
         """
+        if self.reader:
+            return self.reader.poll().raw
         self.tx("?", nl=False)
         while True:
             l = self.readline()
             self.verbose and print("rx '%s'" % (l, ))
+            # Real time command: may be interleaved with streaming acks
+            if self.stream_pending and (l == "ok" or l.find("error") == 0):
+                self.stream_ack(l)
+                continue
             l = trim_status_line(l)
             if len(l):
                 return l
@@ -675,7 +1063,11 @@ class MockGRBLSer(GRBLSer):
         self.verbose and print("MOCK: opening", port)
         self.ser_timeout = -1
         self.serial = None
+        self.reader = None
+        # Reader thread executes lines while the main thread queues them
+        self.mock_lock = threading.Lock()
         self.check_threads = get_bc().dev_mode()
+        self.stream_reset()
         self.reset()
 
     def in_reset(self):
@@ -689,13 +1081,62 @@ class MockGRBLSer(GRBLSer):
             assert 0
 
     def tx(self, out, nl=True):
+        """
+        Lines go into an emulated controller RX buffer
+        Executed and acked one per readline()
+        """
         self.verbose and print("MOCK: tx", out)
+        if not nl:
+            if out == "?":
+                self.status_requests += 1
+            return
+        with self.mock_lock:
+            self.rx_buffer.append(out)
+            self.rx_buffer_bytes += len(out) + 1
+            self.rx_buffer_max = max(self.rx_buffer_max, self.rx_buffer_bytes)
+            if self.rx_buffer_bytes > GRBL_RX_BUFFER_SIZE + 1:
+                raise GrblException("MOCK: RX buffer overflow (%u bytes)" %
+                                    self.rx_buffer_bytes)
+
+    def execute_line(self):
+        with self.mock_lock:
+            if not self.rx_buffer:
+                return ""
+            out = self.rx_buffer.popleft()
+            self.rx_buffer_bytes -= len(out) + 1
+            self.lines_executed += 1
+            if out.upper().find("$J=") == 0:
+                try:
+                    self.execute_jog(out[3:])
+                except ValueError:
+                    return "error:20"
+            return "ok"
+
+    def rx_line(self):
+        """
+        Status reports take priority over command responses like real GRBL
+        """
+        if self.status_requests:
+            self.status_requests -= 1
+            return "<%s>" % (self.status_str(), )
+        l = self.execute_line()
+        if not l:
+            time.sleep(0.005)
+        return l
+
+    def readline(self):
+        if self.reader:
+            return self.reader.readline(timeout=0.1)
+        return self.execute_line()
 
     def txb(self, out):
         self.verbose and print("MOCK: txb", out)
+        if out == b"?":
+            self.status_requests += 1
 
     def txrx0(self, out, nl=True):
         self.verbose and print("MOCK: txrx0", out)
+        self.stream_wait()
 
     def question(self):
         """
@@ -703,12 +1144,22 @@ class MockGRBLSer(GRBLSer):
         Idle|MPos:8.000,0.000,0.000|FS:0,0|Ov:100,100,100
         Idle|MPos:8.000,0.000,0.000|FS:0,0
         """
+        if self.reader:
+            return GRBLSer.question(self)
         assert self.state
         time.sleep(0.05)
+        return self.status_str()
+
+    def status_str(self):
         return "%s|MPos:%0.3f,%0.3f,%0.3f|FS:0,0" % (
             self.state, self.mpos["x"], self.mpos["y"], self.mpos["z"])
 
     def j(self, command):
+        self.stream_wait()
+        self.execute_jog(command)
+        time.sleep(0.05)
+
+    def execute_jog(self, command):
         # Parse a jog command and update state
         # Command completes instantly
         command = command.upper()
@@ -733,7 +1184,6 @@ class MockGRBLSer(GRBLSer):
                 self.mpos[k] += v
         else:
             raise ValueError(command)
-        time.sleep(0.05)
 
     def reset(self):
         self.mpos = {
@@ -742,6 +1192,13 @@ class MockGRBLSer(GRBLSer):
             "z": 0.0,
         }
         self.state = self.STATE_RESET
+        self.stream_reset()
+        self.rx_buffer = collections.deque()
+        self.rx_buffer_bytes = 0
+        # For checking flow control
+        self.rx_buffer_max = 0
+        self.lines_executed = 0
+        self.status_requests = 0
         time.sleep(0.05)
 
     def jog_cancel(self):
@@ -752,11 +1209,17 @@ class MockGRBLSer(GRBLSer):
         time.sleep(0.05)
 
     def flush(self):
+        if self.reader:
+            return self.flush_reader()
         time.sleep(0.05)
 
     def txrxs(self, out, nl=True, trim_data=True, timeout=None):
+        self.stream_wait()
         return "mock"
 
+    def g(self):
+        return "[GC:G0 G54 G17 G21 G90 G94 M5 M9 T0 F0 S0]"
+
     def hash(self):
         return [
             "G54:0.000,0.000,0.000",
@@ -825,6 +1288,7 @@ class GRBL:
                  probe=True,
                  reset=False,
                  gs=None,
+                 status_hz=None,
                  verbose=None):
         """
         port: serial port file name
@@ -832,12 +1296,15 @@ class GRBL:
         flush: try to clear old serial port communications before initializing
         probe: check communications at init to make sure controlelr is working
         reset: do a full reset at initialization. You will loose position and it will take a while
+        status_hz: poll status from a reader thread at this rate. 0 to query on demand
         verbose: yell stuff to the screen
         """
 
         self.gs = None
         self.qstatus_updated_cb = None
         self.pos_cache = None
+        # Parser state to restore after feed_hold_reset(), see modal_state()
+        self.reset_modal = None
         self.verbose = verbose if verbose is not None else bool(
             int(os.getenv("GRBL_VERBOSE", "0")))
         self.port = None
@@ -863,9 +1330,28 @@ class GRBL:
         # See move_relative
         self.use_soft_move_relative = int(os.getenv("GRBL_SOFT_RELATIVE", "1"))
 
+        if status_hz is None:
+            status_hz = float(os.getenv("GRBL_STATUS_HZ", "0"))
+        # Must be after probe / reset: those read status lines directly
+        if status_hz:
+            self.start_status_reader(status_hz)
+
     def set_qstatus_updated_cb(self, cb):
         self.qstatus_updated_cb = cb
 
+    def start_status_reader(self, status_hz):
+        reader = self.gs.start_reader(poll_hz=status_hz)
+        reader.register_status_cb(self.status_report)
+
+    def status_report(self, status):
+        """
+        Background status report from the reader thread
+        """
+        if status.mpos:
+            self.set_pos_cache(status.mpos)
+        if self.qstatus_updated_cb:
+            self.qstatus_updated_cb(status.to_dict())
+
     def close(self):
         if self.gs:
             self.gs.close()
@@ -875,6 +1361,13 @@ class GRBL:
         self.close()
 
     def stop(self):
+        # Streamed moves (ex: move_path() G1s) can be queued behind the current one
+        # A jog cancel only flushes jogs
+        status = self.qstatus()["status"]
+        if self.gs.stream_pending or status == "Run" or status.startswith(
+                "Hold"):
+            self.feed_hold_reset()
+            return
         # sometimes the stop is ignored
         # seems to happen especially for very low jog amounts
         while True:
@@ -883,6 +1376,37 @@ class GRBL:
                 break
             time.sleep(0.01)
 
+    def feed_hold_reset(self, timeout=5.0):
+        """
+        Stop and flush all queued motion without losing position
+        A reset while moving alarms since position may be lost
+        so decelerate with a feed hold first
+        """
+        self.gs.exclamation()
+        tstart = time.time()
+        while self.qstatus()["status"] not in ("Hold:0", "Idle"):
+            if time.time() - tstart > timeout:
+                raise Timeout("Feed hold didn't complete")
+            time.sleep(0.01)
+        self.reset()
+        # Soft reset selects G54 and clears the tool number
+        if self.reset_modal:
+            self.gs.txrx0(" ".join(self.reset_modal))
+
+    def modal_state(self):
+        """
+        Parser state that a soft reset doesn't keep but we rely on
+        WCS selection (ex: G55 from rc_post_home) and tool number (see GrblHal.is_homed())
+        [GC:G0 G55 G17 G21 G90 G94 M5 M9 T1 F0 S0] => ["G55", "T1"]
+        """
+        ret = []
+        for part in self.gs.g().strip("[]").split():
+            if part in ("G54", "G55", "G56", "G57", "G58", "G59"):
+                ret.append(part)
+            elif part[0] == "T":
+                ret.append(part)
+        return ret
+
     def reset(self):
         self.gs.reset()
         self.gs.reset_recover()
@@ -959,27 +1483,11 @@ class GRBL:
         tries = 3
         for i in range(tries):
             try:
-                raw = self.gs.question()
-                parts = raw.split("|")
-                # FIXME: extra
-                ij = parts[0]
-                ret = {
-                    # Idle, Jog
-                    "status": ij,
-                }
-                for part in parts[1:]:
-                    k, v = part.split(":")
-                    if k == "MPos":
-                        v = (float(x) for x in v.split(","))
-                        v = dict([(k, v) for k, v in zip("xyz", v)])
-                        self.set_pos_cache(v)
-                    elif k == "Pn":
-                        # Y and Z are valid values
-                        # Z appears to be when unhomed?
-                        # assert v == "Y"
-                        # v = True
-                        pass
-                    ret[k] = v
+                # Pn: Y and Z are valid values
+                # Z appears to be when unhomed?
+                ret = GrblStatus(self.gs.question()).to_dict()
+                if "MPos" in ret:
+                    self.set_pos_cache(ret["MPos"])
                 if self.qstatus_updated_cb:
                     self.qstatus_updated_cb(ret)
                 return ret
@@ -1015,12 +1523,31 @@ class GRBL:
                 self.gs.j("G90 %s F%u" % (ax_str, f))
                 if blocking:
                     self.wait_idle()
+                return
             except Exception:
                 self.verbose and print("WARNING: bad absolute move")
                 if i == tries - 1:
                     raise
                 self.general_recover()
 
+    def stream_move_absolute(self, pos, f, jog=True):
+        """
+        Queue an absolute move without waiting for the controller to accept it
+        Back to back moves stay in GRBL's planner (no round trip per move)
+        Unlike move_absolute() there is no retry: errors are raised by a later
+        stream call or wait_idle() since which moves ran is unknown
+        jog=False: queue a G1 move instead
+            Can be mixed with other g-code such as G4 but jog_cancel() won't stop it
+            stop() uses a feed hold + soft reset instead (see feed_hold_reset())
+        Return the command sequence number
+        """
+        ax_str = ''.join(
+            [' %c%s' % (k.upper(), format_axis3(v)) for k, v in pos.items()])
+        if jog:
+            return self.gs.stream("$J=G90 %s F%u" % (ax_str, f))
+        else:
+            return self.gs.stream("G90 G1 %s F%u" % (ax_str, f))
+
     def soft_move_relative(self, pos, f, blocking=True):
         # Could use old cache but probably an over optimization
         self.update_pos_cache()
@@ -1050,6 +1577,14 @@ class GRBL:
                 self.wait_idle()
 
     def wait_idle(self):
+        # Idle may be reported before the last streamed move is planned
+        self.gs.stream_wait()
+        if self.gs.reader:
+            # Wakes up on the first Idle report instead of sleep polling
+            status = self.gs.reader.wait_idle()
+            if status.mpos:
+                self.set_pos_cache(status.mpos)
+            return
         while True:
             qstatus = self.qstatus()
             if qstatus["status"] == "Idle":
@@ -1172,6 +1707,18 @@ class GRBL:
         }
         return ret
 
+    def motion_mode(self):
+        """
+        Modal motion word from the parser state
+        [GC:G0 G54 G17 G21 G90 G94 M5 M9 T0 F0 S0] => "G0"
+        """
+        for part in self.gs.g().strip("[]").split():
+            part = part.replace("GC:", "")
+            if part in ("G0", "G1", "G2", "G3", "G38.2", "G38.3", "G38.4",
+                        "G38.5", "G80"):
+                return part
+        raise Exception("failed to parse")
+
     def selected_tool(self):
         for part in self.gs.g().split():
             if part[0] != "T":
@@ -1301,7 +1848,10 @@ class GrblHal(MotionHAL):
         if grbl:
             self.grbl = grbl
         else:
-            self.grbl = GRBL(port=port, verbose=verbose)
+            self.grbl = GRBL(
+                port=port,
+                status_hz=self.microscope.usc.motion.grbl_status_hz(),
+                verbose=verbose)
         """
         # Hack, move out of here to Microscope or similar
         # Run early before any config is overriten though
@@ -1350,6 +1900,7 @@ class GrblHal(MotionHAL):
         rc = options.get("rc_post_home")
         if rc is not None:
             self.rc_commands(rc)
+        self.grbl.reset_modal = self.grbl.modal_state()
 
         # Cache so that damper can be adjusted later
         self._abs_max_velocities = self._get_max_velocities()
@@ -1567,6 +2118,53 @@ class GrblHal(MotionHAL):
         # print("grbl mv_abs", pos)
         self.grbl.move_absolute(self._move_absolute_adjust_wcs(pos), f=1000)
 
+    def _move_path_iter(self, path):
+        """
+        Queue the path in GRBL's planner
+        G4 P0 after each waypoint is only acked once motion stops there
+        A waypoint with a dwell queues the following moves behind a G4 dwell
+        so the controller doesn't wait on the host
+        Path moves are G1: the previous motion mode is restored afterwards
+        so later moves (ex: move_absolute()) don't inherit it
+        """
+        gs = self.grbl.gs
+        motion_mode = self.grbl.motion_mode()
+        # Waypoint queued with motion after it: (G4 P0 sequence number, waypoint)
+        pending = None
+        try:
+            for segment in path:
+                if segment["pos"]:
+                    self.grbl.stream_move_absolute(
+                        self._move_absolute_adjust_wcs(dict(segment["pos"])),
+                        f=1000,
+                        jog=False)
+                if segment["waypoint"] is None:
+                    continue
+                # Motion past the previous waypoint is queued: now wait on it
+                if pending:
+                    gs.stream_wait(pending[0])
+                    yield pending[1]
+                    pending = None
+                marker = gs.stream("G4 P0")
+                if segment["dwell"]:
+                    gs.stream("G4 P%0.3f" % segment["dwell"])
+                    pending = (marker, segment["waypoint"])
+                else:
+                    # Hold position until the caller is done with this point
+                    gs.stream_wait(marker)
+                    yield segment["waypoint"]
+            if pending:
+                gs.stream_wait(pending[0])
+                yield pending[1]
+            self.grbl.wait_idle()
+            gs.txrx0(motion_mode)
+        except GeneratorExit:
+            # Caller stopped early
+            # Let queued motion run out so the position is known
+            self.grbl.wait_idle()
+            gs.txrx0(motion_mode)
+            raise
+
     def _move_relative(self, pos):
         # print("grbl mv_rel", pos)
         self.grbl.move_relative(pos, f=1000)
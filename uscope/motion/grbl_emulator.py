@@ -0,0 +1,915 @@
+"""
+GRBL 1.1 firmware emulator served on a pseudo-terminal
+
+Unlike MockGRBLSer this talks real serial framing over a tty so GRBLSer,
+GRBL and GrblHal run unmodified against it:
+    emu = GrblEmulator()
+    emu.start()
+    hal = GrblHal(port=emu.port, microscope=microscope)
+
+Models enough of the firmware to benchmark round trips and moves:
+-$$, $#, $G, $I, $N, $X, $H, $x=val settings
+-? status reports, 0x85 jog cancel, ! / ~ feed hold, ^X soft reset
+-$J= jogs and G0 / G1 moves in G90 / G91 / G53
+-G54-G59 WCS selection and G10 L2 / L20 WCS writes (see grbl_write_meta())
+-128 byte RX buffer and 15 block planner with ok sent once a line is planned
+-Moves take as long as the configured $11x rates and $12x accelerations allow
+-Optional response latency, serial bandwidth, noise and line corruption
+"""
+
+import math
+import os
+import pty
+import random
+import re
+import select
+import threading
+import time
+import tty
+import collections
+
+# Same limits as an ATmega328 build
+RX_BUFFER_SIZE = 128
+BLOCK_BUFFER_SIZE = 15
+LINE_BUFFER_SIZE = 80
+
+CMD_STATUS = ord("?")
+CMD_CYCLE_START = ord("~")
+CMD_FEED_HOLD = ord("!")
+CMD_RESET = 0x18
+CMD_JOG_CANCEL = 0x85
+
+# Reported after each soft reset
+BANNER = "Grbl 1.1h ['$' for help]"
+
+# Integer settings are printed without decimals
+INT_SETTINGS = (0, 1, 2, 3, 4, 5, 6, 10, 13, 20, 21, 22, 23, 26, 30, 31, 32)
+
+# WCO / Ov are only included in some reports to save bandwidth
+REPORT_WCO_REFRESH = 10
+REPORT_OVR_REFRESH = 20
+
+# error codes from grbl.error_i2s
+ERROR_BAD_NUMBER = 2
+ERROR_INVALID_STATEMENT = 3
+ERROR_SETTING_DISABLED = 5
+ERROR_IDLE_ERROR = 8
+ERROR_SYSTEM_GC_LOCK = 9
+ERROR_OVERFLOW = 11
+ERROR_TRAVEL_EXCEEDED = 15
+ERROR_INVALID_JOG_COMMAND = 16
+ERROR_UNSUPPORTED_COMMAND = 20
+ERROR_UNDEFINED_FEED_RATE = 22
+ERROR_NO_AXIS_WORDS = 26
+
+ALARM_ABORT_CYCLE = 3
+ALARM_HOMING_RESET = 6
+
+AXES = "xyz"
+
+# Wait for motion to complete: homing, WCS writes, dwell
+SYNC_RE = re.compile(r"^(\$H|.*G0*10(?![0-9.])|.*G0*4(?![0-9.]))")
+# "G10" => ("G", 10.0)
+WORD_RE = re.compile(r"([A-Z])([-+]?[0-9]*\.?[0-9]*)")
+
+
+def default_settings():
+    """
+    Reasonable 3 axis defaults (close to a CNC 3018)
+    """
+    return collections.OrderedDict([
+        (0, 10),
+        (1, 25),
+        (2, 0),
+        (3, 0),
+        (4, 0),
+        (5, 0),
+        (6, 0),
+        (10, 1),
+        (11, 0.010),
+        (12, 0.002),
+        (13, 0),
+        (20, 0),
+        (21, 0),
+        (22, 1),
+        (23, 0),
+        (24, 25.0),
+        (25, 500.0),
+        (26, 250),
+        (27, 1.0),
+        (30, 1000),
+        (31, 0),
+        (32, 0),
+        (100, 800.0),
+        (101, 800.0),
+        (102, 800.0),
+        (110, 1000.0),
+        (111, 1000.0),
+        (112, 600.0),
+        (120, 30.0),
+        (121, 30.0),
+        (122, 30.0),
+        (130, 200.0),
+        (131, 200.0),
+        (132, 200.0),
+    ])
+
+
+def format_setting(k, v):
+    if k in INT_SETTINGS:
+        return "$%u=%u" % (k, v)
+    return "$%u=%0.3f" % (k, v)
+
+
+def format_axes(pos):
+    return ",".join(["%0.3f" % pos[axis] for axis in AXES])
+
+
+class EmulatorError(Exception):
+    """
+    Line rejected with a GRBL error code
+    """
+    def __init__(self, code):
+        super().__init__("error:%u" % code)
+        self.code = code
+
+
+class Block:
+    """
+    Straight line move with a trapezoidal velocity profile
+    Like GRBL the feed and acceleration are limited by the slowest axis
+    Unlike GRBL there is no junction blending: every block ends at rest
+    """
+    def __init__(self,
+                 start,
+                 end,
+                 feed,
+                 max_rates,
+                 accelerations,
+                 jog=False,
+                 v_entry=0.0):
+        """
+        feed, max_rates: mm/min
+        accelerations: mm/sec^2
+        v_entry: mm/sec, only used to decelerate to a stop
+        """
+        self.start = dict(start)
+        self.end = dict(end)
+        self.jog = jog
+        self.t_start = None
+        deltas = dict([(axis, end[axis] - start[axis]) for axis in AXES])
+        self.distance = math.sqrt(sum([d * d for d in deltas.values()]))
+        self.unit = dict([(axis, d / self.distance if self.distance else 0.0)
+                          for axis, d in deltas.items()])
+        v = feed / 60.0
+        a = None
+        for axis in AXES:
+            u = abs(self.unit[axis])
+            if not u:
+                continue
+            v = min(v, max_rates[axis] / 60.0 / u)
+            a_axis = accelerations[axis] / u
+            a = a_axis if a is None else min(a, a_axis)
+        self.v_entry = min(v_entry, v) if v_entry else 0.0
+        self.a = a or 1.0
+        self.plan(v)
+
+    def plan(self, v):
+        a = self.a
+        v0 = self.v_entry
+        d = self.distance
+        if d <= 0.0:
+            self.v_peak = 0.0
+            self.t_accel = self.t_cruise = self.t_decel = 0.0
+            self.duration = 0.0
+            return
+        # Too short to reach v: triangle profile
+        d_accel = (v * v - v0 * v0) / (2 * a)
+        d_decel = v * v / (2 * a)
+        if d_accel + d_decel > d:
+            v = math.sqrt(max(v0 * v0, (2 * a * d + v0 * v0) / 2))
+            d_accel = (v * v - v0 * v0) / (2 * a)
+            d_decel = v * v / (2 * a)
+        self.v_peak = v
+        self.d_accel = d_accel
+        self.t_accel = (v - v0) / a
+        self.t_decel = v / a
+        self.t_cruise = max(0.0, (d - d_accel - d_decel) / v)
+        self.duration = self.t_accel + self.t_cruise + self.t_decel
+
+    def progress(self, dt):
+        """
+        Return (distance along the block, speed) dt sec after starting
+        """
+        a = self.a
+        v0 = self.v_entry
+        v = self.v_peak
+        if dt <= 0.0:
+            return 0.0, v0
+        if dt >= self.duration:
+            return self.distance, 0.0
+        if dt < self.t_accel:
+            return v0 * dt + a * dt * dt / 2, v0 + a * dt
+        dt -= self.t_accel
+        if dt < self.t_cruise:
+            return self.d_accel + v * dt, v
+        dt -= self.t_cruise
+        return (self.d_accel + v * self.t_cruise + v * dt - a * dt * dt / 2,
+                v - a * dt)
+
+    def position(self, dt):
+        distance, speed = self.progress(dt)
+        return dict([(axis, self.start[axis] + self.unit[axis] * distance)
+                     for axis in AXES]), speed
+
+    def stop_block(self, dt, max_rates, accelerations):
+        """
+        Block that decelerates to a stop from where this block is at dt
+        """
+        pos, speed = self.position(dt)
+        distance = speed * speed / (2 * self.a)
+        end = dict([(axis, pos[axis] + self.unit[axis] * distance)
+                    for axis in AXES])
+        return Block(pos,
+                     end,
+                     speed * 60.0,
+                     max_rates,
+                     accelerations,
+                     jog=self.jog,
+                     v_entry=speed)
+
+
+class GrblEmulator:
+    def __init__(self,
+                 settings=None,
+                 homed=True,
+                 options="V",
+                 homing_time=1.0,
+                 latency=0.002,
+                 baudrate=115200,
+                 noise_rate=0.0,
+                 corrupt_rate=0.0,
+                 seed=None,
+                 verbose=False):
+        """
+        settings: $ settings overriding default_settings()
+        homed: start Idle instead of in the homing Alarm
+        options: $I OPT letters. Default omits L => HOMING_INIT_LOCK
+        homing_time: sec for a $H cycle
+        latency: sec from a request to its response (USB serial turnaround)
+        baudrate: output is delayed by the time it takes to transmit
+        noise_rate: probability a junk line is inserted before each response
+        corrupt_rate: probability a status report has a character dropped
+            Ex: <Idle|MPos:-72.425,-25.634,0.000FS:0,0>
+        seed: for reproducible noise
+        """
+        self.settings = default_settings()
+        if settings:
+            self.settings.update(settings)
+        self.homed = homed
+        self.options = options
+        self.homing_time = homing_time
+        self.latency = latency
+        self.baudrate = baudrate
+        self.noise_rate = noise_rate
+        self.corrupt_rate = corrupt_rate
+        self.random = random.Random(seed)
+        self.verbose = verbose
+
+        # G54 - G59 persist across reset (EEPROM)
+        self.wcs = dict([(i, dict([(axis, 0.0) for axis in AXES]))
+                         for i in range(1, 7)])
+        self.mpos = dict([(axis, 0.0) for axis in AXES])
+
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.thread = None
+        self.running = threading.Event()
+        # Protects state shared with stats readers
+        self.lock = threading.Lock()
+
+        # Statistics for benchmarks
+        self.lines_rx = 0
+        self.status_reports = 0
+        self.rx_overflows = 0
+        self.rx_buffer_max = 0
+        self.moves = 0
+
+        self.tx_queue = collections.deque()
+        self.tx_busy_until = 0.0
+        # Homing required before moving
+        self.alarm = not homed and bool(self.settings[22])
+        self.blocks = collections.deque()
+        self.homing = None
+        self.soft_reset(banner=False)
+
+    def __del__(self):
+        self.stop()
+
+    def log(self, s):
+        self.verbose and print("GRBL emu: %s" % (s, ))
+
+    def start(self):
+        """
+        Create the pty and start serving
+        self.port is the device file to open
+        """
+        self.master, self.slave = pty.openpty()
+        # Otherwise the line discipline echos and translates \r
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        self.running.set()
+        self.thread = threading.Thread(target=self.run,
+                                       name="GrblEmulator",
+                                       daemon=True)
+        self.thread.start()
+        self.log("serving on %s" % (self.port, ))
+        return self.port
+
+    def stop(self):
+        self.running.clear()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(1.0)
+        self.thread = None
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.master = None
+        self.slave = None
+
+    def soft_reset(self, banner=True):
+        """
+        ^X: stop everything and reset the parser
+        Settings, WCS and position are kept
+        """
+        # GRBL keeps position if reset once a feed hold has stopped motion
+        moving = False
+        if self.blocks:
+            moving = not (self.hold and time.time() >= self.hold_t)
+            # Position at the moment of reset
+            self.mpos = self.current_position()
+        if moving or self.homing:
+            # GRBL can't guarantee position after stopping mid move
+            self.alarm = True
+            self.send(
+                "ALARM:%u" %
+                (ALARM_HOMING_RESET if self.homing else ALARM_ABORT_CYCLE, ))
+        self.rx_buffer = bytearray()
+        self.blocks = collections.deque()
+        self.pending_line = None
+        self.hold = False
+        self.hold_t = None
+        self.homing = None
+        self.dwell_until = None
+        self.wco_count = 0
+        self.ovr_count = 0
+        # Modal state
+        self.distance_mode = "G90"
+        self.motion_mode = "G0"
+        self.wcs_active = 1
+        self.feed = 0.0
+        self.tool = 0
+        if banner:
+            self.send("")
+            self.send(BANNER)
+            if self.alarm:
+                self.send("[MSG:'$H'|'$X' to unlock]")
+
+    """
+    Output
+    """
+
+    def send(self, line, status=False):
+        """
+        Queue a response line
+        Released after latency + transmit time, in order
+        """
+        if self.noise_rate and self.random.random() < self.noise_rate:
+            self.queue_tx("".join([
+                chr(self.random.randrange(0x21, 0x7f))
+                for _i in range(self.random.randrange(1, 8))
+            ]))
+        if status and self.corrupt_rate and self.random.random(
+        ) < self.corrupt_rate and len(line) > 2:
+            i = self.random.randrange(1, len(line) - 1)
+            line = line[:i] + line[i + 1:]
+        self.queue_tx(line)
+
+    def queue_tx(self, line):
+        data = (line + "\r\n").encode("ascii")
+        now = time.time()
+        t = max(now + self.latency, self.tx_busy_until)
+        if self.baudrate:
+            # 8N1 => 10 bits per byte
+            t += len(data) * 10.0 / self.baudrate
+        self.tx_busy_until = t
+        self.tx_queue.append((t, data))
+
+    def flush_tx(self):
+        now = time.time()
+        out = b""
+        while self.tx_queue and self.tx_queue[0][0] <= now:
+            out += self.tx_queue.popleft()[1]
+        if out:
+            try:
+                os.write(self.master, out)
+            except BlockingIOError:
+                # Nobody is reading: drop like a disconnected USB serial
+                pass
+
+    """
+    Input
+    """
+
+    def rx(self, data):
+        for c in data:
+            if c == CMD_STATUS:
+                self.report_status()
+            elif c == CMD_RESET:
+                self.log("soft reset")
+                self.soft_reset()
+            elif c == CMD_JOG_CANCEL:
+                self.jog_cancel()
+            elif c == CMD_FEED_HOLD:
+                self.feed_hold()
+            elif c == CMD_CYCLE_START:
+                self.cycle_start()
+            elif c >= 0x80:
+                # Other extended realtime commands (overrides, etc)
+                pass
+            elif len(self.rx_buffer) >= RX_BUFFER_SIZE - 1:
+                # Real GRBL silently drops bytes
+                self.rx_overflows += 1
+            else:
+                self.rx_buffer.append(c)
+                self.rx_buffer_max = max(self.rx_buffer_max,
+                                         len(self.rx_buffer))
+
+    def next_line(self):
+        """
+        Pop the next complete line from the RX buffer
+        Like GRBL both \r and \n end a line (\r\n => extra empty line, ok)
+        """
+        ends = [
+            i for i in (self.rx_buffer.find(b"\r"), self.rx_buffer.find(b"\n"))
+            if i >= 0
+        ]
+        if not ends:
+            return None
+        i = min(ends)
+        raw = bytes(self.rx_buffer[:i])
+        del self.rx_buffer[:i + 1]
+        return raw.decode("ascii", errors="replace")
+
+    """
+    Motion
+    """
+
+    def max_rates(self):
+        return dict([(axis, self.settings[110 + i])
+                     for i, axis in enumerate(AXES)])
+
+    def accelerations(self):
+        return dict([(axis, self.settings[120 + i])
+                     for i, axis in enumerate(AXES)])
+
+    def wco(self):
+        return self.wcs[self.wcs_active]
+
+    def current_block(self, now=None):
+        """
+        Retire finished blocks and return (block, dt into it)
+        """
+        if now is None:
+            now = time.time()
+        while self.blocks:
+            block = self.blocks[0]
+            if self.hold and self.hold_t is not None:
+                now = min(now, self.hold_t)
+            dt = now - block.t_start
+            if dt < block.duration:
+                return block, dt
+            self.blocks.popleft()
+            self.mpos = dict(block.end)
+            if self.blocks:
+                self.blocks[0].t_start = block.t_start + block.duration
+        return None, 0.0
+
+    def current_position(self):
+        block, dt = self.current_block()
+        if block is None:
+            return dict(self.mpos)
+        return block.position(dt)[0]
+
+    def current_speed(self):
+        block, dt = self.current_block()
+        if block is None:
+            return 0.0
+        return block.position(dt)[1]
+
+    def plan_end(self):
+        if self.blocks:
+            return dict(self.blocks[-1].end)
+        return dict(self.mpos)
+
+    def add_block(self, block):
+        if block.duration <= 0.0:
+            return
+        if not self.blocks:
+            block.t_start = time.time()
+        self.blocks.append(block)
+        self.moves += 1
+
+    def stop_motion(self, keep_queued=False):
+        """
+        Decelerate the current block to a stop
+        """
+        block, dt = self.current_block()
+        if block is None:
+            return
+        stop = block.stop_block(dt, self.max_rates(), self.accelerations())
+        self.blocks.popleft()
+        queued = list(self.blocks) if keep_queued else []
+        self.blocks.clear()
+        stop.t_start = time.time()
+        if stop.duration > 0.0:
+            self.blocks.append(stop)
+        else:
+            self.mpos = dict(stop.start)
+        self.blocks.extend(queued)
+
+    def jog_cancel(self):
+        # Only effective while jogging
+        block, _dt = self.current_block()
+        if block is None or not block.jog:
+            return
+        self.log("jog cancel")
+        self.stop_motion()
+        # Jog lines not yet planned are flushed too
+        if self.pending_line and self.pending_line.upper().startswith("$J="):
+            self.pending_line = None
+
+    def feed_hold(self):
+        block, dt = self.current_block()
+        if block is None or self.hold:
+            return
+        if block.jog:
+            # Feed hold during a jog is a jog cancel
+            return self.jog_cancel()
+        self.stop_motion(keep_queued=True)
+        self.hold = True
+        stop = self.blocks[0] if self.blocks else None
+        # Freeze once decelerated
+        self.hold_t = stop.t_start + stop.duration if stop else time.time()
+
+    def cycle_start(self):
+        if not self.hold:
+            return
+        now = time.time()
+        # Finish the stop block then resume the rest
+        if self.blocks:
+            stop = self.blocks.popleft()
+            self.mpos = dict(stop.end)
+        if self.blocks:
+            self.blocks[0].t_start = now
+        self.hold = False
+        self.hold_t = None
+
+    def state(self):
+        if self.alarm:
+            return "Alarm"
+        if self.homing:
+            return "Home"
+        block, dt = self.current_block()
+        if self.hold:
+            return "Hold:1" if time.time() < self.hold_t else "Hold:0"
+        if block is not None:
+            return "Jog" if block.jog else "Run"
+        return "Idle"
+
+    def report_status(self):
+        """
+        <Idle|MPos:0.000,0.000,0.000|FS:0,0|WCO:0.000,0.000,0.000>
+        """
+        self.status_reports += 1
+        state = self.state()
+        parts = [
+            state,
+            "MPos:" + format_axes(self.current_position()),
+            "FS:%u,0" % (self.current_speed() * 60.0, ),
+        ]
+        # Refresh more often when idle like GRBL
+        if self.wco_count <= 0:
+            self.wco_count = REPORT_WCO_REFRESH if state == "Idle" else 3 * REPORT_WCO_REFRESH
+            parts.append("WCO:" + format_axes(self.wco()))
+        else:
+            self.wco_count -= 1
+        if self.ovr_count <= 0:
+            self.ovr_count = REPORT_OVR_REFRESH
+            parts.append("Ov:100,100,100")
+        else:
+            self.ovr_count -= 1
+        self.send("<%s>" % "|".join(parts), status=True)
+
+    """
+    Line execution
+    """
+
+    def busy(self):
+        """
+        Can't take another line yet (planner full, homing, dwell)
+        """
+        now = time.time()
+        if self.homing:
+            if now < self.homing:
+                return True
+            self.home_done()
+        if self.dwell_until is not None:
+            if now < self.dwell_until or self.blocks:
+                return True
+            self.dwell_until = None
+            self.send("ok")
+        self.current_block(now)
+        return len(self.blocks) >= BLOCK_BUFFER_SIZE
+
+    def synced(self):
+        self.current_block()
+        return not self.blocks and not self.hold
+
+    def poll_lines(self):
+        while not self.busy():
+            if self.pending_line is None:
+                self.pending_line = self.next_line()
+                if self.pending_line is None:
+                    return
+                self.lines_rx += 1
+            line = self.pending_line
+            # Some commands wait for motion to complete
+            if self.needs_sync(line) and not self.synced():
+                return
+            self.pending_line = None
+            self.log("rx '%s'" % (line, ))
+            try:
+                if self.execute_line(line):
+                    continue
+                self.send("ok")
+            except EmulatorError as e:
+                self.log("error %u on '%s'" % (e.code, line))
+                self.send("error:%u" % e.code)
+
+    def needs_sync(self, line):
+        line = "".join(line.split()).upper()
+        return bool(SYNC_RE.match(line))
+
+    def execute_line(self, line):
+        """
+        Return True if the response (ok) is deferred
+        """
+        line = "".join(line.split()).upper()
+        if not line:
+            return False
+        if len(line) > LINE_BUFFER_SIZE:
+            raise EmulatorError(ERROR_OVERFLOW)
+        if line[0] == "$":
+            return self.execute_system(line)
+        if self.alarm:
+            raise EmulatorError(ERROR_SYSTEM_GC_LOCK)
+        if self.state() == "Jog":
+            raise EmulatorError(ERROR_SYSTEM_GC_LOCK)
+        return self.execute_gcode(line)
+
+    def execute_system(self, line):
+        if line == "$":
+            self.send(
+                "[HLP:$$ $# $G $I $N $x=val $Nx=line $J=line $SLP $C $X $H ~ ! ? ctrl-x]"
+            )
+        elif line == "$$":
+            for k, v in self.settings.items():
+                self.send(format_setting(k, v))
+        elif line == "$#":
+            for i in range(1, 7):
+                self.send("[G%u:%s]" % (53 + i, format_axes(self.wcs[i])))
+            self.send("[G28:0.000,0.000,0.000]")
+            self.send("[G30:0.000,0.000,0.000]")
+            self.send("[G92:0.000,0.000,0.000]")
+            self.send("[TLO:0.000]")
+            self.send("[PRB:0.000,0.000,0.000:0]")
+        elif line == "$G":
+            self.send("[GC:%s G%u G17 G21 %s G94 M5 M9 T%u F%u S0]" %
+                      (self.motion_mode, 53 + self.wcs_active,
+                       self.distance_mode, self.tool, self.feed))
+        elif line == "$I":
+            self.send("[VER:1.1h.20190825:]")
+            self.send("[OPT:%s,%u,%u]" %
+                      (self.options, BLOCK_BUFFER_SIZE, RX_BUFFER_SIZE))
+        elif line == "$N":
+            self.send("$N0=")
+            self.send("$N1=")
+        elif line == "$X":
+            if self.alarm:
+                self.alarm = False
+                self.send("[MSG:Caution: Unlocked]")
+        elif line == "$H":
+            if not self.settings[22]:
+                raise EmulatorError(ERROR_SETTING_DISABLED)
+            self.alarm = False
+            self.homing = time.time() + self.homing_time
+            # ok once done, see home_done()
+            return True
+        elif line.startswith("$J="):
+            if self.alarm or self.state() not in ("Idle", "Jog"):
+                raise EmulatorError(ERROR_IDLE_ERROR)
+            self.execute_jog(line[3:])
+        elif "=" in line:
+            if self.state() not in ("Idle", "Alarm"):
+                raise EmulatorError(ERROR_IDLE_ERROR)
+            k, v = line[1:].split("=", 1)
+            try:
+                k = int(k)
+                v = float(v)
+            except ValueError:
+                raise EmulatorError(ERROR_BAD_NUMBER)
+            if k not in self.settings:
+                raise EmulatorError(ERROR_INVALID_STATEMENT)
+            self.settings[k] = int(v) if k in INT_SETTINGS else v
+        else:
+            raise EmulatorError(ERROR_INVALID_STATEMENT)
+        return False
+
+    def home_done(self):
+        self.homing = None
+        pulloff = self.settings[27]
+        self.mpos = dict([(axis, -pulloff) for axis in AXES])
+        self.homed = True
+        self.send("ok")
+
+    def parse_words(self, line):
+        """
+        "G90X1.5F100" => [("G", 90.0), ("X", 1.5), ("F", 100.0)]
+        """
+        ret = []
+        i = 0
+        while i < len(line):
+            m = WORD_RE.match(line, i)
+            if not m or not m.group(2) or m.group(2) in "+-.":
+                raise EmulatorError(ERROR_BAD_NUMBER)
+            ret.append((m.group(1), float(m.group(2))))
+            i = m.end()
+        return ret
+
+    def target(self, axes, distance_mode, machine=False):
+        """
+        Machine position for the axis words of a move
+        """
+        ret = self.plan_end()
+        wco = self.wco()
+        for axis, v in axes.items():
+            if distance_mode == "G91":
+                ret[axis] += v
+            elif machine:
+                ret[axis] = v
+            else:
+                ret[axis] = v + wco[axis]
+        return ret
+
+    def check_soft_limits(self, pos):
+        if not self.settings[20]:
+            return
+        for i, axis in enumerate(AXES):
+            # Machine space is -max travel to 0
+            if pos[axis] > 0.0 or pos[axis] < -self.settings[130 + i]:
+                raise EmulatorError(ERROR_TRAVEL_EXCEEDED)
+
+    def execute_jog(self, line):
+        """
+        $J=G91 X1.0 F100
+        Only G20/G21, G53, G90/G91, axis words and F are allowed
+        """
+        distance_mode = self.distance_mode
+        machine = False
+        axes = {}
+        feed = None
+        for letter, value in self.parse_words(line):
+            if letter == "G":
+                if value in (90, 91):
+                    distance_mode = "G%u" % value
+                elif value == 53:
+                    machine = True
+                elif value in (20, 21):
+                    pass
+                else:
+                    raise EmulatorError(ERROR_INVALID_JOG_COMMAND)
+            elif letter.lower() in AXES:
+                axes[letter.lower()] = value
+            elif letter == "F":
+                feed = value
+            else:
+                raise EmulatorError(ERROR_INVALID_JOG_COMMAND)
+        if feed is None:
+            raise EmulatorError(ERROR_UNDEFINED_FEED_RATE)
+        if not axes:
+            raise EmulatorError(ERROR_NO_AXIS_WORDS)
+        start = self.plan_end()
+        end = self.target(axes, distance_mode, machine=machine)
+        self.check_soft_limits(end)
+        self.add_block(
+            Block(start,
+                  end,
+                  feed,
+                  self.max_rates(),
+                  self.accelerations(),
+                  jog=True))
+
+    def execute_gcode(self, line):
+        words = self.parse_words(line)
+        gs = [v for letter, v in words if letter == "G"]
+        values = dict([(letter, v) for letter, v in words if letter != "G"])
+        axes = dict([(k.lower(), v) for k, v in values.items()
+                     if k.lower() in AXES])
+
+        if 10 in gs:
+            return self.execute_g10(values, axes)
+        if 4 in gs:
+            self.dwell_until = time.time() + values.get("P", 0.0)
+            return True
+        machine = False
+        for g in gs:
+            if g in (90, 91):
+                self.distance_mode = "G%u" % g
+            elif g in (0, 1):
+                self.motion_mode = "G%u" % g
+            elif 54 <= g <= 59:
+                self.wcs_active = int(g) - 53
+            elif g == 53:
+                machine = True
+            elif g in (17, 20, 21, 94):
+                pass
+            else:
+                raise EmulatorError(ERROR_UNSUPPORTED_COMMAND)
+        for letter, v in values.items():
+            if letter == "T":
+                self.tool = int(v)
+            elif letter == "F":
+                self.feed = v
+            elif letter in "MS" or letter.lower() in AXES:
+                pass
+            else:
+                raise EmulatorError(ERROR_UNSUPPORTED_COMMAND)
+        if axes:
+            if self.motion_mode == "G0":
+                feed = max(self.max_rates().values()) * 2
+            else:
+                if not self.feed:
+                    raise EmulatorError(ERROR_UNDEFINED_FEED_RATE)
+                feed = self.feed
+            start = self.plan_end()
+            end = self.target(axes, self.distance_mode, machine=machine)
+            self.check_soft_limits(end)
+            self.add_block(
+                Block(start, end, feed, self.max_rates(),
+                      self.accelerations()))
+        return False
+
+    def execute_g10(self, values, axes):
+        """
+        G10 L2 P2 X1 Y2 Z3: set WCS 2 offsets
+        G10 L20 P2 X0: set WCS 2 so that the current position is X0
+        """
+        l = values.get("L")
+        p = int(values.get("P", 0))
+        if p == 0:
+            p = self.wcs_active
+        if l not in (2, 20) or not 1 <= p <= 6:
+            raise EmulatorError(ERROR_UNSUPPORTED_COMMAND)
+        for axis, v in axes.items():
+            if l == 2:
+                self.wcs[p][axis] = v
+            else:
+                self.wcs[p][axis] = self.mpos[axis] - v
+        return False
+
+    """
+    Main loop
+    """
+
+    def run(self):
+        while self.running.is_set():
+            try:
+                readable, _w, _x = select.select([self.master], [], [], 0.001)
+            except (OSError, ValueError):
+                break
+            with self.lock:
+                if readable:
+                    try:
+                        data = os.read(self.master, 1024)
+                    except (BlockingIOError, OSError):
+                        # Nobody has the port open
+                        data = b""
+                    self.rx(data)
+                self.poll_lines()
+                self.flush_tx()
@@ -5,6 +5,7 @@ from collections import OrderedDict
 from uscope.util import time_str
 from uscope.motion.motion_util import parse_move
 import threading
+import numpy as np
 
 
 class AxisExceeded(ValueError):
@@ -59,6 +60,12 @@ class MotionCritical(Exception):
     pass
 
 
+# stop() / estop() aborted an operation before it completed
+# Ex: a move_path() with waypoints left
+class MotionStop(Exception):
+    pass
+
+
 class MotionModifier:
     def __init__(self, motion):
         self.motion = motion
@@ -73,6 +80,19 @@ class MotionModifier:
     def move_absolute_post(self, ok, options={}):
         pass
 
+    def move_path_pre(self, path, options={}):
+        """
+        Called once with every segment of a batched move (see MotionHAL.move_path())
+        path: list of {"pos": abs pos, "waypoint": index or None, "dwell": sec}
+        Edit in place, including adding segments
+        Default: stateless modifiers can apply their move_absolute_pre() per segment
+        """
+        for segment in path:
+            self.move_absolute_pre(segment["pos"], options=options)
+
+    def move_path_post(self, ok, options={}):
+        pass
+
     def move_relative_pre(self, pos, options={}):
         pass
 
@@ -160,9 +180,11 @@ class BacklashMM(MotionModifier):
         self.compensation = compensation
         self.compensated = {}
 
-    def should_compensate(self, move_to, cur_pos=None):
+    def should_compensate(self, move_to, cur_pos=None, compensated=None):
         if cur_pos is None:
             cur_pos = self.motion.cur_pos_cache()
+        if compensated is None:
+            compensated = self.compensated
         ret = {}
         for axis, val in move_to.items():
             ret[axis] = {
@@ -174,7 +196,7 @@ class BacklashMM(MotionModifier):
             # Skip check?
             if not self.enabled.get(axis, False):
                 # maybe this should be in post
-                self.compensated[axis] = False
+                compensated[axis] = False
                 continue
             if self.backlash[axis] == 0.0:
                 continue
@@ -185,8 +207,8 @@ class BacklashMM(MotionModifier):
 
             # Already compensated and still moving in the same direction?
             # No compensation necessary
-            if self.compensated[axis] and (
-                    delta == 0.0 or sign(delta) == self.compensation[axis]):
+            if compensated[axis] and (delta == 0.0 or sign(delta)
+                                      == self.compensation[axis]):
                 continue
             # A correction is possibly needed then
             # Will the movement itself compensate?
@@ -198,7 +220,7 @@ class BacklashMM(MotionModifier):
                 continue
 
             # Rounding error that a movement won't improve?
-            if self.compensated[axis] and self.motion.equivalent_axis_pos(
+            if compensated[axis] and self.motion.equivalent_axis_pos(
                     axis=axis, value1=val, value2=cur_pos[axis]):
                 continue
 
@@ -206,7 +228,7 @@ class BacklashMM(MotionModifier):
                 self.log("z comp trig ")
                 self.log("  compensation: %s" % (self.compensation[axis], ))
                 self.log("  backlash: %f" % (self.backlash[axis], ))
-                self.log("  compensated: %s" % (self.compensated[axis], ))
+                self.log("  compensated: %s" % (compensated[axis], ))
                 self.log("  delta: %f" % (delta, ))
                 self.log("  val: %f" % (val, ))
                 self.log("  cur_pos: %f" % (cur_pos[axis], ))
@@ -214,23 +236,25 @@ class BacklashMM(MotionModifier):
             ret[axis]["delta"] = delta
         return ret
 
-    def move_x_pre_simple(self, dst_abs_pos, options={}):
+    def plan_compensation(self, dst_abs_pos, cur_pos=None, compensated=None):
         """
-        Simple model for now:
-        -Assume move completes
-        -Only track when big moves move us into a clear state
-            ie moves need to be bigger than the backlash threshold to count
+        Return (all_abs, corrections_abs, pending_compensation)
+        all_abs: position to move to first if corrections_abs is not empty
+        corrections_abs: axes that need a backlash move before dst_abs_pos
+        pending_compensation: axes the move itself will compensate
         """
         corrections_abs = {}
         all_abs = {}
-        self.pending_compensation = {}
-        comp_res = self.should_compensate(move_to=dst_abs_pos).items()
+        pending_compensation = {}
+        comp_res = self.should_compensate(move_to=dst_abs_pos,
+                                          cur_pos=cur_pos,
+                                          compensated=compensated).items()
         for axis, axis_compensation in comp_res:
             backlash_pos = dst_abs_pos[
                 axis] - self.compensation[axis] * self.backlash[axis]
 
             if axis_compensation["auto"]:
-                self.pending_compensation[axis] = True
+                pending_compensation[axis] = True
 
             if axis_compensation["needed"]:
                 # Need to manually compensate
@@ -242,12 +266,22 @@ class BacklashMM(MotionModifier):
                 all_abs[axis] = backlash_pos
             else:
                 all_abs[axis] = dst_abs_pos[axis]
+        return all_abs, corrections_abs, pending_compensation
+
+    def move_x_pre_simple(self, dst_abs_pos, options={}):
+        """
+        Simple model for now:
+        -Assume move completes
+        -Only track when big moves move us into a clear state
+            ie moves need to be bigger than the backlash threshold to count
+        """
+        all_abs, corrections_abs, self.pending_compensation = self.plan_compensation(
+            dst_abs_pos)
 
         if 0:
             print("DEBUG")
             print("  cur ", self.motion.cur_pos_cache())
             print("  dst ", dst_abs_pos)
-            print("  res ", comp_res)
             print("  cor ", corrections_abs)
             print("  com ", self.compensation)
             print("  is  ", self.compensated)
@@ -264,6 +298,43 @@ class BacklashMM(MotionModifier):
             for axis in corrections_abs.keys():
                 self.compensated[axis] = True
 
+    def wiggle_positions(self, dst_abs_pos, cur_pos):
+        """
+        Return the list of absolute moves that vibrate axes into dst_abs_pos
+        """
+        ret = []
+        # TODO: this will require some experiments how to get nice wiggle
+        # Ex: log vs linear approach, how much back / forth
+        for divisor in (1, 8, 64, 512):
+            next_abs_pos = {}
+            deltas = {}
+            for axis, axis_pos in dst_abs_pos.items():
+                # Rounding error that a movement won't improve?
+                if self.motion.equivalent_axis_pos(axis=axis,
+                                                   value1=axis_pos,
+                                                   value2=cur_pos[axis]):
+                    continue
+                axis_delta = -(self.compensation[axis] *
+                               self.backlash[axis]) / divisor
+                deltas[axis] = axis_delta
+                next_pos = axis_pos + axis_delta
+                # Delta so small now won't matter?
+                if self.motion.equivalent_axis_pos(axis=axis,
+                                                   value1=next_pos,
+                                                   value2=cur_pos[axis]):
+                    continue
+                next_abs_pos[axis] = next_pos
+            # Eventually delta should be small enough not to be significant
+            if not len(next_abs_pos):
+                break
+            # Move closer
+            ret.append(dict(next_abs_pos))
+            # Now slight vibrate back to add some shake
+            for k in next_abs_pos.keys():
+                next_abs_pos[k] -= deltas[k] / 4
+            ret.append(next_abs_pos)
+        return ret
+
     def move_x_pre_wiggle(self, dst_abs_pos, options={}):
         """
         Vibrate axes into place
@@ -277,37 +348,8 @@ class BacklashMM(MotionModifier):
         self.recursing = True
         try:
             self.pending_compensation = {}
-            # TODO: this will require some experiments how to get nice wiggle
-            # Ex: log vs linear approach, how much back / forth
-            for divisor in (1, 8, 64, 512):
-                next_abs_pos = {}
-                deltas = {}
-                for axis, axis_pos in dst_abs_pos.items():
-                    # Rounding error that a movement won't improve?
-                    if self.motion.equivalent_axis_pos(axis=axis,
-                                                       value1=axis_pos,
-                                                       value2=cur_pos[axis]):
-                        continue
-                    axis_delta = -(self.compensation[axis] *
-                                   self.backlash[axis]) / divisor
-                    deltas[axis] = axis_delta
-                    next_pos = axis_pos + axis_delta
-                    # Delta so small now won't matter?
-                    if self.motion.equivalent_axis_pos(axis=axis,
-                                                       value1=next_pos,
-                                                       value2=cur_pos[axis]):
-                        continue
-                    next_abs_pos[axis] = next_pos
-                # Eventually delta should be small enough not to be significant
-                if not len(next_abs_pos):
-                    return
-                # Move closer
-                print("wiggle phase 1", next_abs_pos)
-                self.motion.move_absolute(next_abs_pos)
-                # Now slight vibrate back to add some shake
-                for k in next_abs_pos.keys():
-                    next_abs_pos[k] -= deltas[k] / 4
-                print("wiggle phase 2", next_abs_pos)
+            for next_abs_pos in self.wiggle_positions(dst_abs_pos, cur_pos):
+                print("wiggle", next_abs_pos)
                 self.motion.move_absolute(next_abs_pos)
         finally:
             self.recursing = False
@@ -359,6 +401,45 @@ class BacklashMM(MotionModifier):
             self.compensated[axis] = True
         self.pending_compensation = None
 
+    def move_path_pre(self, path, options={}):
+        """
+        Plan compensation for the whole path up front
+        Compensation moves become extra segments ahead of their waypoint
+        """
+        cur_pos = dict(self.motion.cur_pos_cache())
+        compensated = dict(self.compensated)
+        ret = []
+        for segment in path:
+            dst_abs_pos = segment["pos"]
+            if self.wiggle:
+                for pos in self.wiggle_positions(dst_abs_pos, cur_pos):
+                    ret.append({"pos": pos, "waypoint": None, "dwell": 0.0})
+            else:
+                all_abs, corrections_abs, pending_compensation = self.plan_compensation(
+                    dst_abs_pos, cur_pos=cur_pos, compensated=compensated)
+                if len(corrections_abs):
+                    ret.append({
+                        "pos": all_abs,
+                        "waypoint": None,
+                        "dwell": 0.0
+                    })
+                for axis in list(corrections_abs.keys()) + list(
+                        pending_compensation.keys()):
+                    compensated[axis] = True
+            ret.append(segment)
+            cur_pos.update(dst_abs_pos)
+        path[:] = ret
+        self.pending_compensation = compensated
+
+    def move_path_post(self, ok, options={}):
+        if ok:
+            self.compensated = self.pending_compensation
+        else:
+            # Unknown how far we got
+            for axis in self.compensated.keys():
+                self.compensated[axis] = False
+        self.pending_compensation = None
+
 
 """
 Throw an exception if axis out of expected range
@@ -387,6 +468,35 @@ class SoftLimitMM(MotionModifier):
                         "axis %s: move violates %0.3f <= new pos %0.3f <= %0.3f"
                         % (axis, axmin, axpos, axmax))
 
+    def move_path_pre(self, path, options={}):
+        """
+        Check the whole path before anything moves
+        """
+        cur_pos_xyz = self.motion.cur_pos_cache()
+        for axis, limit in self.soft_limits.items():
+            if not limit:
+                continue
+            axmin, axmax = limit
+            segmentis = [
+                segmenti for segmenti, segment in enumerate(path)
+                if axis in segment["pos"]
+            ]
+            if not segmentis:
+                continue
+            dsts = np.array([path[i]["pos"][axis] for i in segmentis])
+            srcs = np.concatenate(([cur_pos_xyz[axis]], dsts[:-1]))
+            # Same rounding allowance as axis_pos_in_range()
+            tolerance = 2 * self.motion.epsilon()[axis]
+            # Reject if its out of bounds and making things worse
+            bad = ((dsts < axmin - tolerance) &
+                   (dsts < srcs)) | ((dsts > axmax + tolerance) &
+                                     (dsts > srcs))
+            if bad.any():
+                badi = int(np.argmax(bad))
+                raise AxisExceeded(
+                    "axis %s: path segment %u violates %0.3f <= new pos %0.3f <= %0.3f"
+                    % (axis, segmentis[badi], axmin, dsts[badi], axmax))
+
     def move_relative_pre(self, pos, cur_pos=None, options={}):
         assert 0, "FIXME: unsupported"
         if cur_pos is None:
@@ -1113,6 +1223,85 @@ class MotionHAL:
     def move_absolute_str(self, pos, options={}):
         self.move_absolute(parse_move(pos), options=options)
 
+    def move_path(self, waypoints, dwells=None, reached=None, options={}):
+        """
+        Absolute move through each position in waypoints
+        Modifiers process the whole path once and backends that can queue
+        motion get it all at once instead of a round trip per point
+        dwells: seconds to hold at each waypoint. A single number applies to all
+        reached: called as reached(index, pos) as each waypoint is reached
+        """
+        for index, pos in self.move_path_iter(waypoints,
+                                              dwells=dwells,
+                                              options=options):
+            if reached:
+                reached(index, pos)
+
+    def move_path_iter(self, waypoints, dwells=None, options={}):
+        """
+        Generator version of move_path()
+        Yields (index, pos) as each waypoint is reached
+        Without a dwell motion resumes when the next waypoint is requested
+        With a dwell the controller may continue once the dwell expires
+        Closing early stops after any motion already queued
+        """
+        assert self.jog_estimated_end is None, f"Can't move while jogging ({self.jog_estimated_end})"
+        self.check_thread_safety()
+        waypoints = [dict(pos) for pos in waypoints]
+        if dwells is None:
+            dwells = 0.0
+        if type(dwells) in (int, float):
+            dwells = [dwells] * len(waypoints)
+        if len(dwells) != len(waypoints):
+            raise ValueError("Got %u dwells for %u waypoints" %
+                             (len(dwells), len(waypoints)))
+        path = []
+        for index, (pos, dwell) in enumerate(zip(waypoints, dwells)):
+            self.validate_axes(pos.keys())
+            if dwell < 0:
+                raise ValueError("Negative dwell %s" % (dwell, ))
+            path.append({
+                "pos": dict(pos),
+                "waypoint": index,
+                "dwell": float(dwell)
+            })
+        self.verbose and print("motion: move_path(%u waypoints)" %
+                               (len(waypoints), ))
+        self.cur_pos_cache_invalidate()
+        ok = False
+        try:
+            for modifier in self.iter_active_modifiers():
+                modifier.move_path_pre(path, options=options)
+            for index in self._move_path_iter(path):
+                self.mv_lastt = time.time()
+                self.cur_pos_cache_invalidate()
+                yield index, dict(waypoints[index])
+            ok = True
+        finally:
+            for modifier in self.iter_active_modifiers():
+                modifier.move_path_post(ok, options=options)
+            self.mv_lastt = time.time()
+            self.cur_pos_cache_invalidate()
+
+    def _move_path_iter(self, path):
+        """
+        Move through modifier processed path segments
+        Yield each waypoint index as its segment is reached
+        Default: one blocking move per segment
+        Override to queue the path in the controller
+        """
+        for segment in path:
+            if segment["pos"]:
+                self._move_absolute(dict(segment["pos"]))
+            if segment["waypoint"] is None:
+                continue
+            treached = time.time()
+            yield segment["waypoint"]
+            # Dwell starts on arrival, not once the caller is done
+            dwell = segment["dwell"] - (time.time() - treached)
+            if dwell > 0:
+                time.sleep(dwell)
+
     def update_backlash(self, cur_pos, abs_pos):
         pass
 
@@ -1449,21 +1638,22 @@ class MockHal(MotionHAL):
             self._pos_cache[axis] = 0.0
 
     def _move_absolute(self, pos):
+        # update_status() modifiers scale in place: pass a copy
         for axis, apos in pos.items():
             self._pos_cache[axis] = apos
         0 and self._log('absolute move to ' + pos_str(pos))
-        self.update_status({"pos": self._pos_cache})
+        self.update_status({"pos": dict(self._pos_cache)})
 
     def _move_relative(self, delta):
         for axis, adelta in delta.items():
             self._pos_cache[axis] += adelta
         0 and self._log('relative move to ' + pos_str(delta))
-        self.update_status({"pos": self._pos_cache})
+        self.update_status({"pos": dict(self._pos_cache)})
 
     def _jog(self, axes, rate):
         for axis, adelta in axes.items():
             self._pos_cache[axis] += adelta
-        self.update_status({"pos": self._pos_cache})
+        self.update_status({"pos": dict(self._pos_cache)})
 
     def _pos(self):
         return self._pos_cache
@@ -38,6 +38,11 @@ class LcncHal(MotionHAL):
             'G90 ' + self.g_feed() +
             ''.join([' %c%0.3f' % (k.upper(), v) for k, v in pos.items()]))
 
+    def _move_absolute(self, pos):
+        # Used by move_path()
+        # MDI commands block until idle so there is nothing to queue
+        self.move_absolute(pos)
+
     def move_relative(self, delta):
         if len(delta) == 0:
             return
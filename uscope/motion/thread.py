@@ -1,5 +1,5 @@
 from uscope.motion.plugins import get_motion_hal
-from uscope.motion.hal import AxisExceeded, MotionHAL, MotionCritical
+from uscope.motion.hal import AxisExceeded, MotionHAL, MotionCritical, MotionStop
 from uscope.threads import CommandThreadBase
 
 import threading
@@ -39,6 +39,30 @@ class MotionThreadMotion(MotionHAL):
     def _move_relative(self, pos):
         self.mt.move_relative(pos, block=True)
 
+    def move_path_iter(self, waypoints, dwells=None, options={}):
+        """
+        Hand the whole path to the real HAL so its modifiers and motion queue
+        (ex: GrblHal streaming) see it at once
+        Each waypoint is fetched with its own command so stop() still gets
+        through between waypoints
+        """
+        ret = self.mt.move_path_start(waypoints,
+                                      dwells=dwells,
+                                      options=options)
+        if isinstance(ret, Exception):
+            raise ret
+        try:
+            while True:
+                ret = self.mt.move_path_next()
+                self.cur_pos_cache_invalidate()
+                if isinstance(ret, Exception):
+                    raise ret
+                if ret is None:
+                    break
+                yield ret
+        finally:
+            self.mt.move_path_close()
+
     def _pos(self):
         # return self.mt.pos_cache
         return self.mt.pos()
@@ -184,6 +208,10 @@ class MotionThreadBase(CommandThreadBase):
         self._pos_cache = None
         self._stop = False
         self._estop = False
+        # Motion thread side of MotionThreadMotion.move_path_iter()
+        self._path_iter = None
+        # Path was aborted by stop / estop, not run to completion
+        self._path_stopped = False
         # XXX: add config directive
         self.allow_motion_reboot = False
         self._jog_enabled = True
@@ -276,6 +304,9 @@ class MotionThreadBase(CommandThreadBase):
 
     def stop(self):
         # self.command("stop")
+        # Also used by GUI stop / escape key
+        # Queued G1 path segments aren't flushed by a jog cancel:
+        # HAL stop() handles that (GRBL: feed hold + soft reset)
         self._stop = True
 
     def estop(self):
@@ -301,6 +332,31 @@ class MotionThreadBase(CommandThreadBase):
     def move_relative(self, pos, block=False, callback=None):
         self.command("move_relative", pos, block=block, callback=callback)
 
+    def move_path_start(self, waypoints, dwells=None, options={}):
+        return self.command("move_path_start",
+                            waypoints,
+                            dwells,
+                            options,
+                            block=True)
+
+    def move_path_next(self):
+        """
+        Return (index, pos) of the next waypoint reached or None when done
+        Returns (not raises) MotionStop if the path was stopped
+        """
+        return self.command("move_path_next", block=True)
+
+    def move_path_close(self):
+        self.command("move_path_close", block=True)
+
+    def _move_path_close(self, stopped=False):
+        path_iter = self._path_iter
+        self._path_iter = None
+        if path_iter is not None:
+            self._path_stopped = stopped
+            # Runs the HAL's cleanup (modifiers, wait for queued motion)
+            path_iter.close()
+
     def update_pos_cache(self):
         self.command("update_pos_cache")
 
@@ -313,9 +369,12 @@ class MotionThreadBase(CommandThreadBase):
     def queue_clear(self):
         while True:
             try:
-                self.queue.get(block=False)
+                command, args, command_done = self.queue.get(block=False)
             except queue.Empty:
                 break
+            # Don't leave a move_path_iter() caller blocked forever
+            if command.startswith("move_path_") and command_done:
+                command_done(command, args, MotionStop("Motion stopped"))
 
     def get_planner_motion(self):
         return MotionThreadMotion(self)
@@ -387,12 +446,15 @@ class MotionThreadBase(CommandThreadBase):
 
                 if self._estop:
                     self.motion.estop()
+                    self._move_path_close(stopped=True)
                     self.queue_clear()
                     self._estop = False
                     continue
 
                 if self._stop:
+                    # Flushes any path queued in the controller
                     self.motion.stop()
+                    self._move_path_close(stopped=True)
                     self.queue_clear()
                     self._stop = False
                     continue
@@ -428,6 +490,27 @@ class MotionThreadBase(CommandThreadBase):
                         self.log(str(e))
                     return self.motion.pos()
 
+                def move_path_start(waypoints, dwells, options):
+                    self._move_path_close()
+                    self._path_stopped = False
+                    self._path_iter = self.motion.move_path_iter(
+                        waypoints, dwells=dwells, options=options)
+
+                def move_path_next():
+                    if self._path_iter is None:
+                        if self._path_stopped:
+                            self._path_stopped = False
+                            return MotionStop("Motion stopped during path")
+                        return None
+                    try:
+                        return next(self._path_iter)
+                    except StopIteration:
+                        self._path_iter = None
+                        return None
+                    except Exception as e:
+                        self._path_iter = None
+                        return e
+
                 def update_pos_cache():
                     pos = self.motion.pos()
                     self._pos_cache = pos
@@ -444,6 +527,9 @@ class MotionThreadBase(CommandThreadBase):
                     'update_pos_cache': update_pos_cache,
                     'move_absolute': move_absolute,
                     'move_relative': move_relative,
+                    'move_path_start': move_path_start,
+                    'move_path_next': move_path_next,
+                    'move_path_close': self._move_path_close,
                     'jog_rel': self._jog_rel,
                     'jog_abs': self._jog_abs,
                     'jog_fractioned': self._jog_fractioned,
@@ -0,0 +1,170 @@
+"""
+Focus map: predict Z anywhere on the sample from a sparse set of focused points
+Used by PointGenerator3P to follow warped dies without autofocusing every tile
+"""
+
+import json
+import os
+import numpy as np
+
+FOCUS_MAP_METHODS = ("plane", "bilinear", "tps")
+
+
+def tps_kernel(r):
+    # r^2 log(r), defined as 0 at r = 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ret = r * r * np.log(r)
+    return np.nan_to_num(ret)
+
+
+class FocusMap:
+    """
+    Fit a smooth surface z(x, y) through focused stage positions
+    plane: least squares plane (needs 3 points)
+    bilinear: z = a + bx + cy + dxy least squares (needs 4 points)
+    tps: thin plate spline, exact (or smoothed) through points (needs 3 points)
+    Falls back to a simpler method until there are enough points
+    """
+    def __init__(self, method="tps", smoothing=0.0):
+        if method not in FOCUS_MAP_METHODS:
+            raise ValueError("Unknown focus map method %s, expect one of %s" %
+                             (method, ", ".join(FOCUS_MAP_METHODS)))
+        self.method = method
+        self.smoothing = smoothing
+        # [(x, y, z, source)]
+        self.points = []
+        # Measured - predicted before each new point was added
+        self.residuals = []
+        self.fit_method = None
+        self.coeffs = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, x, y, z, source="autofocus", refit=True):
+        """
+        Add a focused point
+        If the map already predicts here record how far off it was
+        """
+        if self.coeffs is not None:
+            self.residuals.append(float(z - self.predict(x, y)))
+        self.points.append((float(x), float(y), float(z), source))
+        if refit:
+            self.fit()
+
+    def xyz(self):
+        ret = np.array([point[0:3] for point in self.points], dtype=float)
+        return ret[:, 0], ret[:, 1], ret[:, 2]
+
+    def fit(self):
+        if len(self.points) == 0:
+            self.fit_method = None
+            self.coeffs = None
+            return
+        xs, ys, zs = self.xyz()
+        method = self.method
+        if method == "bilinear" and len(self.points) < 4:
+            method = "plane"
+        if method == "tps" and len(self.points) < 3:
+            method = "plane"
+        if method == "plane" and len(self.points) < 3:
+            # Not enough to tilt: assume flat
+            self.fit_method = "constant"
+            self.coeffs = float(np.mean(zs))
+            return
+
+        if method == "plane":
+            a = np.stack([np.ones_like(xs), xs, ys], axis=1)
+            self.coeffs = np.linalg.lstsq(a, zs, rcond=None)[0]
+        elif method == "bilinear":
+            a = np.stack([np.ones_like(xs), xs, ys, xs * ys], axis=1)
+            self.coeffs = np.linalg.lstsq(a, zs, rcond=None)[0]
+        elif method == "tps":
+            n = len(xs)
+            r = np.hypot(xs[:, None] - xs[None, :], ys[:, None] - ys[None, :])
+            k = tps_kernel(r) + self.smoothing * np.eye(n)
+            p = np.stack([np.ones_like(xs), xs, ys], axis=1)
+            a = np.zeros((n + 3, n + 3))
+            a[0:n, 0:n] = k
+            a[0:n, n:] = p
+            a[n:, 0:n] = p.T
+            b = np.zeros(n + 3)
+            b[0:n] = zs
+            # lstsq: collinear points make the affine part degenerate
+            self.coeffs = np.linalg.lstsq(a, b, rcond=None)[0]
+        self.fit_method = method
+
+    def predict(self, x, y):
+        """
+        Return predicted z at stage x, y
+        """
+        assert self.fit_method, "Focus map has no points"
+        if self.fit_method == "constant":
+            return self.coeffs
+        if self.fit_method == "plane":
+            return float(self.coeffs[0] + self.coeffs[1] * x +
+                         self.coeffs[2] * y)
+        if self.fit_method == "bilinear":
+            return float(self.coeffs[0] + self.coeffs[1] * x +
+                         self.coeffs[2] * y + self.coeffs[3] * x * y)
+        xs, ys, _zs = self.xyz()
+        n = len(xs)
+        w = self.coeffs[0:n]
+        affine = self.coeffs[n:]
+        r = np.hypot(xs - x, ys - y)
+        return float(
+            np.dot(w, tps_kernel(r)) + affine[0] + affine[1] * x +
+            affine[2] * y)
+
+    def residual_rms(self):
+        if not self.residuals:
+            return None
+        return float(np.sqrt(np.mean(np.square(self.residuals))))
+
+    def to_j(self):
+        return {
+            "method":
+            self.method,
+            "smoothing":
+            self.smoothing,
+            "points": [{
+                "x": x,
+                "y": y,
+                "z": z,
+                "source": source
+            } for x, y, z, source in self.points],
+            "residuals":
+            self.residuals,
+        }
+
+    @staticmethod
+    def from_j(j, method=None):
+        """
+        method: override the saved fit method
+        """
+        ret = FocusMap(method=method or j.get("method", "tps"),
+                       smoothing=j.get("smoothing", 0.0))
+        for point in j["points"]:
+            ret.add(point["x"],
+                    point["y"],
+                    point["z"],
+                    source=point.get("source", "autofocus"),
+                    refit=False)
+        ret.residuals = list(j.get("residuals", []))
+        ret.fit()
+        return ret
+
+
+def load_focus_map(fn, method=None):
+    """
+    Load a focus map saved by a previous scan
+    fn: uscan.json or the scan directory
+    """
+    if os.path.isdir(fn):
+        fn = os.path.join(fn, "uscan.json")
+    with open(fn, "r") as f:
+        j = json.load(f)
+    focus_map = j.get("points-xy3p", {}).get("focus-map")
+    if not focus_map:
+        raise ValueError("%s: no focus map" % (fn, ))
+    return FocusMap.from_j(focus_map, method=method)
@@ -100,6 +100,13 @@ class Planner:
 
         self.microscope = microscope
         self.se = None
+        # polarity such that can wait on being set
+        # Before the pipeline: plugins may check_yield() while setting up
+        self.unpaused = threading.Event()
+        self.unpaused.set()
+        self.running = True
+        # Filled in below. Plugins looking at each other see an empty one
+        self.pipeline = OrderedDict()
 
         if not meta_base:
             self.meta_base = {}
@@ -120,11 +127,6 @@ class Planner:
         # https://github.com/Labsmore/pyuscope/issues/180
         self.z_center = None
 
-        # polarity such that can wait on being set
-        self.unpaused = threading.Event()
-        self.unpaused.set()
-        self.running = True
-
     def make_pipeline(self, pipeline):
         # Currently pipeline elements must be unique by name
         ret = OrderedDict()
@@ -261,7 +263,9 @@ class Planner:
     def check_yield(self):
         # TODO: move check_running() fully over to StopEvent
         # might already be good enough, but do more conservative rollout
-        self.se.poll()
+        # None before run() (ex: PointGenerator3P refocusing corners)
+        if self.se:
+            self.se.poll()
         self.check_running()
         self.wait_unpaused()
 
@@ -297,22 +301,26 @@ class Planner:
 
     def run(self):
         with StopEvent(self.microscope) as self.se:
-            self.check_yield()
-            self.full_start_time = time.time()
-            self.scan_begin()
-            self.scan_start_time = time.time()
-            for state in self.run_pipeline():
+            try:
+                self.check_yield()
+                self.full_start_time = time.time()
+                self.scan_begin()
+                self.scan_start_time = time.time()
+                for state in self.run_pipeline():
+                    self.emit_progress(state)
+                self.scan_end_time = time.time()
+                self.check_yield()
+                self.scan_end()
+                meta = self.write_meta()
+                state = {
+                    "type": "meta",
+                    "meta": meta,
+                }
                 self.emit_progress(state)
-            self.scan_end_time = time.time()
-            self.check_yield()
-            self.scan_end()
-            meta = self.write_meta()
-            state = {
-                "type": "meta",
-                "meta": meta,
-            }
-            self.emit_progress(state)
-            return meta
+                return meta
+            finally:
+                for plugin in self.pipeline.values():
+                    plugin.scan_cleanup()
 
     def emit_progress(self, state):
         # self.pipeline["scraper"].emit_progress(state)
@@ -53,6 +53,8 @@ def microscope_to_planner_config(microscope,
         "calibration": microscope.calibration,
         "motion": {},
         "kinematics": {},
+        # Autofocus during scan needs NA, etc
+        "objective": objective,
     }
 
     if contour is not None:
@@ -87,6 +89,10 @@ def microscope_to_planner_config(microscope,
     v = usj["imager"].get("save_quality")
     if v:
         ret["imager"]["save_quality"] = v
+    for k in ("save_threads", "save_queue_depth", "save_spool"):
+        v = usj["imager"].get(k)
+        if v:
+            ret["imager"][k] = v
 
     v = usj["motion"].get("origin")
     if v:
@@ -25,6 +25,13 @@ class PlannerPlugin:
         """
         pass
 
+    def scan_cleanup(self):
+        """
+        Called once when the scan exits, including on error / abort
+        Release threads, etc
+        """
+        pass
+
     def gen_meta(self, meta):
         """
         Generate final metadata output
@@ -1,8 +1,14 @@
 import math
 from collections import OrderedDict
 import os
+import queue
+import threading
 import time
 from uscope.planner.plugin import PlannerPlugin, register_plugin
+from uscope.planner.planner import PlannerStop
+from uscope.spool import SpoolWriter, spool_fn
+from uscope.planner.scan_order import MotionModel, tile_excluded, excluded_tiles, pattern_order, optimize_order
+from uscope.planner.focus_map import FocusMap, load_focus_map
 from PIL import Image
 from uscope.imager.imager_util import get_scaled
 from uscope.motion.hal import pos_str
@@ -313,6 +319,8 @@ class PointGenerator2P(PlannerPlugin):
         # Number of images_actual taken at unique x, y coordinates
         # May be different than all_imags if image stacking
         self.itered_xy_points = 0
+        self.xy_gen = None
+        self.n_points = None
 
     def init_contour(self):
         contour = self.pc.j["points-xy2p"]["contour"]
@@ -385,15 +393,24 @@ class PointGenerator2P(PlannerPlugin):
     def calc_pos(self, ll_col, ll_row):
         return {"x": self.x.rc_pos(ll_col), "y": self.y.rc_pos(ll_row)}
 
+    def pos_generator(self):
+        # Cached: AUTO order can be expensive to compute
+        if self.xy_gen is None:
+            self.xy_gen = XYPosGenerator(rows=self.rows,
+                                         cols=self.cols,
+                                         calc_pos=self.calc_pos,
+                                         pc=self.pc,
+                                         motion=self.motion,
+                                         microscope=self.microscope,
+                                         log=self.log)
+        return self.xy_gen
+
     def gen_pos_ll_ul(self):
         # 2024-03-27
         # Should probably just drop the other algorithms at this point
         # Every major system now uses this
         if self.pc.motion_origin() == "ll":
-            for x in XYPosGenerator(rows=self.rows,
-                                    cols=self.cols,
-                                    calc_pos=self.calc_pos,
-                                    pc=self.pc).run():
+            for x in self.pos_generator().run():
                 yield x
             return
 
@@ -418,45 +435,32 @@ class PointGenerator2P(PlannerPlugin):
                     ul_row = self.rows - 1 - ll_row
                 else:
                     assert 0
+                if tile_excluded(self.pc.exclude(), ul_col, ul_row):
+                    continue
 
                 yield (pos, (ll_col, ll_row), (ul_col, ul_row))
 
-    """
-    def exclude(self, p):
-        (_xy, (cur_row, cur_col)) = p
-        for exclusion in self.pc.exclude():
-            '''
-            If neither limit is specified don't exclude
-            maybe later: if one limit is specified but not the other take it as the single bound
-            '''
-            r0 = exclusion.get('r0', float('inf'))
-            r1 = exclusion.get('r1', float('-inf'))
-            c0 = exclusion.get('c0', float('inf'))
-            c1 = exclusion.get('c1', float('-inf'))
-            if cur_row >= r0 and cur_row <= r1 and cur_col >= c0 and cur_col <= c1:
-                self.log('Excluding r%d, c%d on r%s:%s, c%s:%s' %
-                         (cur_row, cur_col, r0, r1, c0, c1))
-                return True
-        return False
-    """
-
     def gen_xys(self):
         for (x, y), _cr in self.gen_xycr():
             yield (x, y)
 
     def points_expected(self):
-        return self.rows * self.cols
+        # Less than rows * cols if tiles are excluded
+        if self.n_points is None:
+            self.n_points = len(list(self.gen_pos_ll_ul()))
+        return self.n_points
 
     def images_expected(self):
-        return self.rows * self.cols
+        return self.points_expected()
 
     def log_scan_begin(self):
         self.log("XY2P")
         # 2023-10-25: only ll origin is in use now
         # self.log("  Origin: %s" % self.origin)
         log_scan_xy_begin(self)
-        # Try actually generating the points and see if it matches how many we thought we were going to get
-        if self.pc.exclude():
+        if self.pc.motion_origin() == "ll":
+            self.pos_generator().log_order()
+        elif self.pc.exclude():
             self.log("  ROI exclusions active")
 
     def iterate(self, state):
@@ -511,6 +515,9 @@ class PointGenerator2P(PlannerPlugin):
             'points_generated': self.itered_xy_points,
             "points": points,
             "axes": axes,
+            # Not imaged on purpose: post processing shouldn't expect them
+            "excluded": excluded_tiles(self.pc.exclude(), self.cols,
+                                       self.rows),
         }
 
 
@@ -531,12 +538,25 @@ class XYPattern(Enum):
     # For reach row:
     # Start at right side and move left
     XP_XM = "x+:x-"
+    # For each column:
+    # Start at bottom and move up
     YM_YP = "y-:y+"
+    # For each column:
+    # Start at top and move down
     YP_YM = "y+:y-"
+    # Pick the order with the least estimated travel time
+    AUTO = "auto"
 
 
 class XYPosGenerator:
-    def __init__(self, rows, cols, calc_pos, pc):
+    def __init__(self,
+                 rows,
+                 cols,
+                 calc_pos,
+                 pc,
+                 motion=None,
+                 microscope=None,
+                 log=None):
         assert pc.motion_origin() == "ll"
         self.rows = rows
         self.cols = cols
@@ -552,26 +572,98 @@ class XYPosGenerator:
             self.serpentine = True
         print("XYPosGenerator", self.pattern, self.serpentine)
         self.calc_pos = calc_pos
+        self.exclusions = pc.exclude()
+        # Only needed for AUTO / estimates
+        self.motion = motion
+        self.microscope = microscope
+        self._motion_model = None
+        if log is None:
+            log = print
+        self.log = log
+        self.order_cache = None
+        self.order_name = None
 
-    def run(self):
-        if self.pattern in (XYPattern.XM_XP, XYPattern.XP_XM):
-            for ll_row in range(self.rows):
-                for ll_col in range(self.cols):
-                    # Start at right instead of left?
-                    if self.pattern == XYPattern.XP_XM:
-                        ll_col = self.cols - 1 - ll_col
-                    if self.serpentine:
-                        if ll_row % 2 == 1:
-                            ll_col = self.cols - 1 - ll_col
-
-                    pos = self.calc_pos(ll_col, ll_row)
-                    ul_col = ll_col
-                    ul_row = self.rows - 1 - ll_row
-                    yield (pos, (ll_col, ll_row), (ul_col, ul_row))
+    def motion_model(self):
+        if self._motion_model is None:
+            assert self.motion, "Travel time estimate requires motion"
+            self._motion_model = MotionModel.from_motion(
+                self.motion, microscope=self.microscope)
+        return self._motion_model
+
+    def tiles(self):
+        """
+        Tiles to image as (ll_col, ll_row), skipping exclusions
+        """
+        ret = []
+        for ll_row in range(self.rows):
+            for ll_col in range(self.cols):
+                ul_row = self.rows - 1 - ll_row
+                if not tile_excluded(self.exclusions, ll_col, ul_row):
+                    ret.append((ll_col, ll_row))
+        return ret
+
+    def excluded(self):
+        return self.rows * self.cols - len(self.tiles())
+
+    def origin(self):
+        # Scans start from and return to the first corner
+        return self.calc_pos(0, 0)
+
+    def order(self):
+        """
+        Return tiles as (ll_col, ll_row) in the order they will be visited
+        """
+        if self.order_cache is not None:
+            return self.order_cache
+        tiles = self.tiles()
+        if self.pattern == XYPattern.AUTO:
+            self.order_cache, self.order_name, seconds = optimize_order(
+                tiles,
+                self.calc_pos,
+                self.motion_model(),
+                start=self.origin(),
+                end=self.origin())
+        elif self.pattern in (XYPattern.XM_XP, XYPattern.XP_XM):
+            self.order_cache = pattern_order(
+                tiles,
+                major="x",
+                reverse=self.pattern == XYPattern.XP_XM,
+                serpentine=self.serpentine)
+            self.order_name = self.pattern.value
         elif self.pattern in (XYPattern.YM_YP, XYPattern.YP_YM):
-            assert 0, "FIXME"
+            self.order_cache = pattern_order(
+                tiles,
+                major="y",
+                reverse=self.pattern == XYPattern.YP_YM,
+                serpentine=self.serpentine)
+            self.order_name = self.pattern.value
         else:
             assert 0, self.pattern
+        return self.order_cache
+
+    def estimate(self):
+        """
+        Estimated XY travel time in seconds, excluding settling / imaging
+        """
+        return self.motion_model().path_time(
+            [self.calc_pos(*tile) for tile in self.order()],
+            start=self.origin(),
+            end=self.origin())
+
+    def log_order(self):
+        order = self.order()
+        self.log("  XY order: %s, %u tiles" % (self.order_name, len(order)))
+        if self.exclusions:
+            self.log("  Excluded tiles: %u" % (self.excluded(), ))
+        if self.motion:
+            self.log("  Estimated XY travel: %0.1f sec" % (self.estimate(), ))
+
+    def run(self):
+        for ll_col, ll_row in self.order():
+            pos = self.calc_pos(ll_col, ll_row)
+            ul_col = ll_col
+            ul_row = self.rows - 1 - ll_row
+            yield (pos, (ll_col, ll_row), (ul_col, ul_row))
 
 
 class PointGenerator3P(PlannerPlugin):
@@ -586,12 +678,22 @@ class PointGenerator3P(PlannerPlugin):
         -lower left (origin)
         -lower right
         """
+        # Created on first use. setup_bounds() may refocus corners
+        self.af = None
         self.setup_bounds()
         self.setup_axes()
         self.calc_per_rc()
         self.itered_xy_points = 0
         assert self.pc.motion_origin() == "ll"
         self.xy_pattern = self.pc.xy_pattern()
+        self.xy_gen = XYPosGenerator(rows=self.rows,
+                                     cols=self.cols,
+                                     calc_pos=self.calc_pos,
+                                     pc=self.pc,
+                                     motion=self.motion,
+                                     microscope=self.microscope,
+                                     log=self.log)
+        self.setup_focus_map()
 
     def has_z(self, corners):
         ret = None
@@ -603,26 +705,104 @@ class PointGenerator3P(PlannerPlugin):
                 raise ValueError("Inconsistent z keys")
         return ret
 
+    def autofocus(self):
+        """
+        Focus at the current position and return the new position
+        """
+        objective = self.pc.objective()
+        if objective is None:
+            raise ValueError("Autofocus during scan requires objective config")
+        if self.af is None:
+            # Prefer the scan's settle times
+            if "kinematics" in self.planner.pipeline:
+                kinematics = self.planner.pipeline["kinematics"].kinematics
+            else:
+                kinematics = self.microscope.kinematics
+            self.af = Autofocus(self.microscope,
+                                move_absolute=self.af_move_absolute,
+                                pos=self.planner.motion.pos,
+                                imager=self.imager,
+                                kinematics=kinematics,
+                                log=self.log,
+                                poll=self.planner.check_yield)
+        self.planner.check_yield()
+        self.af.coarse(objective)
+        self.planner.check_yield()
+        return self.planner.motion.pos()
+
+    def af_move_absolute(self, pos, block=True):
+        # Autofocus uses the MotionThread API. HAL moves always block
+        self.motion.move_absolute(pos)
+
     def refocus_corners(self, corners):
         """
         Refocus corners before starting scan
         Intended for large batch jobs that may drift before the scan starts
         """
-        af = Autofocus(self.microscope,
-                       move_absolute=self.motion.move_absolute,
-                       pos=self.planner.motion.pos,
-                       imager=self.imager,
-                       kinematics=self.kinematics,
-                       log=self.log,
-                       poll=self.planner.check_yield)
-
         for corner in ("ul", "ll", "lr"):
             self.planner.check_yield()
             self.motion.move_absolute(corners[corner])
+            corners[corner] = self.autofocus()
+
+    def setup_focus_map(self):
+        """
+        Predict z per tile from a surface fit instead of the corner plane
+        """
+        self.focus_map = None
+        self.focus_map_config = self.pc.focus_map()
+        self.focus_map_tiles = set()
+        self.focus_map_sampled = set()
+        if self.focus_map_config is None:
+            return
+        if not self.tracking_z:
+            raise ValueError("Focus map requires corner z")
+        config = self.focus_map_config
+        load = config.load()
+        if load:
+            self.focus_map = load_focus_map(load, method=config.method())
+            self.log("Focus map: loaded %u points from %s" %
+                     (len(self.focus_map), load))
+        else:
+            self.focus_map = FocusMap(method=config.method(),
+                                      smoothing=config.smoothing())
+            for corner in self.corners.values():
+                self.focus_map.add(corner["x"],
+                                   corner["y"],
+                                   corner["z"],
+                                   source="corner",
+                                   refit=False)
+            self.focus_map.fit()
+        if config.mode() == "none":
+            return
+        spacing = config.spacing()
+        for ll_col, ll_row in self.xy_gen.tiles():
+            if (ll_col % spacing == 0 or ll_col == self.cols -
+                    1) and (ll_row % spacing == 0 or ll_row == self.rows - 1):
+                self.focus_map_tiles.add((ll_col, ll_row))
+
+    def focus_map_sample(self, ll_col, ll_row):
+        """
+        Autofocus at the current (tile) position and add it to the focus map
+        """
+        predicted = self.planner.motion.pos()["z"]
+        pos = self.autofocus()
+        self.focus_map.add(pos["x"], pos["y"], pos["z"])
+        self.focus_map_sampled.add((ll_col, ll_row))
+        self.log("Focus map: c=%u, r=%u z=%0.4f, predicted %0.4f (%+0.4f)" %
+                 (ll_col, self.rows - 1 - ll_row, pos["z"], predicted,
+                  pos["z"] - predicted))
+        return pos
+
+    def focus_map_prescan(self):
+        """
+        Autofocus all sample tiles before imaging
+        """
+        tiles = pattern_order(self.focus_map_tiles, major="x")
+        for tilei, (ll_col, ll_row) in enumerate(tiles):
+            self.log("Focus map: prescan %u / %u" % (tilei + 1, len(tiles)))
             self.planner.check_yield()
-            af.coarse()
-            self.planner.check_yield()
-            corners[corner] = self.planner.motion.pos()
+            self.motion.move_absolute(self.calc_pos(ll_col, ll_row))
+            self.focus_map_sample(ll_col, ll_row)
 
     def setup_bounds(self):
         corners = self.pc.j["points-xy3p"]["corners"]
@@ -759,10 +939,10 @@ class PointGenerator3P(PlannerPlugin):
                 self.per_row[axis] = polyfit(xs, ys, 1)[0]
 
     def points_expected(self):
-        return self.rows * self.cols
+        return len(self.xy_gen.order())
 
     def images_expected(self):
-        return self.rows * self.cols
+        return self.points_expected()
 
     def calc_pos(self, ll_col, ll_row):
         ret = {}
@@ -776,16 +956,16 @@ class PointGenerator3P(PlannerPlugin):
                 offset += self.y.view_mm / 2
             ret[axis] = self.per_row[axis] * ll_row + self.per_col[
                 axis] * ll_col + offset
+        # Refine the plane
+        if self.focus_map is not None and "z" in ret:
+            ret["z"] = self.focus_map.predict(ret["x"], ret["y"])
         return ret
 
     def filename_part(self, ul_col, ul_row):
         return 'c%03u_r%03u' % (ul_col, ul_row)
 
     def gen_pos_ll_ul(self):
-        for x in XYPosGenerator(rows=self.rows,
-                                cols=self.cols,
-                                calc_pos=self.calc_pos,
-                                pc=self.pc).run():
+        for x in self.xy_gen.run():
             yield x
 
     def move_absolute(self, pos):
@@ -801,8 +981,14 @@ class PointGenerator3P(PlannerPlugin):
                 del pos["z"]
         self.motion.move_absolute(pos)
 
+    def scan_begin(self, state):
+        if self.focus_map_config is None or self.planner.dry:
+            return
+        if self.focus_map_config.mode() == "prescan":
+            self.focus_map_prescan()
+
     def iterate(self, state):
-        for (pos, _ll, (ul_col, ul_row)) in self.gen_pos_ll_ul():
+        for (pos, ll, (ul_col, ul_row)) in self.gen_pos_ll_ul():
             self.log('')
             self.itered_xy_points += 1
             if "z" in pos and not self.tracking_z:
@@ -812,6 +998,13 @@ class PointGenerator3P(PlannerPlugin):
                 (self.itered_xy_points, self.images_expected(), ul_col, ul_row,
                  self.microscope.usc.motion.format_positions(pos)))
             self.move_absolute(pos)
+            if ll in self.focus_map_tiles and ll not in self.focus_map_sampled \
+                    and not self.planner.dry:
+                # inline: focus here
+                # Stacking drops z from the XY move, start from the prediction
+                self.motion.move_absolute({"z": pos["z"]})
+                pos = self.focus_map_sample(*ll)
+                self.planner.z_center = pos["z"]
 
             modifiers = {
                 "filename_part": 'c%03u_r%03u' % (ul_col, ul_row),
@@ -834,6 +1027,16 @@ class PointGenerator3P(PlannerPlugin):
     def log_scan_begin(self):
         self.log("XY3P")
         log_scan_xy_begin(self)
+        self.xy_gen.log_order()
+        if self.focus_map is not None:
+            self.log("  Focus map: %s, %s, %u points, %u tiles to autofocus" %
+                     (self.focus_map.method, self.focus_map_config.mode(),
+                      len(self.focus_map), len(self.focus_map_tiles)))
+
+    def log_scan_end(self):
+        if self.focus_map is not None and self.focus_map.residuals:
+            self.log("XY3P: focus map prediction error RMS %0.4f mm" %
+                     (self.focus_map.residual_rms(), ))
 
     def gen_meta(self, meta):
         points = OrderedDict()
@@ -850,7 +1053,12 @@ class PointGenerator3P(PlannerPlugin):
             'points_generated': self.itered_xy_points,
             "points": points,
             "axes": axes,
+            # Not imaged on purpose: post processing shouldn't expect them
+            "excluded": excluded_tiles(self.pc.exclude(), self.cols,
+                                       self.rows),
         }
+        if self.focus_map is not None:
+            meta["points-xy3p"]["focus-map"] = self.focus_map.to_j()
 
 
 """
@@ -936,19 +1144,20 @@ class PlannerStacker(PlannerPlugin):
         self.start = self.reference - self.step * (self.total_number - 1) / 2
         self.end = self.start + (self.total_number - 1) * self.step
 
-        for pointi, point in enumerate(self.points()):
-            if pointi == 0:
-                self.planner.log(
-                    "stack %c @ reference %0.6f, start %0.6f, end %0.6f, step %0.6f, %u images, offset %s"
-                    % (self.axis, self.reference, self.start, self.end,
-                       self.step, self.total_number, self.drift_offset))
-                self.first_reference = self.reference
-                self.first_start = self.start
-                self.first_end = self.end
+        self.planner.log(
+            "stack %c @ reference %0.6f, start %0.6f, end %0.6f, step %0.6f, %u images, offset %s"
+            % (self.axis, self.reference, self.start, self.end, self.step,
+               self.total_number, self.drift_offset))
+        self.first_reference = self.reference
+        self.first_start = self.start
+        self.first_end = self.end
+
+        # Whole stack is one path: checked up front and queued where supported
+        # Motion resumes once the next point is requested
+        for pointi, point in self.planner.motion.move_path_iter(
+                list(self.points())):
             self.planner.log("stack: %u / %u @ %0.6f" %
                              (pointi + 1, self.total_number, point[self.axis]))
-
-            self.planner.motion.move_absolute(point)
             modifiers = {
                 "filename_part": self.filename_part(pointi),
             }
@@ -1150,18 +1359,44 @@ class PlannerKinematics(PlannerPlugin):
     def __init__(self, planner):
         super().__init__(planner=planner)
         assert self.microscope
+        # Keep adaptive settle statistics across scans
+        settle_stats = None
+        if self.microscope.kinematics is not None:
+            settle_stats = self.microscope.kinematics.settle_stats
         self.kinematics = Kinematics(
             microscope=self.microscope,
             log=self.log,
+            settle_stats=settle_stats,
         )
         self.kinematics.configure(
             tsettle_motion=self.pc.kinematics.tsettle_motion(),
             tsettle_hdr=self.pc.kinematics.tsettle_hdr(),
         )
+        objective = self.pc.objective()
+        if objective:
+            self.kinematics.set_objective(objective.get("name"))
 
     def log_scan_begin(self):
         self.log("tsettle_motion: %0.3f" % self.kinematics.tsettle_motion)
         self.log("tsettle_hdr: %0.3f" % self.kinematics.tsettle_hdr)
+        self.log("settle_mode: %s" % self.kinematics.settle_mode)
+
+    def log_scan_end(self):
+        if self.kinematics.settle_mode != "adaptive":
+            return
+        stats = self.kinematics.get_settle_stats().to_dict()
+        if stats["n"]:
+            self.log(
+                "settle: %u samples, mean %0.3f, max %0.3f, %u timeouts" %
+                (stats["n"], stats["mean"], stats["max"], stats["timeouts"]))
+
+    def gen_meta(self, meta):
+        meta["kinematics"] = {
+            "settle_mode": self.kinematics.settle_mode,
+        }
+        if self.kinematics.settle_mode == "adaptive":
+            meta["kinematics"][
+                "settle_stats"] = self.kinematics.get_settle_stats().to_dict()
 
     def iterate(self, state):
         # wait for movement + flush image
@@ -1234,24 +1469,131 @@ Should be at the end of the pipeline
 """
 
 
+class ImageWriterPool:
+    """
+    Encode + write captured images in the background
+    Lets the stage move to the next position while the last image saves
+    The queue is bounded: if writers fall behind the planner blocks in submit()
+    Write errors are re-raised on the planner thread as PlannerStop
+    """
+    def __init__(self, threads, depth=4, log=print, done_cb=None):
+        assert threads >= 1
+        assert depth >= 1
+        self.log = log
+        self.done_cb = done_cb
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.error_lock = threading.Lock()
+        self.threads = []
+        for threadi in range(threads):
+            thread = threading.Thread(target=self.worker,
+                                      name=f"image-writer-{threadi}",
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def worker(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                capim, fn, kwargs = job
+                # Once something failed just drain the queue
+                if self.error is None:
+                    capim.save(fn, **kwargs)
+                    if self.done_cb:
+                        self.done_cb(fn)
+            except Exception as e:
+                with self.error_lock:
+                    if self.error is None:
+                        self.error = (fn, e)
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            fn, e = self.error
+            self.log("ERROR: failed to save %s: %s" % (fn, e))
+            raise PlannerStop("Failed to save %s: %s" % (fn, e)) from e
+
+    def submit(self, capim, fn, **kwargs):
+        """
+        Blocks if depth images are already waiting
+        """
+        self.check()
+        self.queue.put((capim, fn, kwargs))
+
+    def pending(self):
+        return self.queue.unfinished_tasks
+
+    def join(self):
+        """
+        Wait for all submitted images to be written
+        """
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        """
+        Finish pending writes and stop the workers
+        Safe to call more than once
+        """
+        if not self.threads:
+            return
+        for _thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
 class PlannerSaveImage(PlannerPlugin):
     def __init__(self, planner):
         super().__init__(planner=planner)
         self.images_saved = 0
         self.extension = self.pc.imager.save_extension()
         self.quality = self.pc.imager.save_quality()
+        self.save_threads = self.pc.imager.save_threads()
+        self.save_queue_depth = self.pc.imager.save_queue_depth()
+        self.save_spool = self.pc.imager.save_spool()
         assert not self.planner.imager.remote()
         self.metadata = {}
+        self.writer = None
+        self.spool = None
 
     def log_scan_begin(self):
         self.log("Output dir: %s" % self.planner.out_dir)
         self.log("Output extension: %s" % self.extension)
+        if self.save_spool:
+            self.log("Output spool: %s" % spool_fn(self.planner.out_dir))
+        elif self.save_threads:
+            self.log("Save threads: %u, queue depth %u" %
+                     (self.save_threads, self.save_queue_depth))
+
+    def scan_begin(self, state):
+        # Spooling is just a memcpy, no need to offload it
+        if self.save_threads and not self.save_spool and not self.planner.dry:
+            self.writer = ImageWriterPool(self.save_threads,
+                                          depth=self.save_queue_depth,
+                                          log=self.log,
+                                          done_cb=self.image_saved)
+
+    def image_saved(self, fn):
+        """
+        Image is fully written to disk and safe to read
+        Called from a writer thread when saving in the background
+        """
+        self.planner.emit_progress({
+            "type": "image_saved",
+            "image_filename_rel": fn,
+        })
 
     def iterate(self, state):
         capim = state.get("captured_image")
-        im = capim.image
         if not self.planner.dry:
-            assert im, "Asked to save image without image given"
+            # Don't touch .image: spooling uses the array directly
+            assert capim, "Asked to save image without image given"
 
         self.images_saved += 1
         img_prefix = self.planner.filename_prefix(state)
@@ -1261,8 +1603,15 @@ class PlannerSaveImage(PlannerPlugin):
             kwargs = {}
             if self.extension == ".jpg" or self.extension == ".jpeg":
                 kwargs["quality"] = self.quality
+            if self.save_spool:
+                self.spool_frame(state, img_prefix, capim)
             # Includes EXIF
-            capim.save(fn_full, **kwargs)
+            elif self.writer:
+                self.writer.submit(capim, fn_full, **kwargs)
+            else:
+                capim.save(fn_full, **kwargs)
+                self.image_saved(fn_full)
+            # Position must be read now, not when the write finishes
             meta = {
                 "position": self.motion.pos(),
             }
@@ -1281,11 +1630,40 @@ class PlannerSaveImage(PlannerPlugin):
         # yield {}, self.state_add_dict(state, "image", "filename_rel", fn_full)
         yield {}, {"image_filename_rel": fn_full}
 
+    def spool_frame(self, state, img_prefix, capim):
+        array = capim.to_np()
+        if self.spool is None:
+            # Frame size isn't known until the first capture
+            self.spool = SpoolWriter(spool_fn(self.planner.out_dir),
+                                     capacity=self.planner.images_expected(),
+                                     shape=array.shape,
+                                     dtype=array.dtype,
+                                     extension=self.extension)
+        self.spool.append(state,
+                          os.path.basename(img_prefix),
+                          array,
+                          exif=capim.exif_bytes)
+
+    def scan_end(self, state):
+        if self.writer:
+            self.log("Waiting for %u images to save" % self.writer.pending())
+            self.writer.join()
+
+    def scan_cleanup(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        if self.spool:
+            self.spool.close()
+            self.spool = None
+
     def gen_meta(self, meta):
         meta["image-save"] = {
             "extension": self.extension,
             "quality": self.quality,
             "saved": self.images_saved,
+            "threads": self.save_threads,
+            "spool": self.save_spool,
         }
         meta["files"] = self.metadata
 
@@ -0,0 +1,258 @@
+"""
+Scan (XY tile visit) ordering
+Estimates stage travel time for a tile order and picks the fastest of several candidates
+Ordering functions take (ll_col, ll_row) tiles: row 0 is the bottom (lowest y) row
+Exclusions are in filename (ul) coordinates: row 0 is the top row
+"""
+
+import math
+import numpy as np
+
+
+class MotionModel:
+    """
+    Estimate how long moves take
+    -Trapezoidal velocity profile per axis (accelerate, cruise, decelerate)
+    -Axes move concurrently: a move is as long as its slowest axis
+    -Approaching a position against the backlash compensation direction
+     costs an overshoot and return (see BacklashMM)
+    """
+    def __init__(self,
+                 velocities,
+                 accelerations,
+                 backlash={},
+                 compensation={},
+                 move_overhead=0.0):
+        """
+        velocities: mm/min (GRBL convention)
+        accelerations: mm/sec^2
+        move_overhead: fixed sec per move (command latency, etc)
+        """
+        self.velocities = dict([(axis, v / 60.0)
+                                for axis, v in velocities.items()])
+        self.accelerations = dict(accelerations)
+        self.backlash = dict(backlash)
+        self.compensation = dict(compensation)
+        self.move_overhead = move_overhead
+
+    @staticmethod
+    def from_motion(motion, microscope=None, move_overhead=0.0):
+        if microscope is None:
+            microscope = motion.microscope
+        usc_motion = microscope.usc.motion
+        return MotionModel(motion.get_max_velocities(),
+                           motion.get_max_accelerations(),
+                           backlash=usc_motion.backlash(),
+                           compensation=usc_motion.backlash_compensation(),
+                           move_overhead=move_overhead)
+
+    def axis_times(self, axis, deltas):
+        """
+        Vectorized: seconds to move axis by each of deltas (mm)
+        """
+        deltas = np.asarray(deltas, dtype=float)
+        distances = np.abs(deltas)
+        v = self.velocities[axis]
+        a = self.accelerations[axis]
+        # Below this distance the axis never reaches full speed
+        ret = np.where(distances < v * v / a, 2 * np.sqrt(distances / a),
+                       distances / v + v / a)
+        backlash = self.backlash.get(axis, 0.0)
+        compensation = self.compensation.get(axis, 0)
+        if backlash and compensation:
+            # Overshoot by backlash then come back
+            against = np.sign(deltas) == -compensation
+            overshoot = distances + backlash
+            overshoot_time = np.where(overshoot < v * v / a,
+                                      2 * np.sqrt(overshoot / a),
+                                      overshoot / v + v / a)
+            back_time = 2 * math.sqrt(backlash / a) if backlash < v * v / a \
+                else backlash / v + v / a
+            ret = np.where(against, overshoot_time + back_time, ret)
+        return ret
+
+    def move_times(self, pos, positions):
+        """
+        Vectorized: seconds to move from pos to each of positions
+        positions: dict of axis to array
+        """
+        ret = None
+        for axis, values in positions.items():
+            if axis not in pos or axis not in self.velocities:
+                continue
+            times = self.axis_times(axis, np.asarray(values) - pos[axis])
+            ret = times if ret is None else np.maximum(ret, times)
+        if ret is None:
+            return np.zeros(len(next(iter(positions.values()))))
+        return np.where(ret > 0, ret + self.move_overhead, 0.0)
+
+    def move_time(self, pos1, pos2):
+        positions = dict([(axis, [v]) for axis, v in pos2.items()])
+        return float(self.move_times(pos1, positions)[0])
+
+    def path_time(self, positions, start=None, end=None):
+        """
+        Total seconds to visit positions in order
+        Optionally starting from / returning to a position
+        """
+        positions = list(positions)
+        if start is not None:
+            positions.insert(0, start)
+        if end is not None:
+            positions.append(end)
+        if len(positions) < 2:
+            return 0.0
+        axes = set(self.velocities.keys())
+        for pos in positions:
+            axes &= set(pos.keys())
+        times = np.zeros(len(positions) - 1)
+        for axis in axes:
+            values = np.array([pos[axis] for pos in positions])
+            times = np.maximum(times, self.axis_times(axis, np.diff(values)))
+        return float(
+            np.sum(np.where(times > 0, times + self.move_overhead, 0.0)))
+
+
+def tile_excluded(exclusions, ul_col, ul_row):
+    """
+    exclusions: list of {"r0", "r1", "c0", "c1"} inclusive ranges (filename row / col)
+    ul_col, ul_row: filename (ul) coordinates, not the ll tiles used for ordering
+    If a range is missing the exclusion doesn't match
+    """
+    for exclusion in exclusions:
+        r0 = exclusion.get('r0', float('inf'))
+        r1 = exclusion.get('r1', float('-inf'))
+        c0 = exclusion.get('c0', float('inf'))
+        c1 = exclusion.get('c1', float('-inf'))
+        if r0 <= ul_row <= r1 and c0 <= ul_col <= c1:
+            return True
+    return False
+
+
+def excluded_tiles(exclusions, cols, rows):
+    """
+    Return sorted [(ul_col, ul_row)] of the grid tiles matched by exclusions
+    Rows are filename (ul) rows: row 0 is the top row
+    """
+    ret = []
+    for ul_col in range(cols):
+        for ul_row in range(rows):
+            if tile_excluded(exclusions, ul_col, ul_row):
+                ret.append((ul_col, ul_row))
+    return ret
+
+
+def tile_lines(tiles, major):
+    """
+    Group tiles into the lines a raster scan would take
+    major "x": each line is a row (move along x), "y": each line is a column
+    tiles: (ll_col, ll_row)
+    Return list of (line index, [tiles sorted by increasing position])
+    """
+    lines = {}
+    for tile in tiles:
+        col, row = tile
+        if major == "x":
+            lines.setdefault(row, []).append(tile)
+        else:
+            lines.setdefault(col, []).append(tile)
+    ret = []
+    for linei, line in sorted(lines.items()):
+        ret.append((linei, sorted(line)))
+    return ret
+
+
+def pattern_order(tiles, major="x", reverse=False, serpentine=True):
+    """
+    Classic raster
+    reverse: start each line at the high end (ex: x+:x-)
+    serpentine: alternate line direction
+    """
+    ret = []
+    for linei, line in tile_lines(tiles, major):
+        this_reverse = reverse
+        # Index by line number (not non-empty line count) so exclusions
+        # don't change the direction of the remaining lines
+        if serpentine and linei % 2 == 1:
+            this_reverse = not this_reverse
+        if this_reverse:
+            line = line[::-1]
+        ret += line
+    return ret
+
+
+def adaptive_order(tiles, calc_pos, model, major="x", start=None):
+    """
+    Raster where each line starts from whichever end is quicker from the last tile
+    Handles irregular outlines better than a fixed serpentine
+    """
+    ret = []
+    cur = start
+    for _linei, line in tile_lines(tiles, major):
+        best = None
+        for candidate in (line, line[::-1]):
+            positions = [calc_pos(*tile) for tile in candidate]
+            t = model.path_time(positions, start=cur)
+            if best is None or t < best[0]:
+                best = (t, candidate, positions[-1])
+        ret += best[1]
+        cur = best[2]
+    return ret
+
+
+def greedy_order(tiles, calc_pos, model, start=None):
+    """
+    Nearest (in time) unvisited tile next
+    O(n^2) but vectorized
+    """
+    if not tiles:
+        return []
+    positions = [calc_pos(*tile) for tile in tiles]
+    arrays = dict([(axis, np.array([pos[axis] for pos in positions]))
+                   for axis in positions[0].keys()])
+    remaining = np.ones(len(tiles), dtype=bool)
+    ret = []
+    if start is None:
+        cur = 0
+    else:
+        cur = int(np.argmin(model.move_times(start, arrays)))
+    while True:
+        remaining[cur] = False
+        ret.append(tiles[cur])
+        if not remaining.any():
+            break
+        times = model.move_times(positions[cur], arrays)
+        times[~remaining] = np.inf
+        cur = int(np.argmin(times))
+    return ret
+
+
+def optimize_order(tiles, calc_pos, model, start=None, end=None):
+    """
+    Try several orders and return the fastest as (order, name, seconds)
+    """
+    candidates = []
+    for major in ("x", "y"):
+        for reverse in (False, True):
+            for serpentine in (True, False):
+                name = "%s-major%s%s" % (major, " reversed" if reverse else "",
+                                         " serpentine" if serpentine else "")
+                candidates.append(
+                    (name, pattern_order(tiles, major, reverse, serpentine)))
+        candidates.append(("%s-major adaptive" % major,
+                           adaptive_order(tiles,
+                                          calc_pos,
+                                          model,
+                                          major=major,
+                                          start=start)))
+    candidates.append(
+        ("nearest", greedy_order(tiles, calc_pos, model, start=start)))
+
+    best = None
+    for name, order in candidates:
+        t = model.path_time([calc_pos(*tile) for tile in order],
+                            start=start,
+                            end=end)
+        if best is None or t < best[2]:
+            best = (order, name, t)
+    return best
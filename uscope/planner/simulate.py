@@ -0,0 +1,428 @@
+"""
+Scan time simulator
+Runs the real planner pipeline against a mock stage + imager on a virtual clock
+Each operation is charged a modeled cost instead of waiting for hardware:
+-Moves: trapezoidal profile from max velocity / acceleration (see MotionModel)
+-Kinematics: motion / HDR settle and frame sync
+-HDR: property read back when closed loop
+-Capture and image encode / write, including background writer queueing
+Intended to compare objectives, stack and HDR settings before committing instrument time
+"""
+
+from uscope.benchmark import time_str
+from uscope.config import PC
+from uscope.imager.image_sequence import CapturedImage
+from uscope.imager.imager import MockImager
+from uscope.kinematics import Kinematics
+from uscope.motion.hal import MockHal
+from uscope.motion.plugins import configure_motion_hal
+from uscope.planner.planner_util import get_planner
+from uscope.planner.scan_order import MotionModel
+from collections import OrderedDict
+import copy
+import functools
+import os
+import re
+import tempfile
+from PIL import Image
+
+# Rough single core encode + write cost in sec per megapixel
+SAVE_SEC_PER_MP = {
+    ".jpg": 0.03,
+    ".jpeg": 0.03,
+    ".tif": 0.015,
+    ".tiff": 0.015,
+    ".png": 0.15,
+}
+# Spooling is a memcpy into a mapped file
+SPOOL_SEC_PER_MP = 0.002
+# Issue move + poll GRBL until idle
+MOVE_OVERHEAD = 0.05
+# One frame: exposure + readout + transfer
+T_CAPTURE = 0.1
+
+
+def save_time(extension, wh, spool=False):
+    """
+    Estimated sec to save one image
+    """
+    mp = wh[0] * wh[1] / 1e6
+    if spool:
+        return SPOOL_SEC_PER_MP * mp
+    return SAVE_SEC_PER_MP.get(extension.lower(), SAVE_SEC_PER_MP[".jpg"]) * mp
+
+
+def grbl_rc_rates(usc):
+    """
+    Return (velocities, accelerations) set by GRBL startup commands, if any
+    Ex: "$110=960.000" => x max rate 960 mm/min
+    Machine units (before scalars)
+    """
+    velocities = {}
+    accelerations = {}
+    grbl = usc.motion.j.get("grbl", {})
+    for k in ("rc_pre_home", "rc_post_home"):
+        for command in grbl.get(k, []):
+            m = re.match(r"\$1([12])([0-2])=([0-9.]+)", command.strip())
+            if not m:
+                continue
+            axis = "xyz"[int(m.group(2))]
+            if m.group(1) == "1":
+                velocities[axis] = float(m.group(3))
+            else:
+                accelerations[axis] = float(m.group(3))
+    return velocities, accelerations
+
+
+class SimClock:
+    """
+    Virtual time in seconds plus where it was spent
+    """
+    def __init__(self, save_threads=0, save_queue_depth=4):
+        self.t = 0.0
+        # phase => sec
+        self.phases = OrderedDict()
+        # phase => number of times charged
+        self.counts = OrderedDict()
+        self.save_threads = save_threads
+        self.save_queue_depth = save_queue_depth
+        # Per background writer: time it becomes free
+        self.writers_free = [0.0] * save_threads
+        # Start times of queued background saves
+        self.save_starts = []
+        self.save_background = 0.0
+
+    def charge(self, phase, dt):
+        if dt <= 0:
+            return
+        self.t += dt
+        self.phases[phase] = self.phases.get(phase, 0.0) + dt
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+
+    def reset(self):
+        self.__init__(save_threads=self.save_threads,
+                      save_queue_depth=self.save_queue_depth)
+
+    def save(self, dt):
+        """
+        Inline save or ImageWriterPool like bounded queue of background writers
+        """
+        if not self.save_threads:
+            self.charge("save", dt)
+            return
+        # Planner blocks in submit() while the queue is full
+        waiting = sorted(start for start in self.save_starts if start > self.t)
+        if len(waiting) >= self.save_queue_depth:
+            self.charge("save backpressure",
+                        waiting[len(waiting) - self.save_queue_depth] - self.t)
+            waiting = [start for start in waiting if start > self.t]
+        writeri = min(range(self.save_threads),
+                      key=lambda i: self.writers_free[i])
+        start = max(self.t, self.writers_free[writeri])
+        self.writers_free[writeri] = start + dt
+        waiting.append(start)
+        self.save_starts = waiting
+        self.save_background += dt
+
+    def flush(self):
+        """
+        Wait for background saves to finish (scan end)
+        """
+        if self.save_threads:
+            self.charge("save flush", max(self.writers_free) - self.t)
+
+
+class SimCapturedImage(CapturedImage):
+    def __init__(self, clock, t_save, **kwargs):
+        super().__init__(**kwargs)
+        self.clock = clock
+        self.t_save = t_save
+
+    def save(self, fn, **kwargs):
+        # Charge encode / write but don't touch disk
+        self.clock.save(self.t_save)
+
+
+class SimHal(MockHal):
+    """
+    Instant moves that charge their modeled duration to the clock
+    Backlash compensation moves are issued by BacklashMM and charged as normal moves
+    """
+    def __init__(self,
+                 clock,
+                 velocities=None,
+                 accelerations=None,
+                 move_overhead=MOVE_OVERHEAD,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.clock = clock
+        self.sim_velocities = velocities
+        self.sim_accelerations = accelerations
+        self.model = MotionModel(self._get_max_velocities(),
+                                 self._get_max_accelerations(),
+                                 move_overhead=move_overhead)
+        # Stage starts at rest
+        self.sim_mv_lastt = float("-inf")
+
+    def _get_max_velocities(self):
+        ret = super()._get_max_velocities()
+        if self.sim_velocities:
+            ret.update(self.sim_velocities)
+        return ret
+
+    def _get_max_accelerations(self):
+        ret = super()._get_max_accelerations()
+        if self.sim_accelerations:
+            ret.update(self.sim_accelerations)
+        return ret
+
+    def _move_absolute(self, pos):
+        self.clock.charge("move", self.model.move_time(self._pos_cache, pos))
+        # Kinematics settles after any commanded move, even a null one
+        self.sim_mv_lastt = self.clock.t
+        super()._move_absolute(pos)
+
+    def _move_relative(self, delta):
+        pos = dict([(axis, self._pos_cache[axis] + adelta)
+                    for axis, adelta in delta.items()])
+        self.clock.charge("move", self.model.move_time(self._pos_cache, pos))
+        self.sim_mv_lastt = self.clock.t
+        super()._move_relative(delta)
+
+    def since_last_motion(self):
+        return self.clock.t - self.sim_mv_lastt
+
+
+class SimImager(MockImager):
+    """
+    Returns the same blank frame at the configured size
+    Accepts any property
+    """
+    def __init__(self,
+                 clock,
+                 width,
+                 height,
+                 t_capture=T_CAPTURE,
+                 t_save=0.0,
+                 verbose=False):
+        super().__init__(verbose=verbose, width=width, height=height)
+        self.clock = clock
+        self.t_capture = t_capture
+        self.t_save = t_save
+        self.properties = {}
+        self.frame = Image.new("RGB", (width, height))
+        self.sim_properties_change = float("-inf")
+        self.sim_restart = None
+
+    def get(self):
+        self.clock.charge("capture", self.t_capture)
+        return SimCapturedImage(self.clock, self.t_save, image=self.frame)
+
+    def get_by_mode(self, mode=None, **kwargs):
+        return self.get()
+
+    def properties_changed(self):
+        self.sim_properties_change = self.clock.t
+
+    def since_properties_change(self):
+        return self.clock.t - self.sim_properties_change
+
+    def set_properties(self, vals):
+        self.properties_changed()
+        self._set_properties(vals)
+
+    def _set_properties(self, vals):
+        self.properties.update(vals)
+
+    def _get_properties(self):
+        return dict(self.properties)
+
+    def wait_properties(self, properties, timeout=1.0):
+        # New values read back about a frame later
+        self.clock.charge("hdr wait", self.t_capture)
+
+    def device_restarted(self):
+        self.sim_restart = self.clock.t
+
+    def since_last_restart(self):
+        if self.sim_restart is None:
+            return None
+        return self.clock.t - self.sim_restart
+
+
+class SimKinematics(Kinematics):
+    """
+    Settle by advancing the clock
+    """
+    def __init__(self, clock, microscope=None, log=None):
+        super().__init__(microscope=microscope, log=log)
+        self.clock = clock
+        self.phase = "settle"
+
+    def sleep(self, t):
+        self.clock.charge(self.phase, t)
+
+    def wait_video_pipeline(self):
+        self.phase = "settle video pipeline"
+        super().wait_video_pipeline()
+
+    def wait_motion(self):
+        self.phase = "settle motion"
+        super().wait_motion()
+
+    def wait_hdr(self):
+        self.phase = "settle hdr"
+        super().wait_hdr()
+
+    def wait_autofocus(self):
+        self.phase = "settle autofocus"
+        super().wait_autofocus()
+
+    def frame_sync(self):
+        # As Kinematics.frame_sync() but on the clock
+        if not self.should_frame_sync:
+            return
+        if self.last_frame_sync is not None:
+            since_last_sync = self.clock.t - self.last_frame_sync
+            if since_last_sync < self.microscope.motion.since_last_motion(
+            ) and since_last_sync < self.microscope.imager.since_properties_change(
+            ):
+                return
+        self.clock.charge("frame sync", self.microscope.imager.t_capture)
+        self.last_frame_sync = self.clock.t
+
+
+def simulate_scan(microscope,
+                  pconfig,
+                  velocities=None,
+                  accelerations=None,
+                  t_capture=T_CAPTURE,
+                  t_save=None,
+                  move_overhead=MOVE_OVERHEAD,
+                  log=None):
+    """
+    Estimate how long a scan will take without touching hardware
+
+    microscope: virtual microscope for the target configuration (see get_virtual_microscope())
+        Its motion, imager and kinematics are replaced
+    pconfig: as for get_planner() (ex: from microscope_to_planner_config())
+    velocities: mm/min, accelerations: mm/sec^2, machine units
+        Default: GRBL startup commands in the microscope config, else MockHal values
+    t_capture: sec per frame
+    t_save: sec to save one image. Default: estimate from format and size
+
+    Return dict with total seconds, per phase seconds + counts and image count
+    """
+    if log is None:
+
+        def log(msg='', verbosity=None):
+            pass
+
+    usc = microscope.usc
+    pc = PC(j=pconfig)
+    clock = SimClock(
+        save_threads=0 if pc.imager.save_spool() else pc.imager.save_threads(),
+        save_queue_depth=pc.imager.save_queue_depth())
+
+    config_velocities, config_accelerations = grbl_rc_rates(usc)
+    config_velocities.update(velocities or {})
+    config_accelerations.update(accelerations or {})
+    axes = "".join([axis for axis in "xyz" if axis in usc.motion.axes()])
+    motion = SimHal(clock,
+                    velocities=config_velocities,
+                    accelerations=config_accelerations,
+                    move_overhead=move_overhead,
+                    axes=axes,
+                    microscope=microscope,
+                    log=log)
+    microscope.set_motion(motion)
+    microscope.set_motion_ts(motion)
+    configure_motion_hal(microscope)
+
+    width, height = usc.imager.final_wh()
+    if t_save is None:
+        t_save = save_time(pc.imager.save_extension(), (width, height),
+                           spool=pc.imager.save_spool())
+    imager = SimImager(clock,
+                       width,
+                       height,
+                       t_capture=t_capture,
+                       t_save=t_save)
+    imager.microscope = microscope
+    # PlannerHDR restores what it changed at scan end
+    imager.properties.update(pconfig["imager"].get("properties", {}))
+    for properties in pconfig["imager"].get("hdr",
+                                            {}).get("properties_list", []):
+        for k, v in properties.items():
+            imager.properties.setdefault(k, v)
+    microscope.set_imager(imager)
+    microscope.set_imager_ts(imager)
+
+    kinematics = SimKinematics(clock, microscope=microscope, log=log)
+    # No live frames: model the upper bound
+    kinematics.configure(tsettle_motion=pc.kinematics.tsettle_motion(),
+                         tsettle_hdr=pc.kinematics.tsettle_hdr(),
+                         settle_mode="fixed")
+    microscope.set_kinematics(kinematics)
+    microscope.set_kinematics_ts(kinematics)
+
+    # Save cost is modeled above: write inline, nothing to disk
+    pconfig = copy.deepcopy(pconfig)
+    pconfig["imager"]["save_threads"] = 0
+    pconfig["imager"]["save_spool"] = False
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        planner = get_planner(microscope=microscope,
+                              pconfig=pconfig,
+                              out_dir=os.path.join(tmp_dir, "scan"),
+                              dry=False,
+                              log=log)
+        if "kinematics" in planner.pipeline:
+            planner.pipeline["kinematics"].kinematics = kinematics
+        for name, plugin in planner.pipeline.items():
+            # Ex: image stabilization vibration delay
+            plugin.sleep = functools.partial(clock.charge, name)
+
+        # Assume the operator left the stage at the first tile
+        for name in ("points-xy2p", "points-xy3p"):
+            if name in planner.pipeline:
+                for pos, _ll, _ul in planner.pipeline[name].gen_pos_ll_ul():
+                    motion.move_absolute(pos)
+                    break
+        clock.reset()
+        motion.sim_mv_lastt = float("-inf")
+        kinematics.last_frame_sync = None
+
+        planner.run()
+        clock.flush()
+
+    return {
+        "total": clock.t,
+        "phases": clock.phases,
+        "counts": clock.counts,
+        "images": planner.images_expected(),
+        "save_background": clock.save_background,
+        "t_capture": t_capture,
+        "t_save": t_save,
+    }
+
+
+def format_estimate(result):
+    """
+    Return printable lines for a simulate_scan() result
+    """
+    ret = []
+    total = result["total"]
+    ret.append("Images: %u" % result["images"])
+    ret.append("Estimated time: %s (%0.1f sec)" % (time_str(total), total))
+    for phase, t in sorted(result["phases"].items(),
+                           key=lambda x: x[1],
+                           reverse=True):
+        ret.append("  %-20s %10.1f sec %5.1f%%  (%u x %0.3f sec)" %
+                   (phase, t, 100.0 * t / total if total else 0.0,
+                    result["counts"][phase], t / result["counts"][phase]))
+    if result["save_background"]:
+        ret.append("  Background save: %0.1f sec" %
+                   (result["save_background"], ))
+    if result["images"]:
+        ret.append("  Per image: %0.3f sec" % (total / result["images"], ))
+    return ret
@@ -6,14 +6,20 @@ plannerj: planner configuration JSON. Written to disk
 """
 
 from uscope.planner.planner_util import get_planner
+from uscope.imagep.streams import PlannerImageStream
 import threading
+import traceback
 
 
 class PlannerThreadBase:
-    def __init__(self, planner_args, progress_cb):
+    def __init__(self, planner_args, progress_cb, csip=None):
         self.planner_args = planner_args
         self.planner = None
         self.progress_cb = progress_cb
+        # If set and enabled by config, process images as they are captured
+        self.csip = csip
+        self.image_stream = None
+        self.stream_thread = None
 
     def log(self, msg=""):
         print(msg)
@@ -45,10 +51,53 @@ class PlannerThreadBase:
             self.planner.shutdown_join()
         super().shutdown_join()
 
+    def stream_start(self):
+        """
+        Kick off image processing concurrent with the scan
+        """
+        if not self.csip or self.planner.dry:
+            return
+        if not self.planner.microscope.usc.ipp.stream():
+            return
+        if self.planner.pc.imager.save_spool():
+            self.log("Spooling raw frames: image processing after scan")
+            return
+        pconfig = self.planner.pc.j
+        self.image_stream = PlannerImageStream(pconfig=pconfig,
+                                               directory=self.planner.out_dir)
+        self.planner.register_progress_callback(self.image_stream.progress_cb)
+
+        def run():
+            try:
+                self.csip.process_stream(self.image_stream,
+                                         configj=pconfig.get("ipp", {}))
+            except Exception as e:
+                # Not fatal: post scan processing will redo anything missing
+                self.log(f"WARNING: stream processing crashed: {e}")
+                traceback.print_exc()
+
+        self.stream_thread = threading.Thread(target=run)
+        self.stream_thread.start()
+
+    def stream_finish(self):
+        """
+        Wait for images already captured to finish processing
+        """
+        if not self.stream_thread:
+            return
+        # In case planner aborted
+        self.image_stream.close()
+        self.stream_thread.join()
+        self.stream_thread = None
+
     def run(self):
         self.planner = get_planner(log=self.log, **self.planner_args)
         self.planner.register_progress_callback(self.progress_cb)
-        self.planner.run()
+        self.stream_start()
+        try:
+            self.planner.run()
+        finally:
+            self.stream_finish()
 
 
 class SimplePlannerThread(PlannerThreadBase, threading.Thread):
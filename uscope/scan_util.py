@@ -1,7 +1,26 @@
 from collections import OrderedDict
-import glob
+import json
 import os
 import re
+import threading
+import time
+
+# Hidden so it isn't picked up as scan output (ex: CloudStitch *.json)
+IINDEX_CACHE_FN = ".iindex.json"
+IINDEX_CACHE_VERSION = 1
+# Changes made within this long of a listing may not bump a coarse
+# (ex: network storage) directory mtime => don't trust it yet
+IINDEX_MTIME_SLACK = 2.0
+IINDEX_EXTENSIONS = (".jpg", ".tif")
+# One basename part, ex: c000, r012, h01, z02, is00
+IINDEX_PART_RE = re.compile(r"(c|r|h|z|is)([0-9]+)")
+IINDEX_PART_KEYS = {
+    "c": "col",
+    "r": "row",
+    "h": "hdr",
+    "z": "stack",
+    "is": "stabilization",
+}
 
 
 def iindex_filename_key(filename):
@@ -10,8 +29,9 @@ def iindex_filename_key(filename):
 
 
 def is_tif_scan(working_dir):
-    fns = glob.glob(working_dir + "/*.tif")
-    return bool(fns)
+    return any(
+        basename.endswith(".tif")
+        for basename in index_scan_parsed(working_dir))
 
 
 def reduce_iindex_filename(filename, remove_key):
@@ -62,10 +82,7 @@ def bucket_group(iindex_in, bucket_key):
 
 def iindex_parse_fn(basename):
     """
-    Nobody is going to be impressed with my regular expression skills
-    but this should work...for now
-    2023-10-23: collapsing under its own weight
-    Rewrite this to be more proper
+    Parse a basename like c000_r002_z01_h02.jpg
     """
     ret = {}
     ret["basename"] = basename
@@ -78,39 +95,13 @@ def iindex_parse_fn(basename):
         return ret
 
     for part in parts.split("_"):
-        m = re.match(r"c([0-9]+)", part)
-        if m:
-            ret["col"] = int(m.group(1))
-            ret["col_str"] = part
-            continue
-
-        m = re.match(r"r([0-9]+)", part)
-        if m:
-            ret["row"] = int(m.group(1))
-            ret["row_str"] = part
-            continue
-
-        m = re.match(r"h([0-9]+)", part)
-        if m:
-            ret["hdr"] = int(m.group(1))
-            ret["hdr_str"] = part
-            continue
-
-        m = re.match(r"z([0-9]+)", part)
-        if m:
-            ret["stack"] = int(m.group(1))
-            ret["stack_str"] = part
-            continue
-
-        m = re.match(r"is([0-9]+)", part)
-        if m:
-            ret["stabilization"] = int(m.group(1))
-            ret["stabilization_str"] = part
-            continue
-
+        m = IINDEX_PART_RE.match(part)
         # Should we allow non-confirming files?
         # return None
-        assert 0, f"Unrecognized part {part} in basename {basename}"
+        assert m, f"Unrecognized part {part} in basename {basename}"
+        key = IINDEX_PART_KEYS[m.group(1)]
+        ret[key] = int(m.group(2))
+        ret[key + "_str"] = part
 
     # HDR: no longer true
     #assert "row" in ret, basename
@@ -143,6 +134,130 @@ def index_scan_images(dir_in):
             },
         },
     }
+    Leaves a hidden .iindex.json index cache in dir_in (see index_scan_parsed())
+    """
+    parsed = index_scan_parsed(dir_in)
+    return index_scan_basenames(dir_in, list(parsed.keys()), parsed=parsed)
+
+
+def scan_excluded_tiles(dir_in):
+    """
+    Return set of (col, row) tiles the planner skipped on purpose (ROI exclusions)
+    Read from the scan's uscan.json, empty if there isn't one
+    """
+    scan_fn = os.path.join(dir_in, "uscan.json")
+    if not os.path.exists(scan_fn):
+        return set()
+    with open(scan_fn) as f:
+        scanj = json.load(f)
+    ret = set()
+    for k in ("points-xy2p", "points-xy3p"):
+        for col, row in scanj.get(k, {}).get("excluded", []):
+            ret.add((col, row))
+    return ret
+
+
+def list_scan_basenames(dir_in):
+    """
+    Sorted image basenames in dir_in
+    Hidden files are skipped like glob() does
+    """
+    return sorted(basename for basename in os.listdir(dir_in)
+                  if not basename.startswith(".")
+                  and os.path.splitext(basename)[1] in IINDEX_EXTENSIONS)
+
+
+def read_iindex_cache(cache_fn):
+    """
+    Return (directory mtime it was valid for or None, {basename: parsed})
+    """
+    try:
+        # Not readj(): json5 is slow on large scans
+        with open(cache_fn, "r") as f:
+            j = json.load(f)
+    except (OSError, ValueError):
+        # Missing, just created, or being written
+        return None, {}
+    if j.get("version") != IINDEX_CACHE_VERSION:
+        return None, {}
+    return j["mtime_ns"], j["images"]
+
+
+def write_iindex_cache(cache_fn, mtime_ns, images):
+    """
+    Return False if the cache couldn't be written (ex: read only scan)
+    """
+    j = {
+        "version": IINDEX_CACHE_VERSION,
+        "mtime_ns": mtime_ns,
+        "images": images,
+    }
+    try:
+        # Rewrite in place: replacing the file would bump the directory mtime
+        with open(cache_fn, "w") as f:
+            json.dump(j, f, separators=(",", ":"))
+    except OSError:
+        # Don't leave a partial file behind (ex: disk full)
+        try:
+            os.remove(cache_fn)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+_iindex_cache = {}
+_iindex_cache_lock = threading.Lock()
+
+
+def index_scan_parsed(dir_in):
+    """
+    Return {basename: iindex_parse_fn(basename)} for the images in dir_in
+    Kept in a hidden dir_in/.iindex.json keyed on the directory mtime:
+    -Unchanged directory: no listing, no parsing
+    -Otherwise re-list and only parse new basenames
+    If the file can't be written (ex: read only scan) the index is only
+    kept in memory for this process
+    Treat the result as read only
+    """
+    dir_in = os.path.realpath(dir_in)
+    cache_fn = os.path.join(dir_in, IINDEX_CACHE_FN)
+    with _iindex_cache_lock:
+        cached = _iindex_cache.get(dir_in)
+    if cached is None:
+        cached = read_iindex_cache(cache_fn)
+    writable = True
+    if not os.path.exists(cache_fn):
+        # Create before taking the mtime so writing it doesn't invalidate it
+        try:
+            open(cache_fn, "a").close()
+        except OSError:
+            writable = False
+    mtime_ns = os.stat(dir_in).st_mtime_ns
+    if cached[0] == mtime_ns:
+        return cached[1]
+
+    old_images = cached[1]
+    images = OrderedDict()
+    for basename in list_scan_basenames(dir_in):
+        v = old_images.get(basename)
+        if v is None:
+            v = iindex_parse_fn(basename)
+        images[basename] = v
+    if time.time() - mtime_ns / 1e9 < IINDEX_MTIME_SLACK:
+        # Keep the parsed results but list again next time
+        mtime_ns = None
+    if writable:
+        write_iindex_cache(cache_fn, mtime_ns, images)
+    with _iindex_cache_lock:
+        _iindex_cache[dir_in] = (mtime_ns, images)
+    return images
+
+
+def index_scan_basenames(dir_in, basenames, parsed={}):
+    """
+    index_scan_images() given the image basenames
+    parsed: optional {basename: iindex_parse_fn(basename)} to reuse
     """
     ret = OrderedDict()
     images = OrderedDict()
@@ -152,12 +267,13 @@ def index_scan_images(dir_in):
     stacks = 0
     stabilization = 0
     crs = OrderedDict()
-    for fn_full in sorted(
-            list(glob.glob(dir_in + "/*.jpg")) +
-            list(glob.glob(dir_in + "/*.tif"))):
-        basename = os.path.basename(fn_full)
-
-        v = iindex_parse_fn(basename)
+    for basename in basenames:
+        v = parsed.get(basename)
+        if v is None:
+            v = iindex_parse_fn(basename)
+        else:
+            # Caller owns the returned index
+            v = dict(v)
         if not v:
             continue
         images[basename] = v
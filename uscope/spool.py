@@ -0,0 +1,306 @@
+"""
+Raw frame spool: one preallocated, memory mapped file per scan
+Faster than encoding a JPEG per frame and avoids lossy compression before stacking
+
+Layout
+-Header (SPOOL_HEADER_SIZE bytes): magic, uint32 JSON length, JSON
+-Index: capacity x SPOOL_INDEX_DTYPE entries, one per frame slot
+-EXIF: capacity x exif_bytes, capture metadata (ex: exposure time) per slot
+-Frames: capacity x frame_bytes, raw HxWxC
+Index entries are keyed by planner state (col/row/stacki/hdri/is, -1 if unused)
+and also record the classic tile basename (ex: c000_r001_z02)
+"""
+
+from uscope.scan_util import index_scan_basenames
+import json
+import os
+import struct
+import threading
+import numpy as np
+from PIL import Image
+
+SPOOL_FN = "frames.spool"
+SPOOL_MAGIC = b"USPOOL\x00\x01"
+SPOOL_HEADER_SIZE = 4096
+SPOOL_ALIGN = 4096
+SPOOL_VERSION = 2
+# Per frame EXIF space. piexif dumps from the GUI are ~100 bytes
+SPOOL_EXIF_BYTES = 4096
+SPOOL_INDEX_DTYPE = np.dtype([
+    ("valid", "u1"),
+    ("col", "<i4"),
+    ("row", "<i4"),
+    ("stacki", "<i4"),
+    ("hdri", "<i4"),
+    ("is", "<i4"),
+    ("exif_len", "<u4"),
+    ("name", "S55"),
+])
+# Planner state key => index field
+SPOOL_STATE_KEYS = (
+    ("col", "col"),
+    ("row", "row"),
+    ("stacki", "stacki"),
+    ("hdri", "hdri"),
+    ("image_stabilization_i", "is"),
+)
+
+
+def spool_fn(directory):
+    return os.path.join(directory, SPOOL_FN)
+
+
+def has_spool(directory):
+    return os.path.exists(spool_fn(directory))
+
+
+def align_up(n, align=SPOOL_ALIGN):
+    return (n + align - 1) // align * align
+
+
+class SpoolWriter:
+    """
+    Append frames to a new spool file
+    Space for capacity frames is reserved up front (sparse on most filesystems)
+    append() is thread safe
+    """
+    def __init__(self,
+                 fn,
+                 capacity,
+                 shape,
+                 dtype="uint8",
+                 extension=".jpg",
+                 exif_bytes=SPOOL_EXIF_BYTES):
+        assert capacity >= 1
+        assert len(shape) == 3, "Expect HxWxC frames"
+        self.fn = fn
+        self.capacity = capacity
+        self.shape = tuple(int(x) for x in shape)
+        self.dtype = np.dtype(dtype)
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.exif_bytes = exif_bytes
+        index_offset = SPOOL_HEADER_SIZE
+        exif_offset = index_offset + capacity * SPOOL_INDEX_DTYPE.itemsize
+        data_offset = align_up(exif_offset + capacity * exif_bytes)
+        self.header = {
+            "version": SPOOL_VERSION,
+            "height": self.shape[0],
+            "width": self.shape[1],
+            "channels": self.shape[2],
+            "dtype": self.dtype.str,
+            "capacity": capacity,
+            "frame_bytes": self.frame_bytes,
+            "index_offset": index_offset,
+            "exif_offset": exif_offset,
+            "exif_bytes": exif_bytes,
+            "data_offset": data_offset,
+            # Format to use when converted back to per tile files
+            "extension": extension,
+        }
+        headerb = json.dumps(self.header).encode("ascii")
+        assert len(SPOOL_MAGIC) + 4 + len(headerb) <= SPOOL_HEADER_SIZE
+        with open(fn, "wb") as f:
+            f.write(SPOOL_MAGIC)
+            f.write(struct.pack("<I", len(headerb)))
+            f.write(headerb)
+            f.truncate(data_offset + capacity * self.frame_bytes)
+
+        self.mm = np.memmap(fn, mode="r+")
+        self.index = self.mm[index_offset:index_offset +
+                             capacity * SPOOL_INDEX_DTYPE.itemsize].view(
+                                 SPOOL_INDEX_DTYPE)
+        self.exif = self.mm[exif_offset:exif_offset +
+                            capacity * exif_bytes].reshape(
+                                (capacity, exif_bytes))
+        self.frames = self.mm[data_offset:data_offset +
+                              capacity * self.frame_bytes].view(
+                                  self.dtype).reshape((capacity, ) +
+                                                      self.shape)
+        self.lock = threading.Lock()
+        self.frames_written = 0
+
+    def append(self, state, name, array, exif=None):
+        """
+        Copy a frame in
+        state: planner state, used for the index key
+        name: tile basename without extension
+        exif: EXIF bytes to write with the tile (ex: CapturedImage.exif_bytes)
+        """
+        assert array.shape == self.shape, "Frame size changed: %s vs %s" % (
+            array.shape, self.shape)
+        if exif is None:
+            exif = b""
+        if len(exif) > self.exif_bytes:
+            raise ValueError("EXIF too large for spool (%u > %u bytes)" %
+                             (len(exif), self.exif_bytes))
+        with self.lock:
+            if self.frames_written >= self.capacity:
+                raise ValueError("Spool full (%u frames)" % self.capacity)
+            slot = self.frames_written
+            self.frames_written += 1
+        self.frames[slot] = array
+        self.exif[slot, :len(exif)] = np.frombuffer(exif, dtype=np.uint8)
+        entry = self.index[slot]
+        for state_key, index_key in SPOOL_STATE_KEYS:
+            entry[index_key] = state.get(state_key, -1)
+        entry["name"] = name.encode("ascii")
+        entry["exif_len"] = len(exif)
+        # Mark valid last so a reader never sees a partial frame
+        entry["valid"] = 1
+        return slot
+
+    def close(self):
+        if self.mm is None:
+            return
+        self.mm.flush()
+        self.index = None
+        self.exif = None
+        self.frames = None
+        self.mm = None
+
+
+class SpoolReader:
+    """
+    Read only, zero copy access to a spool file
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, "rb") as f:
+            magic = f.read(len(SPOOL_MAGIC))
+            if magic != SPOOL_MAGIC:
+                raise ValueError("%s: not a frame spool" % fn)
+            headern = struct.unpack("<I", f.read(4))[0]
+            self.header = json.loads(f.read(headern).decode("ascii"))
+        if self.header["version"] != SPOOL_VERSION:
+            raise ValueError("%s: unsupported spool version %s" %
+                             (fn, self.header["version"]))
+        capacity = self.header["capacity"]
+        self.shape = (self.header["height"], self.header["width"],
+                      self.header["channels"])
+        self.dtype = np.dtype(self.header["dtype"])
+        self.extension = self.header["extension"]
+        index_offset = self.header["index_offset"]
+        data_offset = self.header["data_offset"]
+        self.mm = np.memmap(fn, mode="r")
+        self.index = self.mm[index_offset:index_offset +
+                             capacity * SPOOL_INDEX_DTYPE.itemsize].view(
+                                 SPOOL_INDEX_DTYPE)
+        exif_offset = self.header["exif_offset"]
+        exif_bytes = self.header["exif_bytes"]
+        self.exif = self.mm[exif_offset:exif_offset +
+                            capacity * exif_bytes].reshape(
+                                (capacity, exif_bytes))
+        self.frames = self.mm[data_offset:data_offset +
+                              capacity * self.header["frame_bytes"]].view(
+                                  self.dtype).reshape((capacity, ) +
+                                                      self.shape)
+        # name => slot
+        self.slots = {}
+        for slot in np.flatnonzero(self.index["valid"]):
+            self.slots[self.index[slot]["name"].decode("ascii")] = int(slot)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def names(self):
+        return sorted(self.slots.keys())
+
+    def get(self, name):
+        """
+        Return a read only HxWxC view of the frame
+        """
+        return self.frames[self.slots[name]]
+
+    def key(self, name):
+        """
+        Return planner state dict (col, row, etc) the frame was saved with
+        """
+        entry = self.index[self.slots[name]]
+        ret = {}
+        for state_key, index_key in SPOOL_STATE_KEYS:
+            v = int(entry[index_key])
+            if v >= 0:
+                ret[state_key] = v
+        return ret
+
+    def get_exif(self, name):
+        """
+        Return the EXIF bytes the frame was captured with or None
+        """
+        slot = self.slots[name]
+        n = int(self.index[slot]["exif_len"])
+        if not n:
+            return None
+        return self.exif[slot, :n].tobytes()
+
+    def to_im(self, name):
+        im = Image.fromarray(np.ascontiguousarray(self.get(name)))
+        # Like Image.open() on a saved tile
+        exif = self.get_exif(name)
+        if exif is not None:
+            im.info["exif"] = exif
+        return im
+
+    def save(self, name, fn, **kwargs):
+        """
+        Write frame as a normal image file, keeping its EXIF
+        """
+        exif = self.get_exif(name)
+        if exif is not None:
+            kwargs["exif"] = exif
+        self.to_im(name).save(fn, **kwargs)
+
+
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+def open_spool(fn):
+    """
+    Shared reader per spool file
+    Reopened if the file has been rewritten
+    """
+    fn = os.path.realpath(fn)
+    st = os.stat(fn)
+    key = (st.st_ino, st.st_size)
+    with _readers_lock:
+        cached = _readers.get(fn)
+        if cached is None or cached[0] != key:
+            cached = (key, SpoolReader(fn))
+            _readers[fn] = cached
+        return cached[1]
+
+
+def index_spool_images(fn):
+    """
+    Like index_scan_images() but for a spool
+    Images are the virtual per tile basenames
+    """
+    reader = open_spool(fn)
+    ret = index_scan_basenames(
+        os.path.dirname(fn),
+        [name + reader.extension for name in reader.names()])
+    ret["spool"] = os.path.realpath(fn)
+    return ret
+
+
+def spool_to_dir(fn, dir_out=None, extension=None, quality=95, log=None):
+    """
+    Write the classic one file per tile directory (ex: for CloudStitch)
+    Defaults to the scan directory and the extension the scan was configured with
+    """
+    reader = open_spool(fn)
+    if dir_out is None:
+        dir_out = os.path.dirname(os.path.realpath(fn))
+    if extension is None:
+        extension = reader.extension
+    if not os.path.exists(dir_out):
+        os.mkdir(dir_out)
+    kwargs = {}
+    if extension == ".jpg" or extension == ".jpeg":
+        kwargs["quality"] = quality
+    for name in reader.names():
+        fn_out = os.path.join(dir_out, name + extension)
+        log and log("%s => %s" % (name, fn_out))
+        reader.save(name, fn_out, **kwargs)
+    return dir_out
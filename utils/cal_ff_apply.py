@@ -8,28 +8,7 @@ import glob
 import os
 import math
 from uscope import config
-
-
-def npf2im(statef):
-    #return statef, None
-    rounded = np.round(statef)
-    #print("row1: %s" % rounded[1])
-    statei = np.array(rounded, dtype=np.uint16)
-    #print(len(statei), len(statei[0]), len(statei[0]))
-    height = len(statef)
-    width = len(statef[0])
-
-    # for some reason I isn't working correctly
-    # only L
-    # workaround by plotting manually
-    im = Image.new("RGB", (width, height), "Black")
-    for y, row in enumerate(statei):
-        for x, val in enumerate(row):
-            # this causes really weird issues if not done
-            val = tuple(int(x) for x in val)
-            im.putpixel((x, y), val)
-
-    return im
+from uscope.imagep.util import npf2im
 
 
 def average_imgs(imgs, scalar=None):
@@ -38,10 +17,13 @@ def average_imgs(imgs, scalar=None):
         scalar = 1.0
     scalar = scalar / len(imgs)
 
-    statef = np.zeros((height, width, 3), np.float)
+    # Accumulate in place
+    # float32 is exact for integer sums well past any practical frame count
+    statef = np.zeros((height, width, 3), np.float32)
     for im in imgs:
         assert (width, height) == im.size
-        statef = statef + scalar * np.array(im, dtype=np.float)
+        np.add(statef, np.asarray(im), out=statef)
+    statef *= scalar
 
     return statef, npf2im(statef)
 
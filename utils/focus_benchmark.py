@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Compare autofocus metrics by replaying captured focus stacks
+Each stack (ex: c000_r001_z00.jpg ... c000_r001_z06.jpg) is one simulated autofocus sweep
+Ground truth is either a JSON file or the reference metric at full resolution
+"""
+
+from uscope.imager.autofocus import FOCUS_METRICS, get_focus_metric, focus_roi_gray
+from uscope.scan_util import index_scan_images, bucket_group
+import numpy as np
+import json
+import os
+import time
+from PIL import Image
+
+
+def is_unimodal(scores):
+    """
+    Scores rise to a single peak and then fall
+    Required for early stopping and bracketing searches to converge
+    """
+    peaki = int(np.argmax(scores))
+    rising = np.diff(scores[:peaki + 1])
+    falling = np.diff(scores[peaki:])
+    return bool(np.all(rising >= 0) and np.all(falling <= 0))
+
+
+def load_stacks(dirs_in):
+    """
+    Return list of (name, [filenames in z order])
+    """
+    ret = []
+    for dir_in in dirs_in:
+        iindex = index_scan_images(dir_in)
+        if not iindex["stacks"]:
+            print(f"WARNING: {dir_in}: no focus stacks, skipping")
+            continue
+        for fn_prefix, stack in sorted(bucket_group(iindex, "stack").items()):
+            fns = [
+                os.path.join(iindex["dir"], fn)
+                for _i, fn in sorted(stack.items())
+            ]
+            name = fn_prefix
+            if len(dirs_in) > 1:
+                name = os.path.basename(iindex["dir"]) + "/" + fn_prefix
+            ret.append((name, fns))
+    return ret
+
+
+def run(dirs_in,
+        metrics,
+        downsample=2,
+        reference="laplacian",
+        truth_fn=None,
+        limit=0,
+        verbose=False):
+    stacks = load_stacks(dirs_in)
+    if limit:
+        stacks = stacks[0:limit]
+    assert stacks, "No focus stacks found"
+
+    truth = None
+    if truth_fn:
+        with open(truth_fn) as f:
+            truth = json.load(f)
+
+    reference_metric = get_focus_metric(reference)
+    roi_times = []
+    times = dict([(metric, []) for metric in metrics])
+    errors = dict([(metric, []) for metric in metrics])
+    unimodal = dict([(metric, 0) for metric in metrics])
+    nframes = 0
+    for name, fns in stacks:
+        ims = [Image.open(fn) for fn in fns]
+        if truth is not None:
+            if name not in truth:
+                print(f"WARNING: {name}: no ground truth, skipping")
+                continue
+            truei = int(truth[name])
+        else:
+            truei = int(
+                np.argmax([
+                    reference_metric(focus_roi_gray(im), downsample=1)
+                    for im in ims
+                ]))
+
+        ims_gray = []
+        for im in ims:
+            tstart = time.time()
+            ims_gray.append(focus_roi_gray(im, downsample=downsample))
+            roi_times.append(time.time() - tstart)
+        nframes += len(ims)
+
+        line = "%s: %u images, truth %u" % (name, len(ims), truei)
+        for metric in metrics:
+            metric_func = get_focus_metric(metric)
+            scores = []
+            for im_gray in ims_gray:
+                tstart = time.time()
+                scores.append(metric_func(im_gray, downsample=downsample))
+                times[metric].append(time.time() - tstart)
+            besti = int(np.argmax(scores))
+            errors[metric].append(abs(besti - truei))
+            unimodal[metric] += is_unimodal(scores)
+            line += ", %s %u" % (metric, besti)
+            if verbose:
+                print("  %s: %s" % (metric, " ".join("%0.4g" % score
+                                                     for score in scores)))
+        print(line)
+
+    nstacks = len(errors[metrics[0]])
+    print("")
+    print("Summary (%u stacks, %u frames, downsample %u)" %
+          (nstacks, nframes, downsample))
+    print("  ROI extract: %0.2f ms / frame" % (np.mean(roi_times) * 1000, ))
+    for metric in metrics:
+        error = np.array(errors[metric])
+        print(
+            "  %s: exact %0.1f%%, within 1 %0.1f%%, mean error %0.2f steps, unimodal %0.1f%%, %0.2f ms / frame"
+            % (metric, 100.0 * np.mean(error == 0),
+               100.0 * np.mean(error <= 1), np.mean(error), 100.0 *
+               unimodal[metric] / nstacks, np.mean(times[metric]) * 1000))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark autofocus metrics against captured focus stacks"
+    )
+    parser.add_argument("--metrics",
+                        default=",".join(FOCUS_METRICS.keys()),
+                        help="Comma separated")
+    parser.add_argument("--downsample", type=int, default=2)
+    parser.add_argument(
+        "--reference",
+        default="laplacian",
+        help="Ground truth metric (run at full resolution) if no --truth")
+    parser.add_argument(
+        "--truth",
+        help="JSON file mapping stack name (ex: c000_r001) to best z index")
+    parser.add_argument("--limit",
+                        type=int,
+                        default=0,
+                        help="Only process first n stacks")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("dirs_in", nargs="+")
+    args = parser.parse_args()
+
+    run(args.dirs_in,
+        args.metrics.split(","),
+        downsample=args.downsample,
+        reference=args.reference,
+        truth_fn=args.truth,
+        limit=args.limit,
+        verbose=args.verbose)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Estimate how long a scan will take without running it
+Simulates the planner pipeline with modeled move / settle / capture / save costs
+Ex: compare objectives or stack settings before committing instrument time
+"""
+
+from uscope.microscope import get_virtual_microscope, get_mconfig
+from uscope.planner.planner_util import microscope_to_planner_config
+from uscope.planner.simulate import simulate_scan, format_estimate
+from uscope.planner.simulate import T_CAPTURE, MOVE_OVERHEAD
+from uscope.util import add_bool_arg
+import json
+
+
+def parse_axes(s):
+    """
+    "x=960,y=960" => {"x": 960.0, "y": 960.0}
+    """
+    ret = {}
+    if not s:
+        return ret
+    for part in s.split(","):
+        axis, value = part.split("=")
+        ret[axis.strip()] = float(value)
+    return ret
+
+
+def parse_contour(s):
+    x0, y0, x1, y1 = [float(x) for x in s.split(",")]
+    return {"start": {"x": x0, "y": y0}, "end": {"x": x1, "y": y1}}
+
+
+def make_pconfig(microscope, objective, args):
+    if args.pconfig:
+        with open(args.pconfig, "r") as f:
+            pconfig = json.load(f)
+        # Also accept uscan.json from a previous scan
+        pconfig = pconfig.get("pconfig", pconfig)
+    else:
+        assert args.contour, "Need --contour or --pconfig"
+        pconfig = microscope_to_planner_config(microscope,
+                                               objective=objective,
+                                               contour=parse_contour(
+                                                   args.contour))
+    if args.stack:
+        pconfig["points-stacker"] = {
+            "number": args.stack,
+            "distance": args.stack_distance,
+        }
+    if args.save_threads is not None:
+        pconfig["imager"]["save_threads"] = args.save_threads
+    if args.save_spool is not None:
+        pconfig["imager"]["save_spool"] = args.save_spool
+    return pconfig
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Estimate scan time by simulating the planner")
+    parser.add_argument("--microscope")
+    parser.add_argument("--sn")
+    parser.add_argument("--objective",
+                        help="Objective name. Default: first objective")
+    add_bool_arg(parser,
+                 "--all-objectives",
+                 default=False,
+                 help="Estimate the same area with each objective")
+    parser.add_argument("--contour", help="Scan area in mm as x0,y0,x1,y1")
+    parser.add_argument(
+        "--pconfig",
+        help="Planner config JSON (or uscan.json) instead of --contour")
+    parser.add_argument("--stack",
+                        type=int,
+                        default=0,
+                        help="Focus stack images per tile")
+    parser.add_argument("--stack-distance",
+                        type=float,
+                        default=0.01,
+                        help="Focus stack total distance in mm")
+    parser.add_argument("--save-threads", type=int, default=None)
+    add_bool_arg(parser, "--save-spool", default=None)
+    parser.add_argument("--velocities",
+                        help="Machine mm/min, ex: x=960,y=960,z=1920")
+    parser.add_argument("--accelerations",
+                        help="Machine mm/sec^2, ex: x=24,y=24,z=24")
+    parser.add_argument("--t-capture",
+                        type=float,
+                        default=T_CAPTURE,
+                        help="Seconds per frame")
+    parser.add_argument("--t-save",
+                        type=float,
+                        default=None,
+                        help="Seconds to save an image. Default: estimate")
+    parser.add_argument("--move-overhead",
+                        type=float,
+                        default=MOVE_OVERHEAD,
+                        help="Seconds per move on top of travel")
+    add_bool_arg(parser, "--verbose", default=False)
+    args = parser.parse_args()
+
+    microscope = get_virtual_microscope(
+        mconfig=get_mconfig(name=args.microscope, serial=args.sn))
+    objectives = microscope.get_objectives()
+    if args.all_objectives:
+        names = objectives.names()
+    else:
+        names = [args.objective or objectives.default_name()]
+
+    for name in names:
+        objective = objectives.get_config(name)
+        pconfig = make_pconfig(microscope, objective, args)
+        result = simulate_scan(microscope,
+                               pconfig,
+                               velocities=parse_axes(args.velocities),
+                               accelerations=parse_axes(args.accelerations),
+                               t_capture=args.t_capture,
+                               t_save=args.t_save,
+                               move_overhead=args.move_overhead,
+                               log=print if args.verbose else None)
+        print("Objective: %s" % name)
+        for line in format_estimate(result):
+            print("  " + line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Convert a scan captured with imager.save_spool into one image file per tile
+Ex: to upload to CloudStitch without running the full image processing pipeline
+"""
+
+from uscope.spool import spool_fn, spool_to_dir, open_spool
+import os
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Write per tile images from a raw frame spool")
+    parser.add_argument("--extension",
+                        default=None,
+                        help="Default: as configured when scanned (ex: .jpg)")
+    parser.add_argument("--quality", type=int, default=95)
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("scan_dir")
+    parser.add_argument("dir_out",
+                        nargs="?",
+                        help="Default: write next to the spool")
+    args = parser.parse_args()
+
+    fn = args.scan_dir
+    if os.path.isdir(fn):
+        fn = spool_fn(fn)
+    reader = open_spool(fn)
+    print("%s: %u frames, %ux%u" %
+          (fn, len(reader), reader.shape[1], reader.shape[0]))
+    dir_out = spool_to_dir(fn,
+                           dir_out=args.dir_out,
+                           extension=args.extension,
+                           quality=args.quality,
+                           log=print if args.verbose else None)
+    print("Wrote %s" % (dir_out, ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Compare focus stacking plugins on a captured scan
+Reports wall time per stack and how similar the outputs are
+Reference is the first plugin (by default enfuse)
+"""
+
+from uscope.imagep.pipeline import microscope_name_from_scan_dir
+from uscope.imagep.plugins import get_plugin_ctors
+from uscope.imagep.util import EtherealImageR, EtherealImageW
+from uscope.microscope import get_virtual_microscope
+from uscope.scan_util import index_scan_images, bucket_group
+import numpy as np
+import cv2
+import os
+import tempfile
+import time
+
+
+def compare_images(fn_ref, fn_test):
+    ref = cv2.imread(fn_ref)
+    test = cv2.imread(fn_test)
+    if ref.shape != test.shape:
+        return None, None
+    mad = float(np.mean(cv2.absdiff(ref, test)))
+    return cv2.PSNR(ref, test), mad
+
+
+def run(dir_in, plugin_names, microscope_name=None, limit=0, verbose=False):
+    mconfig = {}
+    if microscope_name:
+        mconfig["name"] = microscope_name
+    else:
+        microscope_name_from_scan_dir(dir_in, mconfig)
+    microscope = get_virtual_microscope(mconfig=mconfig)
+
+    iindex = index_scan_images(dir_in)
+    assert iindex["stacks"], "Directory doesn't have focus stacks"
+    buckets = bucket_group(iindex, "stack")
+    if limit:
+        buckets = dict(list(sorted(buckets.items()))[0:limit])
+    log = print if verbose else lambda s: None
+
+    ctors = get_plugin_ctors()
+    plugins = {}
+    for name in plugin_names:
+        plugins[name] = ctors[name](log=log, microscope=microscope)
+
+    times = dict([(name, []) for name in plugin_names])
+    psnrs = dict([(name, []) for name in plugin_names[1:]])
+    mads = dict([(name, []) for name in plugin_names[1:]])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for fn_prefix, stack in sorted(buckets.items()):
+            fns = [
+                os.path.join(iindex["dir"], fn)
+                for _i, fn in sorted(stack.items())
+            ]
+            fns_out = {}
+            for name, plugin in plugins.items():
+                fn_out = os.path.join(tmp_dir, f"{fn_prefix}_{name}.jpg")
+                data_in = {"images": [EtherealImageR(fn=fn) for fn in fns]}
+                data_out = {"image": EtherealImageW(want_fn=fn_out)}
+                tstart = time.time()
+                plugin.run(data_in=data_in, data_out=data_out)
+                dt = time.time() - tstart
+                times[name].append(dt)
+                fns_out[name] = fn_out
+            line = "%s: %u images" % (fn_prefix, len(fns))
+            for name in plugin_names:
+                line += ", %s %0.2f sec" % (name, times[name][-1])
+            for name in plugin_names[1:]:
+                psnr, mad = compare_images(fns_out[plugin_names[0]],
+                                           fns_out[name])
+                if psnr is None:
+                    line += ", %s size mismatch" % (name, )
+                    continue
+                psnrs[name].append(psnr)
+                mads[name].append(mad)
+                line += ", %s PSNR %0.1f dB" % (name, psnr)
+            print(line)
+
+    print("")
+    print("Summary (%u stacks)" % len(buckets))
+    for name in plugin_names:
+        print("  %s: %0.3f sec / stack, %0.1f sec total" %
+              (name, np.mean(times[name]), np.sum(times[name])))
+    for name in plugin_names[1:]:
+        if not psnrs[name]:
+            continue
+        print("  %s vs %s: PSNR %0.1f dB (min %0.1f), mean abs diff %0.2f" %
+              (name, plugin_names[0], np.mean(psnrs[name]), np.min(
+                  psnrs[name]), np.mean(mads[name])))
+        print("  %s speedup: %0.2fx" %
+              (name, np.sum(times[plugin_names[0]]) / np.sum(times[name])))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark focus stacking plugins against each other")
+    parser.add_argument("--microscope")
+    parser.add_argument("--plugins",
+                        default="stack-enfuse,stack-native",
+                        help="Comma separated. First is the reference")
+    parser.add_argument("--limit",
+                        type=int,
+                        default=0,
+                        help="Only process first n stacks")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("dir_in")
+    args = parser.parse_args()
+
+    run(args.dir_in,
+        args.plugins.split(","),
+        microscope_name=args.microscope,
+        limit=args.limit,
+        verbose=args.verbose)
+
+
+if __name__ == "__main__":
+    main()